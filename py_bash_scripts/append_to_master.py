@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""
+Incremental, crash-safe append of new embeddings into the embeddings/keys master store.
+
+merge_checkpoints.sh copies datasets one key at a time into a per-key master. Here new
+per-task files (per-key or embeddings/keys layout) are appended to the final two-dataset
+store in large blocks, skipping every key that is already in the master (checked against
+its key index, see key_index.py) or that was already appended in this run.
+
+Every run is a transaction recorded in <master>.journal, which is fsynced before the
+master is touched and removed only once the master and its key index are both updated:
+  - staging (default): the master is copied to <master>.staging, the rows are appended
+    to the copy, and the copy is renamed over the master. The master itself is only ever
+    replaced whole; a dead run just leaves a staging file that recovery deletes. Needs
+    space for a second copy, but readers never see the master change under them.
+  - --in-place: the journal holds the row count before the append. If the run raises or
+    is stopped cleanly, the next run (or --recover) shrinks the datasets back to that
+    count. This is NOT atomic on a crash: a process killed while HDF5 is writing can
+    leave metadata that h5py cannot open any more, and then there is nothing to roll
+    back. Only use it with a backup of the master.
+Appenders serialize on an exclusive flock of <master>.lock, a file that is never
+replaced (a lock on the master itself would be lost when staging renames a new file
+over it). While appending they also hold an exclusive flock on the master, so the
+embedder's shared lock in read_processed_ids waits for the commit.
+"""
+import argparse
+import fcntl
+import glob
+import json
+import os
+import shutil
+import sys
+import time
+
+import h5py
+import numpy as np
+
+from embedding_store import DEFAULT_PROFILE, append_rows, create_store_datasets, iter_embedding_blocks
+from key_index import KeyIndex, build_key_index, hash_keys, index_paths, sort_unique_hashes, write_key_index
+
+
+def journal_path(master_path):
+    return f"{master_path}.journal"
+
+
+def staging_path(master_path):
+    return f"{master_path}.staging"
+
+
+def lock_path(master_path):
+    return f"{master_path}.lock"
+
+
+def _fsync_dir(path):
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_file(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_journal(master_path, entry):
+    """Durably replace the journal with entry (a dict)."""
+    path = journal_path(master_path)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        json.dump(entry, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(path)
+
+
+def read_journal(master_path):
+    path = journal_path(master_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def remove_journal(master_path):
+    os.remove(journal_path(master_path))
+    _fsync_dir(master_path)
+
+
+def truncate_store(path, n_rows):
+    """Shrink every row dataset of the store at path back to n_rows."""
+    with h5py.File(path, 'a', locking=False) as hf:
+        for name in ('embeddings', 'scales', 'keys'):
+            if name in hf and hf[name].shape[0] > n_rows:
+                hf[name].resize(n_rows, axis=0)
+    _fsync_file(path)
+
+
+def store_rows(path):
+    """Rows of the store at path, or None if there is no store there yet (missing or empty file)."""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    with h5py.File(path, 'r', locking=False) as hf:
+        return hf['embeddings'].shape[0] if 'embeddings' in hf else None
+
+
+def recover(master_path, index_prefix):
+    """Finish or undo an interrupted run recorded in the journal. Call with the master locked."""
+    entry = read_journal(master_path)
+    if entry is None:
+        return
+    print(f"Found journal of an interrupted append ({entry['state']}, {entry['mode']}, started {entry['started']})")
+    rows_before = entry['rows_before']
+    if entry['state'] == 'appending' and entry['mode'] == 'staging':
+        if os.path.exists(staging_path(master_path)):
+            # os.replace is atomic, so while the staging copy exists it was not renamed over the master
+            print(f"Removing staging copy {staging_path(master_path)}; it was never renamed over the master")
+            os.remove(staging_path(master_path))
+        rows = store_rows(master_path)
+        if rows is not None and rows > rows_before:
+            # died after the rename but before the journal said so: the append is complete
+            print(f"The staging copy was renamed over {master_path} ({rows} rows, {rows_before} before the append); "
+                  f"keeping it and rebuilding the key index {index_prefix}")
+            build_key_index(master_path, index_prefix, lock=False)
+        else:
+            print(f"{master_path} is unchanged ({rows if rows is not None else 'no'} rows, "
+                  f"{rows_before} before the append)")
+    elif entry['state'] == 'appending':
+        try:
+            rows = store_rows(master_path)
+        except OSError as e:
+            # the journal is kept, so the failure is reported again until the master is restored
+            raise RuntimeError(f"{master_path} cannot be opened after an interrupted in-place append ({e}); "
+                               f"restore it from a backup (it had {rows_before} rows) and remove "
+                               f"{journal_path(master_path)}") from e
+        if rows is not None and rows > rows_before:
+            print(f"Rolling back {master_path} from {rows} to {rows_before} rows")
+            truncate_store(master_path, rows_before)
+        else:
+            print(f"{master_path} is unchanged ({rows if rows is not None else 'no'} rows, "
+                  f"{rows_before} before the append)")
+    elif entry['state'] == 'committed':
+        # the master has all the new rows, but its key index may not
+        print(f"Append was committed; rebuilding the key index {index_prefix}")
+        build_key_index(master_path, index_prefix, lock=False)
+    remove_journal(master_path)
+
+
+def update_key_index(index_prefix, key_index, new_hashes, new_rows, master_path):
+    """Merge the hashes and rows appended in this run into the master's key index."""
+    hash_parts, row_parts = [new_hashes], [new_rows]
+    bloom_bits_per_key = 0
+    if key_index is not None:
+        hash_parts.insert(0, np.asarray(key_index.hashes))
+        row_parts.insert(0, np.asarray(key_index.rows))
+        if key_index.meta.get('bloom'):
+            bloom_bits_per_key = round(key_index.meta['bloom']['n_bits'] / max(1, len(key_index)))
+    hashes, rows = sort_unique_hashes(hash_parts, row_parts)
+    write_key_index(index_prefix, hashes, rows, master_path, bloom_bits_per_key)
+    return len(hashes)
+
+
+def iter_new_rows(input_files, key_index, block_rows):
+    """
+    Stream (keys, embeddings, hashes) blocks of the input rows whose keys are neither in
+    the master nor earlier in this run.
+    """
+    seen = set()
+    for fname in input_files:
+        n_new = n_dup = 0
+        for keys_block, emb_block in iter_embedding_blocks(fname, block_rows):
+            hashes = hash_keys(keys_block)
+            fresh = ~key_index.contains_hashes(hashes) if key_index is not None else np.ones(len(hashes), bool)
+            for i in np.flatnonzero(fresh):
+                if hashes[i] in seen:
+                    fresh[i] = False
+                else:
+                    seen.add(hashes[i])
+            keep = np.flatnonzero(fresh)
+            n_new += len(keep)
+            n_dup += len(keys_block) - len(keep)
+            if len(keep):
+                yield [keys_block[i] for i in keep], emb_block[keep], hashes[keep]
+        print(f"  {fname}: {n_new} new, {n_dup} already present")
+        sys.stdout.flush()
+
+
+def append_to_master(master_path, input_files, index_prefix=None, block_rows=100_000, staging=True,
+                     profile=DEFAULT_PROFILE):
+    """Append the new rows of input_files to the store at master_path as one transaction."""
+    index_prefix = index_prefix if index_prefix is not None else f"{master_path}.keyidx"
+    start_time = time.time()
+    with open(lock_path(master_path), 'a') as lock_file:
+        print("Acquiring exclusive lock...")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # opened only once we hold the lock, so this is the master no other appender replaces
+        master_file = open(master_path, 'ab+')
+        fcntl.flock(master_file, fcntl.LOCK_EX)
+        try:
+            recover(master_path, index_prefix)
+
+            if os.path.getsize(master_path) == 0:
+                width = next(iter_embedding_blocks(input_files[0], 1))[1].shape[1]
+                print(f"Creating a new {width}-d store with profile {profile}")
+                with h5py.File(master_path, 'w', locking=False) as hf:
+                    create_store_datasets(hf, width, profile=profile)
+                _fsync_file(master_path)
+
+            # the index is checked before the master is opened for writing, which may touch its mtime
+            if not os.path.exists(index_paths(index_prefix)['meta']):
+                build_key_index(master_path, index_prefix, lock=False)
+            key_index = KeyIndex(index_prefix)
+            if key_index.meta.get('source_mtime') != os.path.getmtime(master_path):
+                print(f"Key index {index_prefix} is older than the master; rebuilding it")
+                build_key_index(master_path, index_prefix, lock=False)
+                key_index = KeyIndex(index_prefix)
+            with h5py.File(master_path, 'r', locking=False) as hf:
+                rows_before = hf['embeddings'].shape[0]
+            print(f"Master {master_path} has {rows_before} rows and {len(key_index)} indexed keys")
+
+            target = master_path
+            journal = {'state': 'appending', 'mode': 'staging' if staging else 'in_place',
+                       'rows_before': rows_before, 'started': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'pid': os.getpid()}
+            write_journal(master_path, journal)
+            if staging:
+                target = staging_path(master_path)
+                print(f"Copying the master to {target}")
+                sys.stdout.flush()
+                shutil.copyfile(master_path, target)
+
+            new_hash_parts, new_row_parts = [], []
+            with h5py.File(target, 'a', locking=False) as hf:
+                emb_ds, keys_ds = hf['embeddings'], hf['keys']
+                total = rows_before
+                for keys_block, emb_block, hashes in iter_new_rows(input_files, key_index, block_rows):
+                    new_total = append_rows(emb_ds, keys_ds, emb_block, np.array(keys_block, dtype=object))
+                    new_hash_parts.append(hashes)
+                    new_row_parts.append(np.arange(total, new_total, dtype=np.int64))
+                    total = new_total
+                    print(f"  Appended {len(keys_block)} rows (master now {total} rows)")
+                    sys.stdout.flush()
+            _fsync_file(target)
+            if staging:
+                os.replace(target, master_path)
+                _fsync_dir(master_path)
+
+            write_journal(master_path, dict(journal, state='committed', rows_after=total))
+            new_hashes = np.concatenate(new_hash_parts) if new_hash_parts else np.empty(0, np.uint64)
+            new_rows = np.concatenate(new_row_parts) if new_row_parts else np.empty(0, np.int64)
+            n_indexed = update_key_index(index_prefix, key_index, new_hashes, new_rows, master_path)
+            remove_journal(master_path)
+        finally:
+            print("Releasing exclusive lock...")
+            fcntl.flock(master_file, fcntl.LOCK_UN)
+            master_file.close()
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    print(f"Committed {total - rows_before} new rows to {master_path} ({total} rows, {n_indexed} indexed keys) "
+          f"in {time.time() - start_time:.1f}[s]")
+    return total - rows_before
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Append new embeddings to the embeddings/keys master store, "
+                                                 "skipping keys it already has, as one crash-safe transaction.",
+                                     allow_abbrev=False)
+    parser.add_argument('--master', type=str, required=True,
+                        help="Master HDF5 store to append to (created if missing)")
+    parser.add_argument('--input-patterns', type=str, default=None,
+                        help="Comma-separated glob patterns for the new HDF5 files (e.g., 'embed_462*,embed_46330*')")
+    parser.add_argument('--index-prefix', type=str, default=None,
+                        help="Key index of the master (default: <master>.keyidx; built if missing)")
+    parser.add_argument('--block-rows', type=int, default=100_000,
+                        help="Rows to append at a time (default: 100000)")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--staging', dest='staging', action='store_true', default=True,
+                      help="Append to a copy of the master and rename it over the master when done (default)")
+    mode.add_argument('--in-place', dest='staging', action='store_false',
+                      help="Append to the master itself with a rollback journal: no second copy, "
+                           "but not atomic if the process is killed mid-write")
+    parser.add_argument('--storage-profile', type=str, default=DEFAULT_PROFILE,
+                        help="Storage profile if the master is created (default: float32)")
+    parser.add_argument('--recover', action='store_true',
+                        help="Only finish or roll back an interrupted append, then exit")
+    args = parser.parse_args()
+
+    if args.recover:
+        index_prefix = args.index_prefix if args.index_prefix is not None else f"{args.master}.keyidx"
+        with open(lock_path(args.master), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(args.master):
+                    with open(args.master, 'rb') as master_file:
+                        fcntl.flock(master_file, fcntl.LOCK_EX)
+                        recover(args.master, index_prefix)
+                else:
+                    # e.g. a first append killed before the master was written
+                    recover(args.master, index_prefix)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return
+    if args.input_patterns is None:
+        parser.error("--input-patterns is required unless --recover is given")
+
+    input_files = []
+    for pattern in (p.strip() for p in args.input_patterns.split(',')):
+        input_files.extend(sorted(glob.glob(pattern)))
+    if not input_files:
+        print("No input files found. Exiting.")
+        return
+    print(f"Found {len(input_files)} files")
+
+    append_to_master(args.master, input_files, args.index_prefix, args.block_rows, args.staging,
+                     args.storage_profile)
+
+
+if __name__ == '__main__':
+    main()
+
+# python /lisc/project/dome/protein_embeddings/py_bash_scripts/append_to_master.py --master /lisc/project/dome/protein_embeddings/GlobDB/embeddings/chlor_plus_part001and002.h5 --input-patterns "/lisc/scratch/dome/pullen/GlobDB/embeddings/embed_4912031*"
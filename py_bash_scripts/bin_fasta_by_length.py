@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Bin the sequences of a large FASTA file by length, in one pass.
+
+Does the job of part1chunking.sh, which reads the FASTA about a dozen times (seqkit seq
+-M and -m, fx2tab, then one awk and one seqkit grep per bin). Here the lengths come from
+the .fai index (see fasta_index.py; the FASTA is scanned once instead if there is no
+index), each record is assigned to its bin, consecutive records of the same bin are
+merged into byte ranges, and the ranges are copied to the bin files in file order, so
+the FASTA is read once, sequentially, with kernel-side copies (fasta_index.copy_range).
+The `seqkit stats -b` table is computed from the same lengths.
+
+The output layout and names match part1chunking.sh, so calc_num_splits.py and the rest
+of the pipeline work unchanged. With the default bins and -o output:
+  output/bins/<prefix>_filtered1000AAmax_sorted_0_99.fasta ... _900_1000.fasta
+  output/bins/<prefix>_filtered1001AAmin.fasta
+  output/stats/<prefix>_stats.txt   the filtered1000AAmax total, then one line per bin
+
+To loop over a dir of fastas
+for fasta in *.fasta; do python /lisc/project/dome/protein_embeddings/py_bash_scripts/bin_fasta_by_length.py -i "$fasta" ; done
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+from fasta_index import FastaIndex, copy_range
+
+# Lower and upper length (inclusive) of each bin; an open-ended last bin is written "1001-".
+DEFAULT_BINS = "0-99,100-199,200-299,300-399,400-499,500-599,600-699,700-799,800-899,900-1000,1001-"
+
+
+def parse_bins(spec):
+    """'0-99,100-199,1001-' -> [(0, 99), (100, 199), (1001, None)], checked to be sorted and disjoint."""
+    bins = []
+    for part in spec.split(','):
+        lower, sep, upper = part.strip().partition('-')
+        if not sep or not lower:
+            raise ValueError(f"Invalid bin '{part}': expected LOWER-UPPER or LOWER- (open-ended)")
+        bins.append((int(lower), int(upper) if upper else None))
+    for i, (lower, upper) in enumerate(bins):
+        if upper is not None and upper < lower:
+            raise ValueError(f"Invalid bin {lower}-{upper}: upper bound below lower bound")
+        if i + 1 < len(bins) and (upper is None or bins[i + 1][0] <= upper):
+            raise ValueError(f"Bins must be sorted and must not overlap: {lower}-{upper if upper is not None else ''}")
+    return bins
+
+
+def bin_paths(bins_dir, prefix, bins):
+    """Output FASTA of each bin, named as by part1chunking.sh."""
+    max_bounded = max((upper for _, upper in bins if upper is not None), default=0)
+    return [os.path.join(bins_dir, f"{prefix}_filtered{max_bounded}AAmax_sorted_{lower}_{upper}.fasta")
+            if upper is not None else os.path.join(bins_dir, f"{prefix}_filtered{lower}AAmin.fasta")
+            for lower, upper in bins]
+
+
+def assign_bins(lengths, bins):
+    """Bin number of each length, or -1 if it falls in no bin."""
+    lowers = np.array([lower for lower, _ in bins], dtype=np.int64)
+    uppers = np.array([upper if upper is not None else np.iinfo(np.int64).max for _, upper in bins],
+                      dtype=np.int64)
+    bin_of = np.searchsorted(lowers, lengths, side='right') - 1
+    outside = (bin_of < 0) | (lengths > uppers[np.maximum(bin_of, 0)])
+    bin_of[outside] = -1
+    return bin_of
+
+
+def byte_runs(records, bin_of):
+    """(bin, start, end) of each run of consecutive records in the same bin, in file order."""
+    if not len(records):
+        return []
+    breaks = np.flatnonzero(np.diff(bin_of)) + 1
+    first = np.concatenate(([0], breaks))
+    last = np.concatenate((breaks, [len(records)])) - 1
+    return [(int(bin_of[f]), int(records['start'][f]), int(records['end'][l]))
+            for f, l in zip(first, last) if bin_of[f] >= 0]
+
+
+def length_stats(lengths):
+    """(num_seqs, sum_len, min_len, avg_len, max_len), 0 for an empty bin like seqkit stats."""
+    if not len(lengths):
+        return 0, 0, 0, 0.0, 0
+    return len(lengths), int(lengths.sum()), int(lengths.min()), float(lengths.mean()), int(lengths.max())
+
+
+def format_stats(rows):
+    """The `seqkit stats -b` table for rows of (file name, length stats)."""
+    table = [('file', 'format', 'type', 'num_seqs', 'sum_len', 'min_len', 'avg_len', 'max_len')]
+    for name, (num, total, lo, avg, hi) in rows:
+        table.append((name, 'FASTA', 'Protein', f"{num:,}", f"{total:,}", f"{lo:,}", f"{avg:,.1f}", f"{hi:,}"))
+    widths = [max(len(row[c]) for row in table) for c in range(len(table[0]))]
+    lines = []
+    for row in table:
+        cells = [row[c].ljust(widths[c]) if c < 3 else row[c].rjust(widths[c]) for c in range(len(row))]
+        lines.append('  '.join(cells).rstrip() + '\n')
+    return ''.join(lines)
+
+
+def bin_fasta(input_fasta, output_dir="output", bins=DEFAULT_BINS, fai_path=None, stats_only=False):
+    """Write the bin FASTAs and the stats file for input_fasta. Returns the stats rows."""
+    start_time = time.time()
+    bins = parse_bins(bins) if isinstance(bins, str) else bins
+    prefix = os.path.splitext(os.path.basename(input_fasta))[0]
+    bins_dir = os.path.join(output_dir, "bins")
+    stats_dir = os.path.join(output_dir, "stats")
+    os.makedirs(bins_dir, exist_ok=True)
+    os.makedirs(stats_dir, exist_ok=True)
+
+    with FastaIndex(input_fasta, fai_path) as fasta:
+        print(f"Processing file: {input_fasta} ({len(fasta)} sequences, lengths from {fasta.source})")
+        sys.stdout.flush()
+        lengths = fasta.lengths
+        bin_of = assign_bins(lengths, bins)
+        paths = bin_paths(bins_dir, prefix, bins)
+        n_outside = int(np.count_nonzero(bin_of < 0))
+        if n_outside:
+            print(f"{n_outside} sequences are in no bin and are not written")
+
+        if not stats_only:
+            runs = byte_runs(fasta.records, bin_of)
+            fds = [os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644) for path in paths]
+            try:
+                for b, start, end in runs:
+                    copy_range(fasta.fileno(), fds[b], start, end - start)
+            finally:
+                for fd in fds:
+                    os.close(fd)
+            elapsed = max(time.time() - start_time, 1e-9)
+            print(f"Copied {fasta.fasta_size / 1024 ** 2:.1f} MB in {len(runs)} byte ranges to {len(paths)} bins "
+                  f"in {elapsed:.1f}[s] ({fasta.fasta_size / elapsed / 1024 ** 2:.1f} MB/s)")
+
+    # As part1chunking.sh: all bounded bins together first, then each bin.
+    bounded = np.isin(bin_of, [b for b, (_, upper) in enumerate(bins) if upper is not None])
+    max_bounded = max((upper for _, upper in bins if upper is not None), default=0)
+    rows = [(f"{prefix}_filtered{max_bounded}AAmax.fasta", length_stats(lengths[bounded]))]
+    rows += [(os.path.basename(path), length_stats(lengths[bin_of == b])) for b, path in enumerate(paths)]
+    stats_file = os.path.join(stats_dir, f"{prefix}_stats.txt")
+    with open(stats_file, 'a') as f:
+        f.write(format_stats(rows))
+    if not stats_only:
+        for path in paths:
+            print(f"Written {path}")
+    print(f"Stats appended to {stats_file}")
+    print(f"Processing complete in {time.time() - start_time:.1f}[s]. "
+          f"All output files are organized under the directory: {output_dir}")
+    sys.stdout.flush()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bin the sequences of a FASTA file by length in one pass, "
+                                                 "using its .fai index (replaces part1chunking.sh).")
+    parser.add_argument('-i', '--input', type=str, required=True,
+                        help="Input FASTA file")
+    parser.add_argument('-o', '--output-dir', type=str, default="output",
+                        help="Base output directory, with bins/ and stats/ below it (default: output)")
+    parser.add_argument('--fai', type=str, default=None,
+                        help="Index of the input (default: <input>.fai; the FASTA is scanned if there is none)")
+    parser.add_argument('--bins', type=str, default=DEFAULT_BINS,
+                        help="Comma-separated inclusive length ranges; the last may be open-ended "
+                             f"(default: {DEFAULT_BINS})")
+    parser.add_argument('--stats-only', action='store_true',
+                        help="Only write the stats file, not the bin FASTAs")
+    args = parser.parse_args()
+    bin_fasta(args.input, args.output_dir, args.bins, args.fai, args.stats_only)
+
+
+if __name__ == '__main__':
+    main()
+
+# python /lisc/project/dome/protein_embeddings/py_bash_scripts/bin_fasta_by_length.py -i /lisc/scratch/dome/pullen/GlobDB/linclust/clusters_more_than1.part_001.fasta -o /lisc/scratch/dome/pullen/GlobDB/linclust
@@ -1,3 +1,5 @@
+# plan_tasks.py replaces this step: it costs every sequence with the time model and packs
+# tasks of byte ranges straight from the .fai, without splitting the bins into files.
 # first go into the stats dir made from running part1chunking.sh
 # and check the stats txt files have the columns from seqkit stats:
 # particularly 1 is file, 4 is num_seqs, 7 is avg_len
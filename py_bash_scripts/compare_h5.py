@@ -1,3 +1,4 @@
+# Interactive comparison of two small per-key files; for whole stores use compare_stores.py
 import h5py
 import pandas as pd
 import numpy as np
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Compare two embedding stores key by key, e.g. CPU vs GPU runs, a storage profile vs
+float32, or a re-embedded part vs the master.
+
+Either file can be a per-key file or an embeddings/keys store (see embedding_store.py).
+The rows of --a are split into ranges that worker processes stream in blocks; each key
+is looked up in --b (through its key index for a store, built next to it on first use,
+or by name for a per-key file; the key stored at every row found through the index is
+read back, so a 64-bit hash collision, even between two similar proteins, is counted as
+missing rather than as a match) and per row we compute, vectorized over the block:
+  - cosine similarity
+  - mean squared error
+  - max absolute difference
+Only running sums, fixed-bin histograms and each worker's worst rows are sent back, so
+memory does not grow with the stores. Reports the key overlap, the mean/min/max of each
+metric, log-scale histograms and the worst --worst keys by cosine similarity.
+
+compare_h5.py loads both files into DataFrames and is only meant for small test files.
+"""
+import argparse
+import heapq
+import sys
+import time
+from multiprocessing import get_context
+
+import h5py
+import numpy as np
+
+from embedding_store import (EMB_CHUNK_ROWS, ChunkGather, fill_mismatched_rows, is_store_layout, per_key_format,
+                             per_key_names, read_embeddings, read_per_key_block)
+from export_memmap import count_rows
+from extract_embeddings_using_keys_txt_file import open_key_index
+from key_index import KeyIndex
+
+# Histogram edges. 1 - cosine, MSE and max |diff| span many orders of magnitude.
+HIST_EDGES = {
+    '1-cos': np.array([0] + [10.0 ** e for e in range(-8, 1)] + [np.inf]),
+    'mse': np.array([0] + [10.0 ** e for e in range(-10, 1)] + [np.inf]),
+    'max_abs': np.array([0] + [10.0 ** e for e in range(-6, 2)] + [np.inf]),
+}
+
+_worker = {}
+
+
+def log_histogram(values, edges):
+    """Counts of values in [edges[i], edges[i+1]); values below edges[0] go to the first bin."""
+    bins = np.clip(np.searchsorted(edges, values, side='right') - 1, 0, len(edges) - 2)
+    return np.bincount(bins, minlength=len(edges) - 1)
+
+
+def row_metrics(a, b):
+    """(cosine, mse, max_abs) of each pair of rows of two (n, width) arrays."""
+    a = a.astype(np.float64)
+    b = b.astype(np.float64)
+    diff = a - b
+    norms = np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+    dots = np.einsum('ij,ij->i', a, b)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cos = np.where(norms > 0, dots / norms, np.where(np.abs(diff).max(axis=1) == 0, 1.0, 0.0))
+    return cos, np.mean(diff ** 2, axis=1), np.abs(diff).max(axis=1)
+
+
+class _Side:
+    """One open input in a worker: its layout, and for per-key files the names and format."""
+
+    def __init__(self, path, names=None, key_index=None):
+        self.path = path
+        self.hf = h5py.File(path, 'r')
+        self.store = is_store_layout(self.hf)
+        self.names = names
+        self.key_index = key_index
+        self.width, self.dtype = (None, None) if self.store else per_key_format(self.hf, names)
+
+    def read_range(self, lo, hi):
+        """(keys, float32 embeddings) of the non-empty rows lo:hi."""
+        if self.store:
+            keys = self.hf['keys'].asstr()[lo:hi]
+            valid = np.flatnonzero(keys != '')
+            return list(keys[valid]), read_embeddings(self.hf, slice(lo, hi))[valid]
+        names = self.names[lo:hi]
+        emb, ok = read_per_key_block(self.hf, names, self.width, self.dtype)
+        if not ok.all():
+            fill_mismatched_rows(self.hf, names, emb, ok, self.width, on_mismatch='skip')
+        return [name.decode('utf-8') for name, good in zip(names, ok) if good], emb[ok]
+
+    def lookup(self, keys):
+        """
+        (positions in keys found here, their float32 embeddings, number of key-index hits
+        whose stored key differs, i.e. hash collisions, which are left out).
+        """
+        if self.store:
+            rows = self.key_index.lookup(keys)
+            hits = np.flatnonzero(rows >= 0)
+            if not len(hits):
+                return hits, None, 0
+            unique_rows, inverse = np.unique(rows[hits], return_inverse=True)
+            stored = self.hf['keys'].asstr()[unique_rows][inverse]
+            same = stored == np.array([keys[i] for i in hits], dtype=object)
+            emb = ChunkGather(self.hf).gather(unique_rows)[inverse]
+            return hits[same], emb[same], int(len(hits) - np.count_nonzero(same))
+        names = [k.encode('utf-8') for k in keys]
+        present = np.flatnonzero([name in self.hf.id for name in names])
+        if not len(present):
+            return present, None, 0
+        names = [names[i] for i in present]
+        emb, ok = read_per_key_block(self.hf, names, self.width, self.dtype)
+        if not ok.all():
+            fill_mismatched_rows(self.hf, names, emb, ok, self.width, on_mismatch='skip')
+        return present[ok], emb[ok], 0
+
+
+def _init_worker(path_a, path_b, names_a, names_b, index_prefix_b):
+    key_index = KeyIndex(index_prefix_b) if index_prefix_b is not None else None
+    _worker['a'] = _Side(path_a, names_a)
+    _worker['b'] = _Side(path_b, names_b, key_index)
+
+
+def _empty_partial():
+    partial = {'n_a': 0, 'n_matched': 0, 'n_collisions': 0, 'worst': []}
+    for name, edges in HIST_EDGES.items():
+        partial[name] = {'hist': np.zeros(len(edges) - 1, dtype=np.int64), 'sum': 0.0,
+                         'min': np.inf, 'max': -np.inf}
+    return partial
+
+
+def compare_range(lo, hi, block_rows, n_worst):
+    """Partial results for the rows lo:hi of --a (run in a worker)."""
+    side_a, side_b = _worker['a'], _worker['b']
+    partial = _empty_partial()
+    for start in range(lo, hi, block_rows):
+        keys, emb_a = side_a.read_range(start, min(start + block_rows, hi))
+        partial['n_a'] += len(keys)
+        if not keys:
+            continue
+        hits, emb_b, n_collisions = side_b.lookup(keys)
+        partial['n_collisions'] += n_collisions
+        if not len(hits):
+            continue
+        cos, mse, max_abs = row_metrics(emb_a[hits], emb_b)
+        partial['n_matched'] += len(hits)
+        for name, values in (('1-cos', 1 - cos), ('mse', mse), ('max_abs', max_abs)):
+            stats = partial[name]
+            stats['hist'] += log_histogram(values, HIST_EDGES[name])
+            stats['sum'] += float(values.sum())
+            stats['min'] = min(stats['min'], float(values.min()))
+            stats['max'] = max(stats['max'], float(values.max()))
+        worst = np.argsort(cos, kind='stable')[:n_worst]
+        partial['worst'] = heapq.nsmallest(
+            n_worst, partial['worst'] + [(float(cos[i]), keys[hits[i]], float(mse[i]), float(max_abs[i]))
+                                         for i in worst])
+    return partial
+
+
+def _compare_task(args):
+    return compare_range(*args)
+
+
+def merge_partials(partials, n_worst):
+    total = _empty_partial()
+    for partial in partials:
+        total['n_a'] += partial['n_a']
+        total['n_matched'] += partial['n_matched']
+        total['n_collisions'] += partial['n_collisions']
+        for name in HIST_EDGES:
+            stats, part = total[name], partial[name]
+            stats['hist'] += part['hist']
+            stats['sum'] += part['sum']
+            stats['min'] = min(stats['min'], part['min'])
+            stats['max'] = max(stats['max'], part['max'])
+        total['worst'] = heapq.nsmallest(n_worst, total['worst'] + partial['worst'])
+    return total
+
+
+def compare_stores(path_a, path_b, workers=1, task_rows=EMB_CHUNK_ROWS * 10, block_rows=EMB_CHUNK_ROWS,
+                   n_worst=20, index_prefix_b=None):
+    """Compare the embeddings of the keys of path_a with the same keys in path_b. Returns the merged results."""
+    start_time = time.time()
+    names, n_rows = {}, {}
+    for side, path in (('a', path_a), ('b', path_b)):
+        with h5py.File(path, 'r') as hf:
+            names[side] = None if is_store_layout(hf) else per_key_names(hf)
+            n_rows[side] = hf['keys'].shape[0] if names[side] is None else len(names[side])
+    if names['b'] is None:
+        index_prefix_b = open_key_index(path_b, index_prefix_b).prefix
+    else:
+        index_prefix_b = None
+
+    init_args = (path_a, path_b, names['a'], names['b'], index_prefix_b)
+    n_rows_a = n_rows['a']
+    tasks = [(lo, min(lo + task_rows, n_rows_a), block_rows, n_worst) for lo in range(0, n_rows_a, task_rows)]
+    print(f"Comparing {n_rows_a} rows of {path_a} against {path_b} in {len(tasks)} tasks on {workers} workers")
+    sys.stdout.flush()
+
+    partials = []
+    if workers <= 1:
+        _init_worker(*init_args)
+        results = map(_compare_task, tasks)
+    else:
+        pool = get_context('fork').Pool(workers, initializer=_init_worker, initargs=init_args)
+        results = pool.imap_unordered(_compare_task, tasks)
+    for done, partial in enumerate(results, 1):
+        partials.append(partial)
+        if done % max(1, len(tasks) // 20) == 0 or done == len(tasks):
+            rows = sum(p['n_a'] for p in partials)
+            print(f"  {done}/{len(tasks)} tasks, {rows} keys ({rows / (time.time() - start_time):.0f} keys/s)")
+            sys.stdout.flush()
+    if workers > 1:
+        pool.close()
+        pool.join()
+
+    result = merge_partials(partials, n_worst)
+    result['n_b'] = count_rows(path_b)[0]
+    result['elapsed'] = time.time() - start_time
+    return result
+
+
+def print_report(result, path_a, path_b):
+    n_matched = result['n_matched']
+    print(f"\nKeys in A ({path_a}): {result['n_a']}")
+    print(f"Keys in B ({path_b}): {result['n_b']}")
+    print(f"Compared: {n_matched}, only in A: {result['n_a'] - n_matched}, "
+          f"only in B: {max(0, result['n_b'] - n_matched)}" + (" (A repeats keys)" if n_matched > result['n_b'] else ""))
+    if result['n_collisions']:
+        print(f"Key index collisions treated as missing: {result['n_collisions']}")
+    print(f"Time: {result['elapsed']:.1f}[s]")
+    if not n_matched:
+        return
+
+    print(f"\n{'metric':10s} {'mean':>12s} {'min':>12s} {'max':>12s}")
+    for name in HIST_EDGES:
+        stats = result[name]
+        print(f"{name:10s} {stats['sum'] / n_matched:12.4g} {stats['min']:12.4g} {stats['max']:12.4g}")
+
+    for name, edges in HIST_EDGES.items():
+        hist = result[name]['hist']
+        print(f"\nHistogram of {name}:")
+        for lo, hi, count in zip(edges[:-1], edges[1:], hist):
+            bar = '#' * int(round(50 * count / max(1, hist.max())))
+            print(f"  [{lo:8.0e}, {hi:8.0e})  {count:12d}  {bar}")
+
+    print(f"\nWorst {len(result['worst'])} keys by cosine similarity:")
+    print(f"  {'key':40s} {'cosine':>12s} {'mse':>12s} {'max |diff|':>12s}")
+    for cos, key, mse, max_abs in result['worst']:
+        print(f"  {key:40s} {cos:12.8f} {mse:12.4g} {max_abs:12.4g}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two embedding stores (per-key or embeddings/keys "
+                                                 "layout) key by key: cosine similarity, MSE and max abs diff.",
+                                     allow_abbrev=False)
+    parser.add_argument('--a', type=str, required=True,
+                        help="First HDF5 file; its keys are the ones compared")
+    parser.add_argument('--b', type=str, required=True,
+                        help="Second HDF5 file")
+    parser.add_argument('--index-prefix-b', type=str, default=None,
+                        help="Key index of --b if it is a store (default: <b>.keyidx; built if missing)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Worker processes (default: 1)")
+    parser.add_argument('--task-rows', type=int, default=EMB_CHUNK_ROWS * 10,
+                        help="Rows of --a per task (default: 100000)")
+    parser.add_argument('--block-rows', type=int, default=EMB_CHUNK_ROWS,
+                        help=f"Rows read and compared at a time within a task (default: {EMB_CHUNK_ROWS})")
+    parser.add_argument('--worst', type=int, default=20,
+                        help="Number of worst keys to list (default: 20)")
+    args = parser.parse_args()
+
+    result = compare_stores(args.a, args.b, args.workers, args.task_rows, args.block_rows, args.worst,
+                            args.index_prefix_b)
+    print_report(result, args.a, args.b)
+
+
+if __name__ == '__main__':
+    main()
+
+# python /lisc/project/dome/protein_embeddings/py_bash_scripts/compare_stores.py --a /lisc/scratch/dome/pullen/GlobDB/embeddings/4448170_node-a06_CPU.h5 --b /lisc/scratch/dome/pullen/GlobDB/embeddings/4448208_node-d01_GPU.h5 --workers 8
@@ -0,0 +1,447 @@
+#!/usr/bin/env python3
+"""
+The two-dataset embedding store layout written by merge_h5_inter_to_big.py and
+merge_h5_big_to_final.py:
+  - 'embeddings': float32, shape (N, 1024), chunked and resizable along the rows
+  - 'keys':       variable-length UTF-8 strings, shape (N,), row i is the ID of embeddings[i]
+
+The embeddings can also be stored with a storage profile (see parse_storage_profile):
+float16, or int8 with a per-row float32 scale in a third dataset 'scales', each with
+optional shuffle and gzip/lzf compression of the chunks. The profile name is kept in the
+'storage_profile' attribute of 'embeddings', and read_embeddings() always gives back
+float32, so readers do not need to know which profile a store uses.
+
+Empty keys mark rows that were allocated but never filled in, and are skipped by
+the readers (read_processed_ids) and by merge_h5_big_to_final.py.
+
+The per-task files written by prott5_embedder_globdb.py (default --output_format per_key)
+instead hold one dataset per key. iter_embedding_blocks() reads either layout.
+"""
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
+import numpy as np
+
+EMB_CHUNK_ROWS = 10000
+KEYS_CHUNK_ROWS = 1_000_000
+
+STORAGE_PRECISIONS = ('float32', 'float16', 'int8')
+STORAGE_FILTERS = ('shuffle', 'gzip', 'lzf')
+DEFAULT_PROFILE = 'float32'
+
+
+def parse_storage_profile(profile):
+    """
+    A storage profile is a precision followed by optional filters, joined with '-',
+    e.g. 'float32' (the default, uncompressed), 'float16-shuffle-gzip' or 'int8-lzf'.
+    Returns the h5py create_dataset arguments for 'embeddings' plus the precision.
+    """
+    precision, *filters = profile.split('-')
+    if precision not in STORAGE_PRECISIONS or not set(filters) <= set(STORAGE_FILTERS):
+        raise ValueError(f"Unknown storage profile {profile!r}: expected one of {STORAGE_PRECISIONS} "
+                         f"followed by any of {STORAGE_FILTERS}, joined with '-'")
+    if 'gzip' in filters and 'lzf' in filters:
+        raise ValueError(f"Storage profile {profile!r} can use gzip or lzf, not both")
+    compression = 'gzip' if 'gzip' in filters else 'lzf' if 'lzf' in filters else None
+    return {
+        'precision': precision,
+        'dtype': precision,
+        'compression': compression,
+        'compression_opts': 4 if compression == 'gzip' else None,
+        'shuffle': 'shuffle' in filters,
+    }
+
+
+def store_profile(hf):
+    """Storage profile of an open store (stores written before profiles existed are float32)."""
+    return hf['embeddings'].attrs.get('storage_profile', DEFAULT_PROFILE)
+
+
+def create_store_datasets(hf, n_cols, emb_chunk_rows=EMB_CHUNK_ROWS, keys_chunk_rows=KEYS_CHUNK_ROWS,
+                          profile=DEFAULT_PROFILE):
+    """Create empty, resizable 'embeddings' and 'keys' (and, for int8, 'scales') datasets in an open h5py.File."""
+    opts = parse_storage_profile(profile)
+    emb_ds = hf.create_dataset(
+        'embeddings', shape=(0, n_cols), maxshape=(None, n_cols),
+        dtype=opts['dtype'], chunks=(emb_chunk_rows, n_cols),
+        compression=opts['compression'], compression_opts=opts['compression_opts'], shuffle=opts['shuffle']
+    )
+    emb_ds.attrs['storage_profile'] = profile
+    if opts['precision'] == 'int8':
+        hf.create_dataset(
+            'scales', shape=(0,), maxshape=(None,), dtype='float32', chunks=(emb_chunk_rows,),
+            compression=opts['compression'], compression_opts=opts['compression_opts']
+        )
+    dt = h5py.string_dtype(encoding='utf-8')
+    keys_ds = hf.create_dataset(
+        'keys', shape=(0,), maxshape=(None,), dtype=dt, chunks=(keys_chunk_rows,)
+    )
+    return emb_ds, keys_ds
+
+
+def quantize_rows(emb_block):
+    """Symmetric int8 quantization with one scale per row: row ~= q * scale."""
+    emb_block = np.asarray(emb_block, dtype=np.float32)
+    scales = np.abs(emb_block).max(axis=1) / 127
+    safe = np.where(scales > 0, scales, 1)
+    q = np.clip(np.rint(emb_block / safe[:, None]), -127, 127).astype(np.int8)
+    return q, scales.astype(np.float32)
+
+
+def read_embeddings(hf, sel=slice(None)):
+    """Rows `sel` (a slice, an index or increasing indices) of 'embeddings' as float32, whatever the profile."""
+    emb = hf['embeddings'][sel]
+    if 'scales' in hf:
+        scales = hf['scales'][sel]
+        return emb.astype(np.float32) * np.asarray(scales, dtype=np.float32)[..., None]
+    return emb.astype(np.float32, copy=False)
+
+
+class ChunkGather:
+    """
+    Batch gather of rows of 'embeddings' (as float32, whatever the profile) that reads
+    every storage chunk at most once per call, instead of one random read per row.
+
+    Requested rows are sorted and grouped by chunk, and each group is served by one read
+    of the chunk (or, without a cache, of just the span of rows it needs), so a compressed
+    chunk is decompressed once rather than once per row. Results come back in query order.
+
+    With threads > 1 the chunks are read on a thread pool. All HDF5 calls are serialised
+    by h5py, so for shuffle/gzip chunks we fetch the raw chunk with read_direct_chunk and
+    inflate, unshuffle and decode it ourselves, outside the lock. Uncompressed chunks
+    (read span by span) and other filters (e.g. lzf) go through h5py and gain little
+    from threads.
+    With cache_mb > 0, whole decoded chunks are kept in an LRU cache of that size, which
+    pays off when many calls touch the same chunks.
+    """
+
+    def __init__(self, hf, threads=1, cache_mb=0):
+        self.emb_ds = hf['embeddings']
+        self.scales_ds = hf['scales'] if 'scales' in hf else None
+        self.n_rows, self.width = self.emb_ds.shape
+        self.chunk_rows = self.emb_ds.chunks[0] if self.emb_ds.chunks else EMB_CHUNK_ROWS
+        self.threads = threads
+        self._filters = self._direct_filters()
+        chunk_bytes = self.chunk_rows * self.width * 4
+        self._cache_chunks = int(cache_mb * 1024 ** 2 // chunk_bytes)
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.chunks_read = 0
+        self.cache_hits = 0
+
+    def _direct_filters(self):
+        """Filter codes of the chunks if we can decode them ourselves, else None."""
+        ds = self.emb_ds
+        if ds.chunks is None or ds.chunks[1] != self.width:
+            return None
+        plist = ds.id.get_create_plist()
+        filters = [plist.get_filter(i)[0] for i in range(plist.get_nfilters())]
+        # without filters, h5py reads just the rows asked for, which beats a whole chunk
+        if not filters or not set(filters) <= {h5py.h5z.FILTER_DEFLATE, h5py.h5z.FILTER_SHUFFLE}:
+            return None
+        return filters
+
+    def _read_direct(self, c):
+        """Decode chunk c from its raw bytes; the inflate runs without holding the GIL or h5py's lock."""
+        try:
+            filter_mask, data = self.emb_ds.id.read_direct_chunk((c * self.chunk_rows, 0))
+        except (KeyError, RuntimeError, ValueError):
+            # chunk never written: let HDF5 apply the fill value
+            return None
+        itemsize = self.emb_ds.dtype.itemsize
+        for i in reversed(range(len(self._filters))):
+            if filter_mask & (1 << i):
+                continue
+            if self._filters[i] == h5py.h5z.FILTER_DEFLATE:
+                data = zlib.decompress(data)
+            else:
+                data = np.frombuffer(data, dtype=np.uint8).reshape(itemsize, -1).T.tobytes()
+        chunk = np.frombuffer(data, dtype=self.emb_ds.dtype).reshape(self.chunk_rows, self.width)
+        return chunk[:min(self.chunk_rows, self.n_rows - c * self.chunk_rows)]
+
+    def _read(self, lo, hi, c=None):
+        """Rows lo:hi as float32, straight from chunk c when we can decode it ourselves."""
+        block = self._read_direct(c) if c is not None and self._filters is not None else None
+        if block is None:
+            block = self.emb_ds[lo:hi]
+        else:
+            block = block[lo - c * self.chunk_rows:hi - c * self.chunk_rows]
+        if self.scales_ds is not None:
+            return block.astype(np.float32) * self.scales_ds[lo:hi][:, None]
+        return block.astype(np.float32, copy=False)
+
+    def _chunk_rows(self, c, lo, hi):
+        """(block, first row of block) covering rows lo..hi of chunk c."""
+        start = c * self.chunk_rows
+        end = min(start + self.chunk_rows, self.n_rows)
+        if self._cache_chunks:
+            with self._cache_lock:
+                block = self._cache.get(c)
+                if block is not None:
+                    self._cache.move_to_end(c)
+                    self.cache_hits += 1
+                    return block, start
+        # a whole chunk for the cache or when it has to be decompressed anyway, else just the span
+        if self._cache_chunks or self._filters is not None:
+            block, first = self._read(start, end, c), start
+        else:
+            block, first = self._read(lo, hi + 1), lo
+        with self._cache_lock:
+            self.chunks_read += 1
+            if self._cache_chunks:
+                self._cache[c] = block
+                while len(self._cache) > self._cache_chunks:
+                    self._cache.popitem(last=False)
+        return block, first
+
+    def gather(self, rows):
+        """float32 array (len(rows), width) with the embeddings of rows, in the given order."""
+        rows = np.asarray(rows, dtype=np.int64)
+        out = np.empty((len(rows), self.width), dtype=np.float32)
+        if not len(rows):
+            return out
+        if rows.min() < 0 or rows.max() >= self.n_rows:
+            raise IndexError(f"Rows out of range for {self.n_rows} embeddings")
+        order = np.argsort(rows, kind='stable')
+        sorted_rows = rows[order]
+        chunk_ids = sorted_rows // self.chunk_rows
+        groups = np.split(np.arange(len(rows)), np.flatnonzero(np.diff(chunk_ids)) + 1)
+
+        def fill(group):
+            block, first = self._chunk_rows(int(chunk_ids[group[0]]), int(sorted_rows[group[0]]),
+                                            int(sorted_rows[group[-1]]))
+            out[order[group]] = block[sorted_rows[group] - first]
+
+        if self.threads > 1 and len(groups) > 1:
+            with ThreadPoolExecutor(max_workers=self.threads) as pool:
+                list(pool.map(fill, groups))
+        else:
+            for group in groups:
+                fill(group)
+        return out
+
+
+def resize_store(emb_ds, keys_ds, n_rows):
+    """Resize the embeddings, scales (int8) and keys datasets to n_rows."""
+    emb_ds.resize((n_rows, emb_ds.shape[1]))
+    if emb_ds.dtype == np.int8:
+        emb_ds.parent['scales'].resize((n_rows,))
+    keys_ds.resize((n_rows,))
+
+
+def write_rows(emb_ds, keys_ds, start, emb_block, keys_block):
+    """
+    Write a block at rows start:start + len(keys_block) of datasets already large enough,
+    encoded for the store's profile. The keys are written last.
+    """
+    end = start + len(keys_block)
+    if emb_ds.dtype == np.int8:
+        emb_block, scales = quantize_rows(emb_block)
+        emb_ds.parent['scales'][start:end] = scales
+    emb_ds[start:end, :] = emb_block
+    keys_ds[start:end] = keys_block
+    return end
+
+
+def append_rows(emb_ds, keys_ds, emb_block, keys_block):
+    """
+    Append a block to the end of the datasets, encoded for the store's profile. All are
+    resized first and the keys are written last, so a crash in between only leaves
+    empty keys behind. Returns the new number of rows.
+    """
+    start = emb_ds.shape[0]
+    resize_store(emb_ds, keys_ds, start + len(keys_block))
+    return write_rows(emb_ds, keys_ds, start, emb_block, keys_block)
+
+
+def is_store_layout(hf):
+    """True for the embeddings/keys layout, False for one dataset per key."""
+    return isinstance(hf.get('embeddings'), h5py.Dataset) and isinstance(hf.get('keys'), h5py.Dataset)
+
+
+def per_key_names(hf):
+    """Names (bytes) of the top-level links of a per-key file, listed with the low-level API."""
+    return list(hf.id)
+
+
+def per_key_format(hf, names):
+    """
+    (width, dtype) of the first dataset among names, which must be a 1-d (or squeezable)
+    vector, or (None, None) if there is no dataset.
+    """
+    for name in names:
+        try:
+            dsid = h5py.h5d.open(hf.id, name)
+        except KeyError:
+            continue
+        if sum(d != 1 for d in dsid.shape) > 1:
+            raise ValueError(f"{name.decode('utf-8')} in {hf.filename} has shape {dsid.shape}, "
+                             f"expected one vector per key (per-protein embeddings)")
+        return int(np.prod(dsid.shape)), dsid.dtype
+    return None, None
+
+
+def read_per_key_block(hf, names, width, dtype=None, out=None):
+    """
+    Bulk read of the datasets `names` (bytes) of an open per-key file into the rows of a
+    preallocated float32 block, avoiding the Dataset objects and selections that make
+    `f[key][:]` slow for millions of small datasets.
+
+    Datasets are opened with the low-level API only to get their file offset and storage
+    size. Those stored contiguously and unfiltered as `width` values of `dtype` in native
+    byte order (as the embedder writes them) are then copied from a memmap of the file in offset order, so
+    the reads are sequential. Any other dataset of shape (width,) gets one H5Dread
+    straight into its row. Returns (block, ok): ok[i] is False where names[i] is not a
+    dataset of shape (width,), and that row is left unset for fill_mismatched_rows().
+    """
+    if out is None:
+        out = np.empty((len(names), width), dtype=np.float32)
+    ok = np.ones(len(names), dtype=bool)
+    raw_dtype = np.dtype(dtype) if dtype is not None else None
+    raw_nbytes = width * raw_dtype.itemsize if raw_dtype is not None else -1
+    raw_rows, raw_offsets = [], []
+    for i, name in enumerate(names):
+        try:
+            dsid = h5py.h5d.open(hf.id, name)
+        except KeyError:
+            ok[i] = False
+            continue
+        offset = dsid.get_offset()
+        # the bytes on disk are only taken as is for exactly `width` native values of `dtype`
+        if (offset is not None and raw_dtype is not None and dsid.dtype == raw_dtype and dsid.dtype.isnative
+                and tuple(d for d in dsid.shape if d != 1) == (width,)
+                and dsid.get_storage_size() == raw_nbytes):
+            raw_rows.append(i)
+            raw_offsets.append(offset)
+        elif dsid.shape == (width,):
+            dsid.read(h5py.h5s.ALL, h5py.h5s.ALL, out[i])
+        else:
+            ok[i] = False
+    if raw_rows:
+        mm = np.memmap(hf.filename, dtype=np.uint8, mode='r')
+        for j in np.argsort(raw_offsets):
+            offset = raw_offsets[j]
+            out[raw_rows[j]] = mm[offset:offset + raw_nbytes].view(dtype)
+        del mm
+    return out, ok
+
+
+def fill_mismatched_rows(hf, names, block, ok, width, on_mismatch='raise'):
+    """
+    Fallback for the rows read_per_key_block() could not read: datasets holding `width`
+    values in another shape (e.g. (1, 1024)) are read with the high-level API and
+    flattened; anything else raises a ValueError, or is skipped with a warning if
+    on_mismatch='skip'. Updates ok in place and returns it.
+    """
+    for i in np.flatnonzero(~ok):
+        key = names[i].decode('utf-8')
+        obj = hf.get(key)
+        if isinstance(obj, h5py.Dataset) and obj.size == width:
+            block[i] = obj[()].reshape(-1)
+            ok[i] = True
+            continue
+        shape = obj.shape if isinstance(obj, h5py.Dataset) else type(obj).__name__
+        if on_mismatch == 'raise':
+            raise ValueError(f"Unexpected shape for key {key} in file {hf.filename}: {shape}")
+        print(f"Skipping key {key} in file {hf.filename}: unexpected shape {shape}")
+    return ok
+
+
+def iter_per_key_blocks(hf, block_rows=EMB_CHUNK_ROWS, on_mismatch='raise'):
+    """Stream (keys, embeddings) blocks from an open per-key file with read_per_key_block()."""
+    names = per_key_names(hf)
+    width, dtype = per_key_format(hf, names)
+    if width is None:
+        return
+    for start in range(0, len(names), block_rows):
+        block_names = names[start:start + block_rows]
+        emb_block, ok = read_per_key_block(hf, block_names, width, dtype)
+        if not ok.all():
+            fill_mismatched_rows(hf, block_names, emb_block, ok, width, on_mismatch)
+            block_names = [name for name, good in zip(block_names, ok) if good]
+            emb_block = emb_block[ok]
+        yield [name.decode('utf-8') for name in block_names], emb_block
+
+
+def iter_embedding_blocks(path, block_rows=EMB_CHUNK_ROWS):
+    """
+    Stream (keys, embeddings) blocks of at most block_rows rows from an HDF5 file in
+    either layout, as a list of str and a float32 (n, width) array. Empty keys are dropped.
+    Only one block is held in memory at a time.
+    """
+    with h5py.File(path, 'r') as hf:
+        if not is_store_layout(hf):
+            yield from iter_per_key_blocks(hf, block_rows)
+            return
+        emb_ds, keys_ds = hf['embeddings'], hf['keys']
+        for start in range(0, emb_ds.shape[0], block_rows):
+            end = min(start + block_rows, emb_ds.shape[0])
+            keys_block = keys_ds.asstr()[start:end]
+            valid = np.flatnonzero(keys_block != '')
+            if len(valid):
+                emb_block = read_embeddings(hf, slice(start, end))
+                yield list(keys_block[valid]), emb_block[valid]
+
+
+class EmbeddingStoreWriter:
+    """
+    Buffered, append-only writer for the embeddings/keys layout.
+
+    Rows are collected in memory and appended in blocks of `flush_rows`. The file is
+    only open while a block is written, so a job killed at its time limit leaves every
+    earlier block intact on disk. An existing store at `path` is appended to.
+    """
+
+    def __init__(self, path, flush_rows=EMB_CHUNK_ROWS, emb_chunk_rows=EMB_CHUNK_ROWS, profile=DEFAULT_PROFILE):
+        self.path = str(path)
+        self.flush_rows = flush_rows
+        self.emb_chunk_rows = emb_chunk_rows
+        self.profile = profile
+        self.rows_written = 0
+        self._keys = []
+        self._embs = []
+
+    def write(self, keys, embeddings):
+        """Buffer one embedding per key, flushing whenever a full block is available."""
+        for key, emb in zip(keys, embeddings):
+            self._keys.append(key)
+            self._embs.append(np.asarray(emb, dtype=np.float32).reshape(-1))
+        if len(self._keys) >= self.flush_rows:
+            self.flush()
+
+    def write_duplicates(self, keys, rep_keys, embeddings):
+        """Rows of a contiguous store cannot be shared, so duplicates are stored as copies."""
+        self.write(keys, embeddings)
+
+    def flush(self):
+        if not self._keys:
+            return
+        emb_block = np.stack(self._embs)
+        keys_block = np.array(self._keys, dtype=object)
+        mode = 'a' if os.path.exists(self.path) else 'w'
+        with h5py.File(self.path, mode) as hf:
+            if 'embeddings' in hf:
+                emb_ds, keys_ds = hf['embeddings'], hf['keys']
+                if emb_ds.shape[1] != emb_block.shape[1]:
+                    raise ValueError(f"Cannot append {emb_block.shape[1]}-d embeddings to {self.path} "
+                                     f"which holds {emb_ds.shape[1]}-d embeddings")
+            else:
+                emb_ds, keys_ds = create_store_datasets(hf, emb_block.shape[1], self.emb_chunk_rows,
+                                                        profile=self.profile)
+            append_rows(emb_ds, keys_ds, emb_block, keys_block)
+        self.rows_written += len(self._keys)
+        self._keys = []
+        self._embs = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
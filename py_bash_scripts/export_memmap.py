@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Export an embedding store as a raw, memory-mappable matrix for downstream analytics.
+
+Full scans of the HDF5 store pay for h5py calls, decompression and a copy into NumPy for
+every block. The export writes, for --prefix GlobDB40:
+  GlobDB40.embeddings.npy      contiguous little-endian float32 (or float16) matrix, N x 1024
+  GlobDB40.keys.txt            one key per line, line i is the ID of row i
+  GlobDB40.keyidx.*            key -> row index (see key_index.py) for lookups by ID
+  GlobDB40.json                metadata: rows, width, dtype, source; written last
+
+load_memmap() then gives a read-only np.memmap over the .npy: slicing rows copies
+nothing, and processes that map the same file share its pages through the page cache.
+
+Example:
+    emb = load_memmap("GlobDB40")
+    block = emb.embeddings[1_000_000:1_010_000]          # no copy, no HDF5
+    rows = emb.rows_of(["BCRBG_15609___2917"])           # -1 if absent
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import h5py
+import numpy as np
+
+from embedding_store import EMB_CHUNK_ROWS, is_store_layout, iter_embedding_blocks
+from key_index import KeyIndex, hash_keys, sort_unique_hashes, write_key_index
+from sharded_store import ShardedStore
+
+EXPORT_DTYPES = {'float32': '<f4', 'float16': '<f2'}
+
+
+def export_paths(prefix):
+    prefix = str(prefix)
+    return {
+        'embeddings': f"{prefix}.embeddings.npy",
+        'keys': f"{prefix}.keys.txt",
+        'keyidx': f"{prefix}.keyidx",
+        'meta': f"{prefix}.json",
+    }
+
+
+def count_rows(input_path, block_size=10_000_000):
+    """(rows with a non-empty key, width) of a store, a per-key file or a sharded store manifest."""
+    if input_path.endswith('.json'):
+        store = ShardedStore(input_path)
+        return len(store), store.manifest['width']
+    with h5py.File(input_path, 'r') as hf:
+        if not is_store_layout(hf):
+            first = next(iter(hf.values()), None)
+            return len(hf), (first.size if first is not None else 0)
+        keys_ds = hf['keys']
+        n_rows = 0
+        for start in range(0, keys_ds.shape[0], block_size):
+            n_rows += int(np.count_nonzero(keys_ds.asstr()[start:start + block_size] != ''))
+        return n_rows, hf['embeddings'].shape[1]
+
+
+def iter_input_blocks(input_path, block_rows):
+    if input_path.endswith('.json'):
+        return ShardedStore(input_path).iter_blocks(block_rows)
+    return iter_embedding_blocks(input_path, block_rows)
+
+
+def export_memmap(input_path, prefix, dtype='float32', block_rows=EMB_CHUNK_ROWS * 10):
+    """Write the export files for input_path at prefix. Returns the number of rows."""
+    paths = export_paths(prefix)
+    start_time = time.time()
+    n_rows, width = count_rows(input_path)
+    print(f"Exporting {n_rows} x {width} embeddings from {input_path} as {dtype} to {paths['embeddings']}")
+    sys.stdout.flush()
+
+    tmp_emb = f"{paths['embeddings']}.tmp{os.getpid()}"
+    tmp_keys = f"{paths['keys']}.tmp{os.getpid()}"
+    out = np.lib.format.open_memmap(tmp_emb, mode='w+', dtype=EXPORT_DTYPES[dtype], shape=(n_rows, width))
+    hash_parts, row_parts = [], []
+    pos = 0
+    with open(tmp_keys, 'w', encoding='utf-8') as keys_out:
+        for keys_block, emb_block in iter_input_blocks(input_path, block_rows):
+            n = len(keys_block)
+            if pos + n > n_rows:
+                raise ValueError(f"{input_path} has more rows than counted ({n_rows}); was it modified?")
+            out[pos:pos + n] = emb_block
+            keys_out.write(''.join(k + '\n' for k in keys_block))
+            hash_parts.append(hash_keys(keys_block))
+            row_parts.append(np.arange(pos, pos + n, dtype=np.int64))
+            pos += n
+            elapsed = time.time() - start_time
+            print(f"  Exported rows {pos} / {n_rows} ({pos * width * 4 / max(elapsed, 1e-9) / 1024 ** 2:.1f} MB/s)")
+            sys.stdout.flush()
+    if pos != n_rows:
+        raise ValueError(f"Exported {pos} rows from {input_path} but counted {n_rows}; was it modified?")
+    out.flush()
+    del out
+    os.replace(tmp_emb, paths['embeddings'])
+    os.replace(tmp_keys, paths['keys'])
+
+    hashes, rows = sort_unique_hashes(hash_parts, row_parts)
+    write_key_index(paths['keyidx'], hashes, rows, paths['embeddings'])
+
+    meta = {
+        'source': os.path.abspath(input_path),
+        'rows': n_rows,
+        'width': width,
+        'dtype': dtype,
+        'embeddings': os.path.basename(paths['embeddings']),
+        'keys': os.path.basename(paths['keys']),
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    tmp_meta = f"{paths['meta']}.tmp{os.getpid()}"
+    with open(tmp_meta, 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_meta, paths['meta'])
+    print(f"Finished exporting {n_rows} rows in {time.time() - start_time:.1f}[s]")
+    return n_rows
+
+
+class MemmapEmbeddings:
+    """A finished export: .embeddings is a read-only np.memmap, keys and index are opened on demand."""
+
+    def __init__(self, prefix):
+        self.paths = export_paths(prefix)
+        with open(self.paths['meta'], 'r') as f:
+            self.meta = json.load(f)
+        self.embeddings = np.load(self.paths['embeddings'], mmap_mode='r')
+        self._keys = None
+        self._key_index = None
+
+    def __len__(self) -> int:
+        return self.embeddings.shape[0]
+
+    @property
+    def keys(self):
+        """All keys, in row order (read from the sidecar on first use)."""
+        if self._keys is None:
+            with open(self.paths['keys'], 'r', encoding='utf-8') as f:
+                self._keys = [line.rstrip('\n') for line in f]
+        return self._keys
+
+    def rows_of(self, keys) -> np.ndarray:
+        """int64 row of each key, -1 where absent."""
+        if self._key_index is None:
+            self._key_index = KeyIndex(self.paths['keyidx'])
+        return self._key_index.lookup(keys)
+
+
+def load_memmap(prefix):
+    """Open an export written by export_memmap (see MemmapEmbeddings)."""
+    return MemmapEmbeddings(prefix)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export an embedding store as a raw .npy matrix with a keys "
+                                                 "sidecar, for zero-copy np.memmap access.")
+    parser.add_argument('--input', type=str, required=True,
+                        help="Embeddings/keys store, per-key file, or sharded store manifest (.json)")
+    parser.add_argument('--prefix', type=str, required=True,
+                        help="Output prefix, e.g. /path/GlobDB40 gives GlobDB40.embeddings.npy, "
+                             "GlobDB40.keys.txt, GlobDB40.keyidx.* and GlobDB40.json")
+    parser.add_argument('--dtype', type=str, choices=sorted(EXPORT_DTYPES), default='float32',
+                        help="Element type of the exported matrix (default: float32)")
+    parser.add_argument('--block-rows', type=int, default=EMB_CHUNK_ROWS * 10,
+                        help="Rows to copy at a time (default: 100000)")
+    args = parser.parse_args()
+    export_memmap(args.input, args.prefix, args.dtype, args.block_rows)
+
+
+if __name__ == '__main__':
+    main()
+
+# python /lisc/project/dome/protein_embeddings/py_bash_scripts/export_memmap.py --input /lisc/project/dome/protein_embeddings/GlobDB/embeddings/chlor_plus_part001and002.h5 --prefix /lisc/scratch/dome/pullen/GlobDB/embeddings/GlobDB40 --dtype float16
@@ -1,82 +1,97 @@
-import subprocess
+import os
+import warnings
 import h5py
 import numpy as np
 
-def build_inmemory_index(keys_txt_path: str):
-    """
-    One-time build: reads keys_txt_path line by line into a dict.
-    Returns { key_str: line_number_zero_based }.
-    Takes around 1 minute to build.
-    """
-    idx_map = {}
-    with open(keys_txt_path, 'r', encoding='utf-8') as f:
-        for i, line in enumerate(f):
-            key = line.rstrip('\n')
-            idx_map[key] = i
-    return idx_map
+from embedding_store import ChunkGather
+from key_index import KeyIndex, build_key_index, index_paths
 
-def _grep_index(keys_txt_path: str, query_id: str):
+def open_key_index(h5_path: str, index_prefix: str = None):
     """
-    Returns the zero-based line index of query_id in keys_txt_path,
-    or raises KeyError if not found.
-    grep -n returns format like 123456:ID_QUERY
+    Returns the KeyIndex of h5_path (see key_index.py), which maps each key to its row
+    with a binary search over memory-mapped sorted hashes.
+    If there is no index at index_prefix (default: <h5_path>.keyidx) it is built once,
+    which takes about as long as dumping the keys with save_keys_order.py.
     """
-    # -x : exact match, -n : prefix each line with its 1-based line number
-    proc = subprocess.run(
-        ['grep', '-nx', query_id, keys_txt_path],
-        capture_output=True, text=True
-    )
-    if proc.returncode != 0 or not proc.stdout:
-        # !r tells Python to call repr() on query_id rather than str()
-        # e.g. with quotes in case there is newlines, or non-printable characters
-        raise KeyError(f"{query_id!r} not found in keys file")
-    # stdout like "12345:KEY\n"
-    lineno = int(proc.stdout.split(':', 1)[0])
-    return lineno - 1  # convert to 0-based
+    prefix = index_prefix if index_prefix is not None else f"{h5_path}.keyidx"
+    if not os.path.exists(index_paths(prefix)['meta']):
+        print(f"No key index found at {prefix}, building it now")
+        build_key_index(h5_path, prefix)
+    key_index = KeyIndex(prefix)
+    if key_index.meta.get('source_mtime') != os.path.getmtime(h5_path):
+        print(f"Warning: {h5_path} changed since {prefix} was built; rows are checked against its keys")
+    return key_index
 
 def get_embeddings_multi(
     h5_path: str,
-    keys_txt_path: str,
-    query_ids,
-    threshold: int = 20
+    keys_txt_path: str = None,
+    query_ids=None,
+    threshold: int = None,
+    *,
+    index_prefix: str = None,
+    key_index: KeyIndex = None,
+    verify: bool = True,
+    threads: int = 1,
+    cache_mb: float = 0,
+    gatherer: ChunkGather = None
 ):
     """
     Returns a dict { key: embedding_array } for all found keys.
-    
-    - If 1 <= n < threshold: uses grep-per-key.
-    - If n >= threshold: builds an in-memory index once.
+
+    - Rows are looked up in the key index of h5_path (built on first use, see open_key_index),
+      for one or millions of IDs at once, without reading the keys into memory.
+    - Embeddings are gathered chunk by chunk (see embedding_store.ChunkGather), on `threads`
+      threads, as float32 whatever the storage profile.
+    - If verify, the keys at those rows are read back and compared, so a hash collision
+      or a stale index shows up as a missing key rather than a wrong embedding.
+    Pass key_index to reuse an open index across calls, and gatherer (a ChunkGather of an
+    open h5_path, e.g. ChunkGather(f, threads=4, cache_mb=2048)) to keep its LRU cache of
+    decoded chunks across calls; otherwise one is made per call with threads and cache_mb.
+
+    keys_txt_path and threshold are deprecated and ignored: they only remain so that old
+    calls get_embeddings_multi(h5_path, keys_txt_path, query_ids) keep working. Pass the
+    IDs as query_ids=... and everything else by keyword.
     """
+    if query_ids is None:
+        raise TypeError("get_embeddings_multi() needs query_ids=...; the second positional argument "
+                        "is the deprecated keys_txt_path")
+    if keys_txt_path is not None or threshold is not None:
+        warnings.warn("get_embeddings_multi(): keys_txt_path and threshold are deprecated and ignored; "
+                      "rows are looked up in the key index of h5_path. Pass query_ids=... instead.",
+                      DeprecationWarning, stacklevel=2)
     # Normalise to a list
     if isinstance(query_ids, str):
         query_ids = [query_ids]
     total = len(query_ids)
     result = {}
-    
-    with h5py.File(h5_path, 'r') as f:
-        emb_ds = f['embeddings']
-        
-        if total < threshold:
-            # use grep for each
-            for q in query_ids:
-                try:
-                    idx = _grep_index(keys_txt_path, q)
-                    result[q] = emb_ds[idx, :]
-                except KeyError:
-                    # skip missing
-                    pass
+
+    if key_index is None:
+        key_index = open_key_index(h5_path, index_prefix)
+    rows = key_index.lookup(query_ids)
+    hits = np.flatnonzero(rows >= 0)
+
+    if len(hits):
+        # a repeated query is read once, and h5py needs increasing row numbers for the keys
+        unique_rows, inverse = np.unique(rows[hits], return_inverse=True)
+        if gatherer is not None:
+            embs = gatherer.gather(unique_rows)
+            stored_keys = gatherer.emb_ds.file['keys'].asstr()[unique_rows] if verify else None
         else:
-            # build in-memory index
-            idx_map = build_inmemory_index(keys_txt_path)
-            for q in query_ids:
-                idx = idx_map.get(q)
-                if idx is not None:
-                    result[q] = emb_ds[idx, :]
-                # else skip missing
+            with h5py.File(h5_path, 'r') as f:
+                embs = ChunkGather(f, threads=threads, cache_mb=cache_mb).gather(unique_rows)
+                stored_keys = f['keys'].asstr()[unique_rows] if verify else None
+        for i, j in zip(hits, inverse):
+            q = query_ids[i]
+            if verify and stored_keys[j] != q:
+                # skip collision / stale row
+                continue
+            result[q] = embs[j]
 
-    # Summary
+    # Summary, over the unique IDs (a repeated ID is looked up and returned once)
+    n_unique = len(set(query_ids))
     found = len(result)
-    missing = total - found
-    print(f"Total queried IDs : {total}")
+    missing = n_unique - found
+    print(f"Total queried IDs : {total}" + (f" ({n_unique} unique)" if n_unique != total else ""))
     print(f"Found embeddings  : {found}")
     print(f"Missing embeddings: {missing}")
     if missing:
@@ -89,17 +104,15 @@ def get_embeddings_multi(
 
 # example usages
 if __name__ == "__main__":
-    # Load embeddings and the corresponding text file of keys
+    # Load embeddings; the key index GlobDB40.h5.keyidx.* is built next to it on first use
+    # (or beforehand with: python key_index.py --h5 GlobDB40.h5)
     h5_path        = "GlobDB40.h5"
-    keys_txt_path  = "GlobDB40keys.txt"
 
     # For a single ID or list of IDs:
     query_ids      = ["BCRBG_15609___2917", "GCA_013288945___541", "MOTU40_023145___1271"]  
     embeddings_dict = get_embeddings_multi(
         h5_path,
-        keys_txt_path,
-        query_ids,
-        threshold=20
+        query_ids=query_ids
     )
     # Or from a txt file of IDs (one per line, exactly as in GlobDB):
     with open('/lisc/scratch/dome/pullen/GlobDB/Testing/clustered_IDs_head10000.txt', 'r') as f:
@@ -107,7 +120,12 @@ if __name__ == "__main__":
     print(len(query_ids))
     embeddings_dict = get_embeddings_multi(
         h5_path,
-        keys_txt_path,
-        query_ids,
-        threshold=20
+        query_ids=query_ids
     )
+    # Many calls on the same store: keep the index and the chunk cache between them
+    key_index = open_key_index(h5_path)
+    with h5py.File(h5_path, 'r') as f:
+        gatherer = ChunkGather(f, threads=4, cache_mb=2048)
+        for batch in (query_ids[:5000], query_ids[5000:]):
+            embeddings_dict = get_embeddings_multi(h5_path, query_ids=batch, key_index=key_index,
+                                                   gatherer=gatherer)
@@ -1,9 +1,149 @@
-from itertools import islice
+from multiprocessing import get_context
 import sys
-from typing import List, Set, Tuple
+from typing import List, Tuple
 import os
+import time
 
-def extract_seqs(fasta_file: str, fai_file: str, IDs_to_extract: str, output_file: str) -> None:
+import numpy as np
+
+from fasta_index import COPY_BUFFER_BYTES, copy_range
+from key_index import hash_keys
+
+FAI_CHUNK_BYTES = 16 * 1024 ** 2  # bytes of the .fai parsed by one worker task, about 400k lines
+ID_BATCH = 1_000_000  # IDs hashed at a time
+
+def read_id_hashes(IDs_to_extract: str) -> np.ndarray:
+    """
+    Sorted, unique 64-bit hashes (key_index.hash_keys) of the IDs in the file, one per
+    line: 8 bytes per ID instead of a Python string in a set.
+    """
+    parts = []
+    with open(IDs_to_extract, 'rb') as id_file:
+        batch = []
+        for line in id_file:
+            # One ID per line, stripping any whitespace
+            seq_id = line.strip()
+            if seq_id:
+                batch.append(seq_id)
+            if len(batch) >= ID_BATCH:
+                parts.append(hash_keys(batch))
+                batch = []
+        parts.append(hash_keys(batch))
+    return np.unique(np.concatenate(parts))
+
+def fai_chunks(fai_file: str, chunk_bytes: int) -> List[Tuple[int, int]]:
+    """Split the .fai into byte ranges of about chunk_bytes that start and end at line boundaries."""
+    size = os.path.getsize(fai_file)
+    bounds = [0]
+    with open(fai_file, 'rb') as fai:
+        while bounds[-1] + chunk_bytes < size:
+            fai.seek(bounds[-1] + chunk_bytes)
+            fai.readline()  # finish the line we landed in
+            if fai.tell() >= size:
+                break
+            bounds.append(fai.tell())
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def _previous_line(fai, start: int) -> bytes:
+    """The .fai line that ends at byte start."""
+    pos = max(0, start - 65536)
+    fai.seek(pos)
+    data = fai.read(start - pos)
+    return data[data.rstrip(b'\n').rfind(b'\n') + 1:]
+
+def _record_ends(lengths, offsets, linebases, linewidth, fasta_size):
+    """Byte after the last residue line of each record (fasta_index.sequence_span, vectorized)."""
+    full_lines, remainder = np.divmod(lengths, np.maximum(linebases, 1))
+    span = full_lines * linewidth + np.where(remainder > 0, remainder + linewidth - linebases, 0)
+    span[(lengths == 0) | (linebases == 0)] = 0
+    return np.minimum(offsets + span, fasta_size)
+
+def _parse_fai(data: bytes):
+    """(names, lengths, offsets, linebases, linewidth) of the .fai lines in data."""
+    names, numbers = [], []
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        cols = line.split(b'\t')
+        try:
+            if len(cols) != 5:
+                raise ValueError
+            numbers.append((int(cols[1]), int(cols[2]), int(cols[3]), int(cols[4])))
+        except ValueError:
+            raise ValueError(f"Invalid .fai file format in line: {line.decode('utf-8', 'replace')}") from None
+        names.append(cols[0])
+    numbers = np.array(numbers, dtype=np.int64).reshape(-1, 4)
+    return names, numbers[:, 0], numbers[:, 1], numbers[:, 2], numbers[:, 3]
+
+_scan_state = {}
+
+def _scan_fai_chunk(chunk: Tuple[int, int]):
+    """
+    Coalesced (start, end) byte intervals of the records of one .fai chunk whose names are
+    in the ID hashes, and the number of records and matches. A record runs from the end
+    of the previous record to the end of its own sequence, so headers may hold more than
+    the .fai NAME and blank lines are kept.
+    """
+    fai_file, fasta_size, id_hashes = _scan_state['fai_file'], _scan_state['fasta_size'], _scan_state['id_hashes']
+    start, end = chunk
+    with open(fai_file, 'rb') as fai:
+        prev_end = 0
+        if start > 0:
+            _, length, offset, linebases, linewidth = _parse_fai(_previous_line(fai, start))
+            prev_end = int(_record_ends(length, offset, linebases, linewidth, fasta_size)[0])
+        fai.seek(start)
+        data = fai.read(end - start)
+    names, lengths, offsets, linebases, linewidth = _parse_fai(data)
+    ends = _record_ends(lengths, offsets, linebases, linewidth, fasta_size)
+    starts = np.concatenate(([prev_end], ends[:-1]))
+    hashes = hash_keys(names)
+    pos = np.minimum(np.searchsorted(id_hashes, hashes), len(id_hashes) - 1)
+    match = np.flatnonzero(id_hashes[pos] == hashes) if len(id_hashes) else np.empty(0, dtype=np.int64)
+    return coalesce(starts[match], ends[match]), len(names), len(match)
+
+def coalesce(starts, ends) -> np.ndarray:
+    """Merge intervals (sorted by start) that touch, as an (n, 2) int64 array."""
+    if not len(starts):
+        return np.empty((0, 2), dtype=np.int64)
+    new = np.concatenate(([True], starts[1:] != ends[:-1]))
+    first = np.flatnonzero(new)
+    last = np.concatenate((first[1:], [len(starts)])) - 1
+    return np.stack((starts[first], ends[last]), axis=1).astype(np.int64)
+
+def write_intervals(fasta_file: str, intervals: np.ndarray, output_file: str,
+                    buffer_bytes: int = COPY_BUFFER_BYTES) -> int:
+    """
+    Copy the intervals (sorted, disjoint) of the FASTA to output_file. Small intervals are
+    gathered from large sequential reads into a buffer written buffer_bytes at a time;
+    an interval larger than the buffer is copied with copy_range. Returns bytes written.
+    """
+    written = 0
+    src = os.open(fasta_file, os.O_RDONLY)
+    try:
+        with open(output_file, 'wb') as out_f:
+            window, window_start = b'', 0
+            out_buf = bytearray()
+            for start, end in intervals.tolist():
+                if end - start >= buffer_bytes:
+                    out_f.write(out_buf)
+                    out_buf = bytearray()
+                    out_f.flush()
+                    copy_range(src, out_f.fileno(), start, end - start)
+                else:
+                    if not (window_start <= start and end <= window_start + len(window)):
+                        window, window_start = os.pread(src, buffer_bytes, start), start
+                    out_buf += window[start - window_start:end - window_start]
+                    if len(out_buf) >= buffer_bytes:
+                        out_f.write(out_buf)
+                        out_buf = bytearray()
+                written += end - start
+            out_f.write(out_buf)
+    finally:
+        os.close(src)
+    return written
+
+def extract_seqs(fasta_file: str, fai_file: str, IDs_to_extract: str, output_file: str, workers: int = 1) -> None:
     """
     Extract desired sequences from a large FASTA file using its .fai index file.
 
@@ -31,22 +171,27 @@ def extract_seqs(fasta_file: str, fai_file: str, IDs_to_extract: str, output_fil
     offset we subtract 15+2 to get the start of the sequence ID (which should = the previous sequence's
     offset plus linewidth, as we have the sequence on 1 line).
 
+    Rather than the ID of each record (the header may hold more than the .fai NAME, e.g. a
+    description), a record is taken to run from the end of the previous record's sequence
+    to the end of its own (offset plus the bytes its LENGTH residues occupy), which gives the
+    same intervals for a well-formed file.
+
     Key Steps:
     0. Make the .fai file e.g. `seqkit faidx file.fasta`.
-    1. Use `islice` to read every matching ID's line from the .fai file which avoids the need to
-       read the entire file into memory. See https://docs.python.org/3/library/itertools.html#itertools.islice
-       and https://stackoverflow.com/a/27108718
-    2. For each desired sequence:
-       - Extract the sequence ID and calculate its length in bytes.
-       - Add 2 bytes (for '>' and newline) to account for the FASTA header format.
-       - Adjust the byte offset to include the ID line.
-    3. Write each sequence to a separate output file, ensuring valid FASTA format.
+    1. Hash the IDs to a sorted array of 64-bit keys (key_index.hash_keys), 8 bytes per ID
+       instead of a Python string in a set, so tens of millions of IDs fit easily.
+    2. Split the .fai into chunks at line boundaries and parse them in `workers` processes:
+       each line is parsed once, the names of the chunk hashed and looked up in the sorted
+       keys, and the matching records merged into coalesced byte intervals.
+    3. Merge the intervals of the chunks in order (joining intervals that touch across chunk
+       boundaries) and copy them to the output with large sequential reads and writes.
 
     Args:
         fasta_file (str): Path to the input FASTA file.
         fai_file (str): Path to the corresponding .fai index file.
         IDs_to_extract (str): Path to a text file containing sequence IDs to extract (one per line).
         output_file (str): Path to output FASTA filename (must be .fasta or .faa)
+        workers (int): Number of processes parsing the .fai.
 
     Output:
         Generates one FASTA file containing only our desired sequences.
@@ -55,7 +200,8 @@ def extract_seqs(fasta_file: str, fai_file: str, IDs_to_extract: str, output_fil
         - The first part always starts at byte 0 to include the header of the first sequence.
         - The script assumes the FASTA file is well-formatted, with each sequence starting
           with a '>' followed by the sequence ID and a newline.
-        - Having non-ASCII characters in the ID string might cause problems.
+        - Two different IDs sharing a 64-bit hash is vanishingly unlikely but would extract
+          an extra sequence; more sequences extracted than unique IDs is reported.
     """
     # Input validation
     assert isinstance(fasta_file, str) and fasta_file.endswith(('.fasta', '.faa')), "fasta_file must be a valid .fasta or .faa file path."
@@ -65,93 +211,59 @@ def extract_seqs(fasta_file: str, fai_file: str, IDs_to_extract: str, output_fil
     if not os.path.exists(IDs_to_extract):
         raise FileNotFoundError(f"IDs_to_extract file '{IDs_to_extract}' not found.")
 
-    ids_set: Set[str] = set()
-    with open(IDs_to_extract, 'r') as id_file:
-        for line in id_file:
-            # One ID per line, stripping any whitespace
-            seq_id = line.strip()
-            if seq_id:
-                ids_set.add(seq_id)
+    start_time = time.time()
+    id_hashes = read_id_hashes(IDs_to_extract)
+    print(f"Hashed {len(id_hashes)} unique IDs from {IDs_to_extract} in {time.time() - start_time:.1f}[s] "
+          f"({id_hashes.nbytes / 1024 ** 2:.1f} MB)")
+    sys.stdout.flush()
 
     # Get the total size of the FASTA file (needed for the last sequence)
     fasta_size = os.stat(fasta_file).st_size
+    fai_size = os.path.getsize(fai_file)
 
-    # Helper: given a line from the .fai file, compute the header start offset and return also the seq ID.
-    def parse_fai_line(line: str) -> Tuple[int, str]:
-        cols = line.rstrip("\n").split('\t')
-        if len(cols) != 5:
-            raise ValueError(f"Invalid .fai file format in line: {line}")
-        seq_id = cols[0] # Sequence ID
-        seq_offset = int(cols[2]) # Byte offset of the sequence
-        # Calculate the byte position of the ID line: 
-        # subtract header length (ID encoded in bytes + 2 for '>' and newline)
-        header_start = seq_offset - (len(seq_id.encode('utf-8')) + 2)
-        return header_start, seq_id
-
+    # Workers are forked and inherit the hashes rather than receiving a pickled copy.
+    _scan_state.update(fai_file=fai_file, fasta_size=fasta_size, id_hashes=id_hashes)
+    scan_time = time.time()
+    chunks = fai_chunks(fai_file, FAI_CHUNK_BYTES)
     line_count = 0
     extracted_count = 0
-    # Scan the .fai file and record intervals (start, end) for matching sequences.
-    # If consecutive intervals are contiguous, merge them.
-    matching_intervals = []  # List of tuples (start_offset, end_offset)
-    with open(fai_file, 'r') as fai:
-        prev_line = None
-        prev_header_start = None
-        prev_seq_id = None
-        
-        for line in fai:
-            line_count += 1
-            if line_count % 10000000 == 0:
-                print(f"Processed {line_count} lines of the .fai file so far...")
-                print(f"Extracted {extracted_count} sequences so far...")
-                sys.stdout.flush()
-            if prev_line is None:
-                prev_header_start, prev_seq_id = parse_fai_line(line)
-                prev_line = line
-                continue
-            
-            # For current line, compute its header start offset.
-            current_header_start, _ = parse_fai_line(line)
-            
-            # If the previous sequence is one of the IDs to extract,
-            # record its interval as [prev_header_start, current_header_start)
-            if prev_seq_id in ids_set:
-                extracted_count += 1
-                current_interval = (prev_header_start, current_header_start)
-                # Merge with the previous interval if contiguous.
-                if matching_intervals and matching_intervals[-1][1] == current_interval[0]:
-                    matching_intervals[-1] = (matching_intervals[-1][0], current_interval[1])
-                else:
-                    matching_intervals.append(current_interval)
-            
-            # Advance to next line.
-            prev_header_start, prev_seq_id = current_header_start, parse_fai_line(line)[1]
-        
-        # Process the last line in the .fai file.
-        if prev_seq_id in ids_set:
-            extracted_count += 1
-            last_interval = (prev_header_start, fasta_size)
-            if matching_intervals and matching_intervals[-1][1] == last_interval[0]:
-                matching_intervals[-1] = (matching_intervals[-1][0], last_interval[1])
-            else:
-                matching_intervals.append(last_interval)
-    
-    # Now open the FASTA file once and write out each matching interval.
-    with open(fasta_file, 'rb') as fasta, open(output_file, 'wb') as out_f:
-        for start, end in matching_intervals:
-            # Seek to the beginning of the interval.
-            fasta.seek(start)
-            # Read exactly the number of bytes for this interval.
-            data = fasta.read(end - start)
-            out_f.write(data)
+    # Coalesced intervals of each chunk, in .fai order.
+    matching_intervals = []
+    try:
+        if workers > 1 and len(chunks) > 1:
+            with get_context('fork').Pool(min(workers, len(chunks))) as pool:
+                results = list(pool.imap(_scan_fai_chunk, chunks))
+        else:
+            results = [_scan_fai_chunk(chunk) for chunk in chunks]
+    finally:
+        _scan_state.clear()
+    for intervals, n_lines, n_found in results:
+        line_count += n_lines
+        extracted_count += n_found
+        matching_intervals.append(intervals)
+    matching_intervals = np.concatenate(matching_intervals) if matching_intervals else np.empty((0, 2), dtype=np.int64)
+    matching_intervals = coalesce(matching_intervals[:, 0], matching_intervals[:, 1])
+    elapsed = max(time.time() - scan_time, 1e-9)
+    print(f"Scanned {line_count} lines of the .fai file ({fai_size / 1024 ** 2:.1f} MB) in {len(chunks)} chunks "
+          f"with {workers} workers in {elapsed:.1f}[s] ({line_count / elapsed:.0f} lines/s, "
+          f"{fai_size / elapsed / 1024 ** 2:.1f} MB/s)")
+    if extracted_count < len(id_hashes):
+        print(f"Warning: {len(id_hashes) - extracted_count} IDs were not found in the .fai file")
+    elif extracted_count > len(id_hashes):
+        print(f"Warning: {extracted_count} sequences matched {len(id_hashes)} unique IDs "
+              f"(repeated names in the .fai file or a hash collision)")
+    sys.stdout.flush()
 
+    # Now copy each matching interval from the FASTA file in file order.
+    write_time = time.time()
+    written = write_intervals(fasta_file, matching_intervals, output_file)
+    elapsed = max(time.time() - write_time, 1e-9)
     print(f"Extraction complete. {len(matching_intervals)} intervals were written to {output_file}.")
+    print(f"Wrote {written / 1024 ** 2:.1f} MB in {elapsed:.1f}[s] ({written / elapsed / 1024 ** 2:.1f} MB/s)")
     print(f"Processed {line_count} lines of the .fai file in total.")
     print(f"Total sequences extracted: {extracted_count}")
-
-#    with open("/lisc/scratch/dome/pullen/GlobDB/fastas/offsets_for_splitting.txt", 'w') as offsets_file:
-#        for offset in offsets:
-#            offsets_file.write(f"{offset}\n")
-#    print(f"len offset: {len(offsets)}")
+    print(f"Total time {time.time() - start_time:.1f}[s]")
+    sys.stdout.flush()
 
 def main():
     # Parameters
@@ -160,8 +272,10 @@ def main():
     output_file = "/lisc/scratch/dome/pullen/GlobDB/linclust/slurm-4625318/clusters_more_than1.fasta"
     IDs_to_extract = "/lisc/scratch/dome/pullen/GlobDB/linclust/slurm-4625318/cluster_more_than1_IDs.txt"
     
-    # Run the splitting
-    extract_seqs(fasta_file, fai_file, IDs_to_extract, output_file)
+    workers = int(os.environ.get('SLURM_CPUS_PER_TASK', 1))  # processes parsing the .fai
+
+    # Run the extraction
+    extract_seqs(fasta_file, fai_file, IDs_to_extract, output_file, workers)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Index-backed, streaming access to large FASTA files.
+
+Instead of reading every sequence into a dict, we keep a compact table with one row
+per record: the byte where its header starts, the byte where its sequence ends and its
+length in residues. The table is built either from the `.fai` index (see
+split_fasta_from_index.py for a description of the 5 columns) or, if there is no index,
+from one sequential scan of the FASTA. Sequences are then read from disk on demand with
+`os.pread`, so memory stays flat however big the input is.
+
+Example:
+    with FastaIndex("part_001.fasta") as fasta:
+        for seq_id, seq in fasta.iter_records(fasta.order_by_length()):
+            ...
+"""
+import errno
+import os
+from array import array
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+
+# 24 bytes per sequence, so ~80 MB for a 3.3M sequence split file
+RECORD_DTYPE = np.dtype([('start', np.int64), ('end', np.int64), ('length', np.int64)])
+
+# First line of a task manifest of virtual FASTA shards (plan_tasks.py, read by the embedder)
+VIRTUAL_MANIFEST_HEADER = "#task,fasta,ranges,n_seqs,est_seconds,first_id,last_id"
+
+
+def parse_fai_line(line: str) -> Tuple[str, int, int, int, int]:
+    """
+    Parse one line of a .fai file into (NAME, LENGTH, OFFSET, LINEBASES, LINEWIDTH).
+    """
+    cols = line.rstrip("\n").split('\t')
+    if len(cols) != 5:
+        raise ValueError(f"Invalid .fai file format in line: {line}")
+    return cols[0], int(cols[1]), int(cols[2]), int(cols[3]), int(cols[4])
+
+
+def sequence_span(length: int, linebases: int, linewidth: int) -> int:
+    """
+    Number of bytes a sequence of `length` residues occupies on disk, including the
+    newline characters (the last line is assumed to be newline-terminated).
+    """
+    if length == 0 or linebases == 0:
+        return 0
+    full_lines, remainder = divmod(length, linebases)
+    span = full_lines * linewidth
+    if remainder:
+        span += remainder + (linewidth - linebases)
+    return span
+
+
+def parse_byte_ranges(spec: str):
+    """'0-5314020;5314020-9000000' -> [(0, 5314020), (5314020, 9000000)], half-open byte ranges."""
+    ranges = []
+    for part in spec.split(';'):
+        start, _, end = part.strip().partition('-')
+        ranges.append((int(start), int(end)))
+    return ranges
+
+
+def format_byte_ranges(ranges) -> str:
+    """[(0, 5314020), (5314020, 9000000)] -> '0-5314020;5314020-9000000', as read by parse_byte_ranges."""
+    return ';'.join(f"{start}-{end}" for start, end in ranges)
+
+
+def format_manifest_line(task: int, fasta_path, ranges, n_seqs: int, est_seconds: float,
+                         first_id: str, last_id: str) -> str:
+    """One task of a virtual manifest (see VIRTUAL_MANIFEST_HEADER), newline included."""
+    return (f"{task:06d},{os.path.abspath(fasta_path)},{format_byte_ranges(ranges)},{n_seqs},"
+            f"{est_seconds:.1f},{first_id},{last_id}\n")
+
+
+def is_virtual_manifest(manifest_path) -> bool:
+    """Whether the manifest lists byte ranges of a FASTA (written by plan_tasks.py)."""
+    with open(manifest_path, 'r') as f:
+        return f.readline().strip() == VIRTUAL_MANIFEST_HEADER
+
+
+def parse_manifest_task(fields):
+    """Fields of one virtual manifest line -> (FASTA path, byte ranges)."""
+    return fields[1], parse_byte_ranges(fields[2])
+
+
+def default_fai_path(fasta_path) -> Optional[str]:
+    """Return `<fasta>.fai` if it exists (as written by `seqkit faidx`), otherwise None."""
+    fai_path = f"{fasta_path}.fai"
+    return fai_path if os.path.exists(fai_path) else None
+
+
+def clean_id(header: str) -> str:
+    """Header line to identifier, replacing tokens that are mis-interpreted when loading h5."""
+    return header.strip().replace("/", "_").replace(".", "_")
+
+
+def clean_sequence(seq_bytes: bytes) -> str:
+    """Join lines, drop white-space and gaps and cast to upper-case."""
+    return b''.join(seq_bytes.split()).decode('ascii').upper().replace("-", "")
+
+
+COPY_BUFFER_BYTES = 64 * 1024 ** 2
+
+
+def copy_range(src_fd: int, dst_fd: int, offset: int, count: int) -> None:
+    """
+    Append bytes offset:offset + count of src_fd at the current position of dst_fd.
+
+    Uses os.copy_file_range, so the kernel copies (or, on file systems that support it,
+    reflinks) the data without it passing through user space; falls back to os.sendfile
+    and then to pread/write in COPY_BUFFER_BYTES pieces where those are not supported,
+    e.g. across file systems on older kernels.
+    """
+    end = offset + count
+    for method in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, method):
+            continue
+        try:
+            while offset < end:
+                if method == 'copy_file_range':
+                    n = os.copy_file_range(src_fd, dst_fd, end - offset, offset)
+                else:
+                    n = os.sendfile(dst_fd, src_fd, offset, end - offset)
+                if n == 0:
+                    raise EOFError(f"Unexpected end of file at byte {offset} (expected {end})")
+                offset += n
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP):
+                raise
+    while offset < end:
+        data = os.pread(src_fd, min(COPY_BUFFER_BYTES, end - offset), offset)
+        if not data:
+            raise EOFError(f"Unexpected end of file at byte {offset} (expected {end})")
+        view = memoryview(data)
+        while view:
+            view = view[os.write(dst_fd, view):]
+        offset += len(data)
+
+
+class FastaIndex:
+    """
+    Compact (start, end, length) table of the records in a FASTA file, plus an open
+    file descriptor to read single records back with `os.pread`.
+
+    Records are addressed by their position in the file (0-based), so any ordering of
+    the table (e.g. longest first) is just an array of record numbers.
+    """
+
+    def __init__(self, fasta_path, fai_path=None, ranges=None):
+        self.fasta_path = str(fasta_path)
+        self.fasta_size = os.path.getsize(self.fasta_path)
+        if ranges is not None:
+            # a virtual shard of a big FASTA: only the records in these byte ranges
+            self.records = self._table_from_ranges(ranges)
+            self.source = f"scan of {len(ranges)} byte ranges"
+        else:
+            if fai_path is None:
+                fai_path = default_fai_path(self.fasta_path)
+            if fai_path is not None:
+                self.records = self._table_from_fai(str(fai_path))
+                self.source = str(fai_path)
+            else:
+                self.records = self._table_from_scan()
+                self.source = "scan"
+        self._fd = os.open(self.fasta_path, os.O_RDONLY)
+
+    def _table_from_fai(self, fai_path: str) -> np.ndarray:
+        """
+        The header of record i spans from the end of record i-1's sequence to OFFSET of
+        record i, so this also works when headers contain more than the .fai NAME.
+        """
+        starts, ends, lengths = array('q'), array('q'), array('q')
+        prev_end = 0
+        with open(fai_path, 'r') as fai:
+            for line in fai:
+                if not line.strip():
+                    continue
+                _, length, offset, linebases, linewidth = parse_fai_line(line)
+                end = min(offset + sequence_span(length, linebases, linewidth), self.fasta_size)
+                starts.append(prev_end)
+                ends.append(end)
+                lengths.append(length)
+                prev_end = end
+        return self._to_table(starts, ends, lengths)
+
+    def _table_from_scan(self) -> np.ndarray:
+        """One sequential pass over the FASTA, counting residues per record."""
+        starts, ends, lengths = array('q'), array('q'), array('q')
+        with open(self.fasta_path, 'rb') as fasta:
+            self._scan(fasta, 0, None, starts, ends, lengths)
+        return self._to_table(starts, ends, lengths)
+
+    def _table_from_ranges(self, ranges) -> np.ndarray:
+        """
+        One sequential pass over each byte range [start, end), e.g. from plan_tasks.py. A
+        range must start at a record (or blank lines before one) and end where one ends.
+        """
+        starts, ends, lengths = array('q'), array('q'), array('q')
+        with open(self.fasta_path, 'rb') as fasta:
+            for start, end in ranges:
+                if not 0 <= start <= end <= self.fasta_size:
+                    raise ValueError(f"Byte range {start}-{end} is outside {self.fasta_path} ({self.fasta_size} bytes)")
+                fasta.seek(start)
+                self._scan(fasta, start, end, starts, ends, lengths)
+        return self._to_table(starts, ends, lengths)
+
+    def _scan(self, fasta, pos, stop, starts, ends, lengths) -> None:
+        """Append the records from byte pos (where fasta is positioned) to stop, or the end if None."""
+        length = None
+        while stop is None or pos < stop:
+            line = fasta.readline()
+            if not line:
+                break
+            if line.startswith(b'>'):
+                if length is not None:
+                    ends.append(pos)
+                    lengths.append(length)
+                starts.append(pos)
+                length = 0
+            elif length is not None:
+                length += len(line.strip())
+            elif stop is not None and line.strip():
+                raise ValueError(f"A byte range of {self.fasta_path} does not start at a record (byte {pos})")
+            pos += len(line)
+        if length is not None:
+            ends.append(pos)
+            lengths.append(length)
+        if stop is not None and (pos != stop or fasta.read(1) not in (b'', b'>', b'\n', b'\r')):
+            raise ValueError(f"Byte range ending at {stop} of {self.fasta_path} does not end at a record")
+
+    @staticmethod
+    def _to_table(starts: array, ends: array, lengths: array) -> np.ndarray:
+        table = np.empty(len(starts), dtype=RECORD_DTYPE)
+        table['start'] = np.frombuffer(starts, dtype=np.int64)
+        table['end'] = np.frombuffer(ends, dtype=np.int64)
+        table['length'] = np.frombuffer(lengths, dtype=np.int64)
+        return table
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return self.records['length']
+
+    def order_by_length(self, descending: bool = True) -> np.ndarray:
+        """Record numbers sorted by length (stable, so file order is kept for ties)."""
+        key = -self.lengths if descending else self.lengths
+        return np.argsort(key, kind='stable')
+
+    def read_record(self, i: int) -> Tuple[str, str]:
+        """Return (identifier, sequence) of record number i, read straight from disk."""
+        start, end = int(self.records['start'][i]), int(self.records['end'][i])
+        data = os.pread(self._fd, end - start, start)
+        # anything before the '>' is blank lines left over from the previous record
+        data = data[data.find(b'>') + 1:]
+        header, _, seq_bytes = data.partition(b'\n')
+        return clean_id(header.decode('utf-8')), clean_sequence(seq_bytes)
+
+    def read_id(self, i: int, max_header_bytes: int = 4096) -> str:
+        """Identifier of record number i, reading only the start of its header."""
+        start, end = int(self.records['start'][i]), int(self.records['end'][i])
+        data = os.pread(self._fd, min(end - start, max_header_bytes), start)
+        header = data[data.find(b'>') + 1:].partition(b'\n')[0]
+        return clean_id(header.decode('utf-8'))
+
+    def iter_records(self, order=None) -> Iterator[Tuple[str, str]]:
+        """Stream (identifier, sequence) for the given record numbers, or in file order."""
+        if order is None:
+            order = range(len(self))
+        for i in order:
+            yield self.read_record(i)
+
+    def fileno(self) -> int:
+        """File descriptor of the open FASTA, e.g. for copy_range."""
+        return self._fd
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Compact, memory-mappable index of the keys in an embeddings/keys store.
+
+Reading the whole 'keys' dataset of the master file into a Python set costs many GB
+per job. Instead we publish a sidecar once, next to the master:
+  <prefix>.hashes.npy  sorted, unique uint64 hashes of the non-empty keys
+  <prefix>.rows.npy    int64 row in the store of each of those keys (first row if repeated)
+  <prefix>.bloom.npy   optional Bloom filter (uint8 bit array) over the same hashes
+  <prefix>.json        metadata: number of keys, hash scheme, Bloom parameters, source
+
+Readers np.load(..., mmap_mode='r') the arrays, so only the pages touched by the
+binary search are read from disk, and membership checks and key -> row lookups
+(KeyIndex.lookup) are O(log n).
+
+Keys are hashed with the first 8 bytes of BLAKE2b. With ~83M keys the chance of any
+two keys sharing a hash is ~2e-4, and a collision can only make a new protein look
+like it was already processed.
+
+Example:
+    python key_index.py --h5 GlobDB40.h5 --bloom-bits-per-key 10
+    python prott5_embedder_globdb.py ... --processed_index GlobDB40.h5.keyidx
+"""
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import time
+
+import h5py
+import numpy as np
+
+HASH_SCHEME = "blake2b-64-le"
+
+
+def key_hash(key) -> int:
+    """Stable 64-bit hash of a key (str or UTF-8 bytes)."""
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+def hash_keys(keys) -> np.ndarray:
+    """uint64 hashes of an iterable of keys, in the same order."""
+    return np.fromiter((key_hash(k) for k in keys), dtype=np.uint64)
+
+
+def index_paths(prefix):
+    prefix = str(prefix)
+    return {
+        'hashes': f"{prefix}.hashes.npy",
+        'rows': f"{prefix}.rows.npy",
+        'bloom': f"{prefix}.bloom.npy",
+        'meta': f"{prefix}.json",
+    }
+
+
+def _bloom_positions(hashes: np.ndarray, n_bits: int, n_hashes: int) -> np.ndarray:
+    """Bit positions (n_hashes x len(hashes)) by double hashing on the two halves of the hash."""
+    h1 = hashes & np.uint64(0xFFFFFFFF)
+    h2 = (hashes >> np.uint64(32)) | np.uint64(1)
+    i = np.arange(n_hashes, dtype=np.uint64)[:, None]
+    return (h1[None, :] + i * h2[None, :]) % np.uint64(n_bits)
+
+
+def build_bloom(hashes: np.ndarray, bits_per_key: int, block_size: int = 10_000_000):
+    """Return (bit array as uint8, number of bits, number of hash functions)."""
+    n_bits = max(8, int(len(hashes) * bits_per_key))
+    n_hashes = max(1, int(round(bits_per_key * np.log(2))))
+    bits = np.zeros((n_bits + 7) // 8, dtype=np.uint8)
+    for start in range(0, len(hashes), block_size):
+        pos = _bloom_positions(hashes[start:start + block_size], n_bits, n_hashes).ravel()
+        np.bitwise_or.at(bits, (pos >> np.uint64(3)).astype(np.int64),
+                         (np.uint8(1) << (pos & np.uint64(7)).astype(np.uint8)))
+    return bits, n_bits, n_hashes
+
+
+def _save_npy_atomic(path, arr):
+    """Write to a temporary file and rename, so readers never see a half-written array."""
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        np.save(f, arr)
+    os.replace(tmp_path, path)
+
+
+def read_key_rows(h5_path, block_size=10_000_000, lock=True):
+    """
+    Hash every non-empty key of the store at h5_path, reading 'keys' in blocks under a
+    shared flock (as read_processed_ids does). Returns (hashes, rows): sorted, unique
+    uint64 hashes and the int64 row of each key in the store (its first row if repeated).
+    """
+    hash_parts, row_parts = [], []
+    with open(h5_path, 'rb') as f:
+        if lock:
+            print("Acquiring shared lock...")
+            fcntl.flock(f, fcntl.LOCK_SH)
+        try:
+            with h5py.File(f, 'r') as hf:
+                keys_ds = hf['keys']
+                total = keys_ds.shape[0]
+                for start in range(0, total, block_size):
+                    end = min(start + block_size, total)
+                    block = keys_ds[start:end]
+                    valid = [i for i, k in enumerate(block) if k not in (b'', '')]
+                    hash_parts.append(hash_keys(block[i] for i in valid))
+                    row_parts.append(np.asarray(valid, dtype=np.int64) + start)
+                    print(f"  Hashed keys {start}–{end} / {total}")
+                    sys.stdout.flush()
+        finally:
+            if lock:
+                print("Releasing shared lock...")
+                fcntl.flock(f, fcntl.LOCK_UN)
+    return sort_unique_hashes(hash_parts, row_parts)
+
+
+def sort_unique_hashes(hash_parts, row_parts):
+    """Concatenate blocks of (hashes, rows) in row order, sort by hash and keep each hash's first row."""
+    hashes = np.concatenate(hash_parts) if hash_parts else np.empty(0, dtype=np.uint64)
+    rows = np.concatenate(row_parts) if row_parts else np.empty(0, dtype=np.int64)
+    # rows are increasing, so a stable sort keeps the first row of a repeated key first
+    order = np.argsort(hashes, kind='stable')
+    hashes, rows = hashes[order], rows[order]
+    first = np.ones(len(hashes), dtype=bool)
+    first[1:] = hashes[1:] != hashes[:-1]
+    return hashes[first], rows[first]
+
+
+def read_key_hashes(h5_path, block_size=10_000_000, lock=True):
+    """Sorted, unique uint64 hashes of the non-empty keys of the store at h5_path."""
+    return read_key_rows(h5_path, block_size, lock)[0]
+
+
+def write_key_index(prefix, hashes, rows, source, bloom_bits_per_key=0):
+    """Publish sorted unique hashes and their rows (from sort_unique_hashes) as the index at prefix."""
+    paths = index_paths(prefix)
+    meta = {
+        'source': os.path.abspath(str(source)),
+        'source_mtime': os.path.getmtime(source),
+        'n_keys': int(len(hashes)),
+        'hash_scheme': HASH_SCHEME,
+        'rows': True,
+        'bloom': None,
+    }
+    _save_npy_atomic(paths['hashes'], hashes)
+    _save_npy_atomic(paths['rows'], rows)
+    if bloom_bits_per_key > 0:
+        bits, n_bits, n_hashes = build_bloom(hashes, bloom_bits_per_key)
+        _save_npy_atomic(paths['bloom'], bits)
+        meta['bloom'] = {'n_bits': n_bits, 'n_hashes': n_hashes}
+    # The metadata goes last: its presence means the arrays are complete
+    tmp_meta = f"{paths['meta']}.tmp{os.getpid()}"
+    with open(tmp_meta, 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_meta, paths['meta'])
+
+
+def build_key_index(h5_path, prefix=None, bloom_bits_per_key=0, block_size=10_000_000, lock=True):
+    """
+    Build and publish the sidecar index of the store at h5_path. Returns the prefix used.
+    Pass lock=False if the caller already holds a lock on h5_path.
+    """
+    prefix = str(prefix) if prefix is not None else f"{h5_path}.keyidx"
+    start = time.time()
+    hashes, rows = read_key_rows(h5_path, block_size, lock)
+    write_key_index(prefix, hashes, rows, h5_path, bloom_bits_per_key)
+    print(f"Indexed {len(hashes)} keys of {h5_path} into {prefix}.* in {time.time() - start:.1f}[s]")
+    return prefix
+
+
+class KeyIndex:
+    """
+    Read-only membership test against a published sidecar, usable in place of the
+    set returned by read_processed_ids (supports `in` and len()), and key -> row
+    lookups into the store it was built from.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = str(prefix)
+        paths = index_paths(prefix)
+        with open(paths['meta'], 'r') as f:
+            self.meta = json.load(f)
+        if self.meta['hash_scheme'] != HASH_SCHEME:
+            raise ValueError(f"Unsupported hash scheme {self.meta['hash_scheme']} in {paths['meta']}")
+        self.hashes = np.load(paths['hashes'], mmap_mode='r')
+        self.rows = np.load(paths['rows'], mmap_mode='r') if self.meta.get('rows') else None
+        self.bloom = None
+        if self.meta.get('bloom'):
+            self.bloom = np.load(paths['bloom'], mmap_mode='r')
+            self.n_bits = self.meta['bloom']['n_bits']
+            self.n_hashes = self.meta['bloom']['n_hashes']
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def _maybe_present(self, hashes: np.ndarray) -> np.ndarray:
+        """Bloom filter check: False means certainly absent."""
+        if self.bloom is None:
+            return np.ones(len(hashes), dtype=bool)
+        pos = _bloom_positions(hashes, self.n_bits, self.n_hashes)
+        bytes_ = np.asarray(self.bloom[(pos >> np.uint64(3)).astype(np.int64)])
+        set_bits = (bytes_ >> (pos & np.uint64(7)).astype(np.uint8)) & np.uint8(1)
+        return set_bits.all(axis=0).astype(bool)
+
+    def contains_hashes(self, hashes: np.ndarray) -> np.ndarray:
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        found = self._maybe_present(hashes)
+        candidates = np.flatnonzero(found)
+        if len(candidates) and len(self.hashes):
+            pos = np.searchsorted(self.hashes, hashes[candidates])
+            pos_clipped = np.minimum(pos, len(self.hashes) - 1)
+            found[candidates] = (pos < len(self.hashes)) & (self.hashes[pos_clipped] == hashes[candidates])
+        else:
+            found[:] = False
+        return found
+
+    def contains_many(self, keys) -> np.ndarray:
+        """Boolean array: which of the keys are in the index."""
+        return self.contains_hashes(hash_keys(keys))
+
+    def lookup_hashes(self, hashes: np.ndarray) -> np.ndarray:
+        """int64 row in the store of each hash, -1 where it is not in the index."""
+        if self.rows is None:
+            raise ValueError(f"Key index {self.prefix} has no row numbers: rebuild it with key_index.py")
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        found_rows = np.full(len(hashes), -1, dtype=np.int64)
+        candidates = np.flatnonzero(self._maybe_present(hashes))
+        if len(candidates) and len(self.hashes):
+            pos = np.minimum(np.searchsorted(self.hashes, hashes[candidates]), len(self.hashes) - 1)
+            hit = self.hashes[pos] == hashes[candidates]
+            found_rows[candidates[hit]] = self.rows[pos[hit]]
+        return found_rows
+
+    def lookup(self, keys) -> np.ndarray:
+        """int64 row in the store of each key, -1 where it is not in the index."""
+        return self.lookup_hashes(hash_keys(keys))
+
+    def __contains__(self, key) -> bool:
+        return bool(self.contains_many([key])[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Publish a compact, mmap-able hash index of the keys in an embeddings/keys HDF5 store."
+    )
+    parser.add_argument('--h5', type=str, required=True,
+                        help="Master HDF5 file with a 'keys' dataset")
+    parser.add_argument('--prefix', type=str, default=None,
+                        help="Prefix for the index files (default: <h5>.keyidx)")
+    parser.add_argument('--bloom-bits-per-key', type=int, default=0,
+                        help="Also write a Bloom filter with this many bits per key, e.g. 10 for ~1%% "
+                             "false positives (default: 0, no filter)")
+    parser.add_argument('--block-size', type=int, default=10_000_000,
+                        help="Keys to read at a time (default: 1e7)")
+    args = parser.parse_args()
+    build_key_index(args.h5, args.prefix, args.bloom_bits_per_key, args.block_size)
+
+
+if __name__ == '__main__':
+    main()
+
+# python /lisc/project/dome/protein_embeddings/py_bash_scripts/key_index.py --h5 /lisc/project/dome/protein_embeddings/GlobDB/embeddings/chlor_plus_part001and002.h5 --bloom-bits-per-key 10
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Measure the storage profiles of embedding_store.py on a sample of real embeddings before
+choosing one for merge_h5_big_to_final.py / merge_h5_inter_to_big.py --storage-profile.
+
+For each profile the sample is written to a temporary store and read back in full, and
+we report:
+  - bytes per row of the embeddings on disk (keys excluded), the ratio to uncompressed
+    float32 and the projected size of the whole input store
+  - write and full-scan read throughput (MB/s of float32 embeddings). The written file is
+    fsynced and dropped from the page cache (posix_fadvise) before it is read, so the read
+    includes the disk as well as decompression and decoding
+  - the error versus float32: per-row cosine similarity (mean and min) and max abs diff
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from embedding_store import (EMB_CHUNK_ROWS, append_rows, create_store_datasets, is_store_layout,
+                             iter_embedding_blocks, read_embeddings)
+
+DEFAULT_PROFILES = ('float32,float32-shuffle-gzip,float16,float16-shuffle-gzip,float16-lzf,'
+                    'int8,int8-shuffle-gzip,int8-lzf')
+
+
+def read_sample(path, n_rows, block_rows=EMB_CHUNK_ROWS):
+    """The first n_rows (keys, float32 embeddings) of a store or per-key file."""
+    keys, embs, total = [], [], 0
+    for keys_block, emb_block in iter_embedding_blocks(path, block_rows):
+        keys.extend(keys_block)
+        embs.append(emb_block)
+        total += len(keys_block)
+        if total >= n_rows:
+            break
+    return np.array(keys[:n_rows], dtype=object), np.concatenate(embs)[:n_rows]
+
+
+def total_rows(path):
+    """Number of rows in the input, to project the size of the full store."""
+    with h5py.File(path, 'r') as hf:
+        return hf['embeddings'].shape[0] if is_store_layout(hf) else len(hf)
+
+
+def drop_from_page_cache(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def measure_profile(profile, keys, embs, out_path, chunk_rows):
+    """Write keys/embs with profile to out_path, read it back and return the measurements."""
+    mb = embs.nbytes / 1024 ** 2
+    start = time.time()
+    with h5py.File(out_path, 'w') as hf:
+        emb_ds, keys_ds = create_store_datasets(hf, embs.shape[1], emb_chunk_rows=chunk_rows, profile=profile)
+        for s in range(0, len(keys), chunk_rows):
+            append_rows(emb_ds, keys_ds, embs[s:s + chunk_rows], keys[s:s + chunk_rows])
+    write_time = time.time() - start
+    with h5py.File(out_path, 'r') as hf:
+        # the embeddings (and scales) only: the keys take the same space in every profile
+        size = sum(hf[name].id.get_storage_size() for name in ('embeddings', 'scales') if name in hf)
+    drop_from_page_cache(out_path)
+
+    start = time.time()
+    decoded = np.empty_like(embs)
+    with h5py.File(out_path, 'r') as hf:
+        for s in range(0, len(keys), chunk_rows):
+            decoded[s:s + chunk_rows] = read_embeddings(hf, slice(s, s + chunk_rows))
+    read_time = time.time() - start
+
+    ref = embs.astype(np.float64)
+    test = decoded.astype(np.float64)
+    cos_sim = (ref * test).sum(axis=1) / (np.linalg.norm(ref, axis=1) * np.linalg.norm(test, axis=1))
+    return {
+        'profile': profile,
+        'bytes_per_row': size / len(keys),
+        'write_mb_s': mb / write_time,
+        'read_mb_s': mb / read_time,
+        'cos_mean': float(np.mean(cos_sim)),
+        'cos_min': float(np.min(cos_sim)),
+        'max_abs_diff': float(np.abs(ref - test).max()),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure size, read throughput and accuracy of the "
+                                                 "embedding storage profiles on a sample of a store.")
+    parser.add_argument('--input', type=str, required=True,
+                        help="HDF5 file to take the sample from (embeddings/keys store or per-key file)")
+    parser.add_argument('--rows', type=int, default=200_000,
+                        help="Number of rows in the sample (default: 200000)")
+    parser.add_argument('--profiles', type=str, default=DEFAULT_PROFILES,
+                        help=f"Comma-separated storage profiles to measure (default: {DEFAULT_PROFILES})")
+    parser.add_argument('--chunk-rows', type=int, default=EMB_CHUNK_ROWS,
+                        help=f"Rows per chunk, as used by the merge (default: {EMB_CHUNK_ROWS})")
+    parser.add_argument('--tmp-dir', type=str, default=None,
+                        help="Where to write the temporary stores, ideally the same file system as the "
+                             "final store (default: $TMPDIR)")
+    args = parser.parse_args()
+
+    keys, embs = read_sample(args.input, args.rows)
+    n_total = total_rows(args.input)
+    print(f"Sample of {len(keys)} rows x {embs.shape[1]} from {args.input} ({n_total} rows in total)")
+    sys.stdout.flush()
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        for profile in args.profiles.split(','):
+            out_path = os.path.join(tmp_dir, f"{profile}.h5")
+            results.append(measure_profile(profile.strip(), keys, embs, out_path, args.chunk_rows))
+            os.remove(out_path)
+            print(f"  measured {profile}")
+            sys.stdout.flush()
+
+    float32_bytes = 4 * embs.shape[1]
+    print(f"\n{'profile':24s} {'B/row':>8s} {'ratio':>6s} {'full GB':>8s} {'write MB/s':>10s} "
+          f"{'read MB/s':>9s} {'cos mean':>10s} {'cos min':>10s} {'max |diff|':>10s}")
+    for r in results:
+        print(f"{r['profile']:24s} {r['bytes_per_row']:8.0f} {r['bytes_per_row'] / float32_bytes:6.3f} "
+              f"{r['bytes_per_row'] * n_total / 1e9:8.1f} {r['write_mb_s']:10.1f} {r['read_mb_s']:9.1f} "
+              f"{r['cos_mean']:10.7f} {r['cos_min']:10.7f} {r['max_abs_diff']:10.3g}")
+
+
+if __name__ == '__main__':
+    main()
+
+# python /lisc/project/dome/protein_embeddings/py_bash_scripts/measure_storage_profiles.py --input /lisc/project/dome/protein_embeddings/GlobDB/embeddings/chlor_plus_part001and002.h5 --rows 500000 --tmp-dir /lisc/scratch/dome/pullen/GlobDB/embeddings
@@ -3,7 +3,121 @@ import numpy as np
 import glob
 import os
 import argparse
+import queue
 import sys
+import threading
+import time
+
+from embedding_store import (DEFAULT_PROFILE, KEYS_CHUNK_ROWS, create_store_datasets, read_embeddings,
+                             resize_store, write_rows)
+from sharded_store import ShardedStoreWriter
+
+N_BUFFERS = 2  # one block being written while the reader fills the other
+
+def valid_key_mask(keys_block):
+    """True for the non-empty keys. Variable-length keys come back as an object array and b'' is falsy."""
+    return keys_block.astype(bool)
+
+def count_valid_rows(input_files, block_size=KEYS_CHUNK_ROWS):
+    """Number of rows with a non-empty key in each input file (reads the keys only)."""
+    counts = []
+    for infile in input_files:
+        with h5py.File(infile, 'r') as f:
+            keys_ds = f['keys']
+            counts.append(sum(int(np.count_nonzero(valid_key_mask(keys_ds[start:start + block_size])))
+                              for start in range(0, keys_ds.shape[0], block_size)))
+    return counts
+
+def _read_ahead(input_files, block_size, buffers, free_slots, full_slots, stop):
+    """
+    Reader thread: filter and decode each block into a free buffer and pass its slot, keys
+    and position to the writer. Sends ('file', infile, rows read) at the end of each file
+    and None at the end. h5py releases the GIL while it reads and decompresses, so this
+    overlaps with the writes of the main thread.
+    """
+    try:
+        for infile in input_files:
+            with h5py.File(infile, 'r') as f:
+                total_rows = f['embeddings'].shape[0]
+                for start in range(0, total_rows, block_size):
+                    end = min(start + block_size, total_rows)
+                    keys_block = f['keys'][start:end]
+                    valid_indices = np.flatnonzero(valid_key_mask(keys_block))
+                    if not len(valid_indices):
+                        # Skip block if no valid entries.
+                        continue
+                    # Read the corresponding embeddings (as float32, whatever the input's profile).
+                    emb_block = read_embeddings(f, slice(start, end))
+                    while True:
+                        if stop.is_set():
+                            return
+                        try:
+                            slot = free_slots.get(timeout=1)
+                            break
+                        except queue.Empty:
+                            continue
+                    np.take(emb_block, valid_indices, axis=0, out=buffers[slot][:len(valid_indices)])
+                    full_slots.put(('block', infile, start, end, slot, keys_block[valid_indices]))
+            full_slots.put(('file', infile, total_rows))
+        full_slots.put(None)
+    except BaseException as e:
+        full_slots.put(('error', e))
+
+def iter_valid_blocks(input_files, block_size, n_cols):
+    """
+    Read each input file in blocks of block_size rows and yield
+    (start, end, valid_keys, valid_emb) for the rows with a non-empty key.
+
+    The blocks are read and decoded by a background thread into one of two buffers while
+    the caller writes the previous one, so valid_emb is only valid until the next block
+    is requested. Throughput is reported at the end of each file.
+    """
+    buffers = [np.empty((block_size, n_cols), dtype=np.float32) for _ in range(N_BUFFERS)]
+    free_slots, full_slots = queue.Queue(), queue.Queue()
+    for slot in range(N_BUFFERS):
+        free_slots.put(slot)
+    stop = threading.Event()
+    reader = threading.Thread(target=_read_ahead, name="reader",
+                              args=(input_files, block_size, buffers, free_slots, full_slots, stop), daemon=True)
+    reader.start()
+    try:
+        current_file, file_rows, file_start, read_wait = None, 0, time.time(), 0.0
+        while True:
+            wait_start = time.time()
+            msg = full_slots.get()
+            read_wait += time.time() - wait_start
+            if msg is None:
+                break
+            if msg[0] == 'error':
+                raise msg[1]
+            if msg[0] == 'file':
+                _, infile, rows_read = msg
+                elapsed = max(time.time() - file_start, 1e-9)
+                print(f"Finished file: {infile}: {file_rows} of {rows_read} rows valid, {elapsed:.1f}[s], "
+                      f"{file_rows / elapsed:.0f} rows/s, {file_rows * n_cols * 4 / elapsed / 1024 ** 2:.1f} MB/s "
+                      f"(waited {read_wait:.1f}[s] for reads)")
+                sys.stdout.flush()
+                current_file, file_rows, file_start, read_wait = None, 0, time.time(), 0.0
+                continue
+            _, infile, start, end, slot, valid_keys = msg
+            if infile != current_file:
+                print(f"Processing file: {infile}")
+                current_file = infile
+            file_rows += len(valid_keys)
+            yield start, end, valid_keys, buffers[slot][:len(valid_keys)]
+            free_slots.put(slot)
+    finally:
+        stop.set()
+        reader.join()
+
+def merge_blocks(blocks, append):
+    """Append every block with append(keys, emb) -> total rows so far. Returns the total."""
+    current_index = 0
+    for start, end, valid_keys, valid_emb in blocks:
+        current_index = append(valid_keys, valid_emb)
+        print(f"  Processed rows {start} to {end}: added {len(valid_keys)} valid entries (total so far: {current_index})")
+        sys.stdout.flush()
+    return current_index
 
 def main():
     parser = argparse.ArgumentParser(
@@ -15,6 +129,15 @@ def main():
                         help="Path to the final output master HDF5 file.")
     parser.add_argument('--block-size', type=int, default=100000,
                         help="Number of rows to process per block (default: 100000).")
+    parser.add_argument('--storage-profile', type=str, default=DEFAULT_PROFILE,
+                        help="Precision and compression of the output embeddings: float32, float16 or int8 "
+                             "(per-row scale), optionally followed by -shuffle and -gzip or -lzf, "
+                             "e.g. float16-shuffle-gzip (default: float32, uncompressed). "
+                             "See measure_storage_profiles.py")
+    parser.add_argument('--shards', type=int, default=1,
+                        help="Write this many shards partitioned by key hash, plus a manifest, instead of "
+                             "one file: --output-file X.h5 gives X.shard000.h5, ... and X.manifest.json "
+                             "(see sharded_store.py; default: 1, a single file)")
     args = parser.parse_args()
 
     # Split the comma-separated patterns and combine the results.
@@ -36,65 +159,50 @@ def main():
     n_cols = emb_shape[1]
     print(f"Found {len(input_files)} input files. Embedding width taken to be {n_cols}.")
 
+    blocks = iter_valid_blocks(input_files, args.block_size, n_cols)
+    print(f"Storage profile: {args.storage_profile}")
+    if args.shards > 1:
+        # Each shard buffers and appends one chunk (10000 rows) at a time.
+        with ShardedStoreWriter(args.output_file, args.shards, n_cols, profile=args.storage_profile) as writer:
+            current_index = merge_blocks(blocks, writer.append)
+        print(f"Wrote {args.shards} shards and manifest {writer.manifest_path}")
+        print(f"Finished merging. Total valid embeddings in sharded store: {current_index}")
+        return
+
+    # Count the valid rows first so the output is resized once, not once per block.
+    valid_counts = count_valid_rows(input_files)
+    total_valid = sum(valid_counts)
+    print(f"Valid rows to copy: {total_valid}")
+    sys.stdout.flush()
+
     # Create the master file with unlimited rows.
+    start_time = time.time()
     with h5py.File(args.output_file, 'w') as master:
-        # Create the embeddings dataset.
-        emb_ds = master.create_dataset(
-            'embeddings',
-            shape=(0, n_cols),
-            maxshape=(None, n_cols),
-            dtype='float32',
-            chunks=(args.block_size, n_cols)  # Using block size for appending.
-        )
-        # Create the keys dataset with a chunk size of 1_000_000 for efficient reads.
-        dt = h5py.string_dtype(encoding='utf-8')
-        keys_ds = master.create_dataset(
-            'keys',
-            shape=(0,),
-            maxshape=(None,),
-            dtype=dt,
-            chunks=(1_000_000,)
-        )
-
-        current_index = 0
-
-        # Process each input file.
-        for infile in input_files:
-            print(f"Processing file: {infile}")
-            with h5py.File(infile, 'r') as f:
-                total_rows = f['embeddings'].shape[0]
-                # Process the file in blocks for memory efficiency.
-                for start in range(0, total_rows, args.block_size):
-                    end = min(start + args.block_size, total_rows)
-                    # Read keys in this block.
-                    keys_block = f['keys'][start:end]
-                    # Build a valid mask: exclude keys that are b'' or empty string.
-                    valid_mask = np.array([k != b'' and k != "" for k in keys_block])
-                    if not np.any(valid_mask):
-                        # Skip block if no valid entries.
-                        continue
-                    valid_indices = np.where(valid_mask)[0]
-                    # Read the corresponding embeddings.
-                    emb_block = f['embeddings'][start:end]
-                    valid_emb = emb_block[valid_indices, :]
-                    valid_keys = keys_block[valid_indices]
-
-                    n_valid = valid_emb.shape[0]
-                    # Extend the master datasets.
-                    new_total = current_index + n_valid
-                    emb_ds.resize((new_total, n_cols))
-                    keys_ds.resize((new_total,))
-                    # Append the valid entries.
-                    emb_ds[current_index:new_total, :] = valid_emb
-                    keys_ds[current_index:new_total] = valid_keys
-                    current_index = new_total
-
-                    print(f"  Processed rows {start} to {end}: added {n_valid} valid entries (total so far: {current_index})")
-                    sys.stdout.flush()
-
-        print(f"Finished merging. Total valid embeddings in master file: {current_index}")
+        # Chunks of block size for appending; keys chunks of 1_000_000 for efficient reads.
+        emb_ds, keys_ds = create_store_datasets(master, n_cols, emb_chunk_rows=args.block_size,
+                                                profile=args.storage_profile)
+        # Rows not reached if the merge dies keep empty keys, which readers skip.
+        resize_store(emb_ds, keys_ds, total_valid)
+
+        pos = 0
+
+        def write_next(keys, emb):
+            nonlocal pos
+            if pos + len(keys) > total_valid:
+                raise ValueError(f"Input files have more valid rows than counted ({total_valid}); were they modified?")
+            pos = write_rows(emb_ds, keys_ds, pos, emb, keys)
+            return pos
+
+        current_index = merge_blocks(blocks, write_next)
+        if current_index != total_valid:
+            raise ValueError(f"Copied {current_index} rows but counted {total_valid}; were the input files modified?")
+
+        elapsed = max(time.time() - start_time, 1e-9)
+        print(f"Finished merging. Total valid embeddings in master file: {current_index} "
+              f"({elapsed:.1f}[s], {current_index * n_cols * 4 / elapsed / 1024 ** 2:.1f} MB/s)")
 
 if __name__ == '__main__':
     main()
 
 # /usr/bin/time python merge_h5_big_to_final.py --input-files "/lisc/project/dome/protein_embeddings/GlobDB/embeddings/chlor_plus_part001.h5,/lisc/project/dome/protein_embeddings/GlobDB/embeddings/part002_embeddings.h5" --output-file /lisc/project/dome/protein_embeddings/GlobDB/embeddings/chlor_plus_part001and002.h5
+# /usr/bin/time python merge_h5_big_to_final.py --input-files "/lisc/project/dome/protein_embeddings/GlobDB/embeddings/chlor_plus_part001and002.h5" --output-file /lisc/project/dome/protein_embeddings/GlobDB/embeddings/sharded/GlobDB40.h5 --shards 16
@@ -5,6 +5,8 @@ import os
 import argparse
 import sys
 
+from embedding_store import DEFAULT_PROFILE, append_rows, create_store_datasets, read_embeddings
+
 def main():
     parser = argparse.ArgumentParser(
         description="Merge intermediate HDF5 files into one master file with unlimited rows."
@@ -17,6 +19,12 @@ def main():
         '--output-file', type=str, required=True,
         help="Path for the output master HDF5 file (e.g., 'master.h5')"
     )
+    parser.add_argument(
+        '--storage-profile', type=str, default=DEFAULT_PROFILE,
+        help="Precision and compression of the output embeddings: float32, float16 or int8 (per-row scale), "
+             "optionally followed by -shuffle and -gzip or -lzf, e.g. float16-shuffle-gzip "
+             "(default: float32, uncompressed)"
+    )
     args = parser.parse_args()
 
     # Find all intermediate files in the input directory.
@@ -31,35 +39,21 @@ def main():
     n_cols = emb_shape[1]
 
     print(f"Merging {len(intermediate_files)} files into {args.output_file}")
-    print(f"Creating master dataset with unlimited rows and {n_cols} columns")
+    print(f"Creating master dataset with unlimited rows and {n_cols} columns ({args.storage_profile})")
 
     # Create the master file and initialize datasets with 0 rows, but with an unlimited maxshape.
     with h5py.File(args.output_file, 'w') as master:
-        master_emb = master.create_dataset(
-            'embeddings', shape=(0, n_cols), maxshape=(None, n_cols),
-            dtype='float32', chunks=(10000, n_cols)# chunks are memory storage size
-        )
-        # Create dataset for keys using a variable-length UTF-8 string dtype.
-        dt = h5py.string_dtype(encoding='utf-8')
-        master_keys = master.create_dataset(
-            'keys', shape=(0,), maxshape=(None,), dtype=dt, chunks=(1_000_000,)
-        )
+        master_emb, master_keys = create_store_datasets(master, n_cols, profile=args.storage_profile)
 
         current_index = 0
         for file in intermediate_files:
             with h5py.File(file, 'r') as f:
-                emb_block = f['embeddings'][:]
+                emb_block = read_embeddings(f)
                 keys_block = f['keys'][:]
                 n_block = emb_block.shape[0]
 
                 # Extend the master datasets to accommodate the new block.
-                new_total = current_index + n_block
-                master_emb.resize((new_total, n_cols))
-                master_keys.resize((new_total,))
-                
-                master_emb[current_index:new_total, :] = emb_block
-                master_keys[current_index:new_total] = keys_block
-                current_index = new_total
+                current_index = append_rows(master_emb, master_keys, emb_block, keys_block)
 
                 print(f"Copied {n_block} embeddings from {file}")
                 sys.stdout.flush()
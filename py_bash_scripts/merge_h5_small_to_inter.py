@@ -6,11 +6,13 @@ import argparse
 from multiprocessing import Pool
 import sys
 
+from embedding_store import fill_mismatched_rows, per_key_format, per_key_names, read_per_key_block
+
 def process_group(args):
     """
     Process a group of HDF5 source files.
-    For each file, iterate over its keys (each embedding),
-    read the 1024-d float array, and store it along with its key.
+    For each file, list its keys (each embedding) and bulk read the
+    1024-d float arrays into the preallocated block, along with the keys.
     Finally, write an intermediate master file.
     """
     group_files, output_filename = args
@@ -28,20 +30,23 @@ def process_group(args):
     embeddings = np.empty((total_embeddings, 1024), dtype=np.float32)
     keys = []  # Will be converted to an array of strings later
 
-    # Second pass: read each embedding and key
+    # Second pass: bulk read each file's embeddings straight into its rows
     idx = 0
+    next_report = 1_000_000
     for fname in group_files:
         with h5py.File(fname, 'r') as f:
-            for key in f.keys():
-                data = f[key][:]
-                if data.shape != (1024,):
-                    raise ValueError(f"Unexpected shape for key {key} in file {fname}: {data.shape}")
-                embeddings[idx] = data
-                keys.append(key)
-                idx += 1
-                if idx % 1_000_000 == 0:
-                    print(f"Processed {idx} embeddings so far. Currently in file {fname}")
-                    sys.stdout.flush()
+            names = per_key_names(f)
+            rows = embeddings[idx:idx + len(names)]
+            _, dtype = per_key_format(f, names)
+            _, ok = read_per_key_block(f, names, 1024, dtype, out=rows)
+            if not ok.all():
+                fill_mismatched_rows(f, names, rows, ok, 1024)
+            keys.extend(name.decode('utf-8') for name in names)
+            idx += len(names)
+            if idx >= next_report:
+                print(f"Processed {idx} embeddings so far. Currently in file {fname}")
+                sys.stdout.flush()
+                next_report = idx + 1_000_000
 
     # Write the aggregated data to an intermediate file.
     with h5py.File(output_filename, 'w') as f_out:
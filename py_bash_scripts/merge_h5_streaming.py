@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Streaming k-way merge of per-task embedding files into one embeddings/keys store.
+
+Replaces merge_h5_small_to_inter.py followed by merge_h5_inter_to_big.py, which hold a
+whole group of embeddings in RAM and rewrite all the data twice. Here N reader processes
+each take input files from a shared list and stream them in blocks of rows over a bounded
+queue to this process, which appends every block straight to the final chunked store.
+Memory use is fixed by --memory-mb, whatever the number or size of the inputs.
+
+Inputs can be the per-key files written by prott5_embedder_globdb.py or files that
+already have the embeddings/keys layout (rows with empty keys are dropped). Rows are
+written in the order blocks arrive, so the order of the keys across files is not fixed.
+"""
+import argparse
+import glob
+import multiprocessing
+import queue
+import sys
+import time
+import traceback
+
+import h5py
+
+from embedding_store import (DEFAULT_PROFILE, EMB_CHUNK_ROWS, append_rows, create_store_datasets,
+                             is_store_layout, iter_embedding_blocks, per_key_format, per_key_names)
+
+
+def embedding_width(path):
+    """Width of the embeddings in one input file, in either layout."""
+    with h5py.File(path, 'r') as hf:
+        if is_store_layout(hf):
+            return hf['embeddings'].shape[1]
+        return per_key_format(hf, per_key_names(hf))[0]
+
+
+def plan_block_rows(memory_mb, n_readers, n_cols):
+    """
+    Rows per block so that all blocks in flight fit in the memory budget: up to 2 per
+    reader waiting in the queue, 1 being filled by each reader and 1 being written.
+    """
+    blocks_in_flight = 3 * n_readers + 1
+    row_bytes = 4 * n_cols
+    return max(1, (memory_mb * 1024 ** 2) // (blocks_in_flight * row_bytes))
+
+
+def _reader(input_files, next_file, block_rows, results):
+    """Reader process: stream every file it claims as (fname, keys, embeddings) blocks."""
+    try:
+        while True:
+            with next_file.get_lock():
+                i = next_file.value
+                next_file.value += 1
+            if i >= len(input_files):
+                break
+            fname = input_files[i]
+            for keys_block, emb_block in iter_embedding_blocks(fname, block_rows):
+                results.put((fname, keys_block, emb_block))
+            results.put((fname, None, None))
+        results.put(None)
+    except Exception:
+        results.put(traceback.format_exc())
+
+
+def merge_streaming(input_files, output_file, n_readers=4, memory_mb=4096,
+                    chunk_rows=EMB_CHUNK_ROWS, report_every=1_000_000, profile=DEFAULT_PROFILE):
+    """Merge input_files into a new store at output_file. Returns the number of rows written."""
+    n_cols = next((w for w in map(embedding_width, input_files) if w is not None), None)
+    if n_cols is None:
+        print("No embeddings found in the input files. Exiting.")
+        return 0
+    n_readers = max(1, min(n_readers, len(input_files)))
+    block_rows = plan_block_rows(memory_mb, n_readers, n_cols)
+    print(f"Merging {len(input_files)} files into {output_file} with {n_readers} readers")
+    print(f"Storage profile: {profile}")
+    print(f"Embedding width {n_cols}; blocks of {block_rows} rows within a {memory_mb} MB budget")
+    sys.stdout.flush()
+
+    ctx = multiprocessing.get_context('fork')
+    next_file = ctx.Value('l', 0)
+    results = ctx.Queue(maxsize=2 * n_readers)
+    readers = [ctx.Process(target=_reader, name=f"merge-r{r}", args=(input_files, next_file, block_rows, results))
+               for r in range(n_readers)]
+    for p in readers:
+        p.start()
+
+    start_time = time.time()
+    total_rows = 0
+    files_done = 0
+    next_report = report_every
+    try:
+        with h5py.File(output_file, 'w') as master:
+            emb_ds, keys_ds = create_store_datasets(master, n_cols, emb_chunk_rows=chunk_rows, profile=profile)
+            n_running = n_readers
+            while n_running:
+                try:
+                    item = results.get(timeout=10)
+                except queue.Empty:
+                    if any(p.exitcode not in (None, 0) for p in readers):
+                        raise RuntimeError(f"A reader process died: exit codes {[p.exitcode for p in readers]}")
+                    continue
+                if item is None:
+                    n_running -= 1
+                    continue
+                if isinstance(item, str):
+                    raise RuntimeError(f"Reader failed:\n{item}")
+                fname, keys_block, emb_block = item
+                if keys_block is None:
+                    files_done += 1
+                    continue
+                if emb_block.shape[1] != n_cols:
+                    raise ValueError(f"{fname} holds {emb_block.shape[1]}-d embeddings, expected {n_cols}")
+                total_rows = append_rows(emb_ds, keys_ds, emb_block, keys_block)
+                if total_rows >= next_report:
+                    elapsed = time.time() - start_time
+                    print(f"  {total_rows} rows from {files_done}/{len(input_files)} files in {elapsed:.0f}[s]: "
+                          f"{total_rows / elapsed:.0f} rows/s, {total_rows * n_cols * 4 / elapsed / 1024 ** 2:.1f} MB/s")
+                    sys.stdout.flush()
+                    next_report = total_rows + report_every
+    finally:
+        for p in readers:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+
+    elapsed = time.time() - start_time
+    print(f"Finished merging {files_done} files. Total embeddings in {output_file}: {total_rows}")
+    print(f"Total time: {elapsed:.1f}[s]; {total_rows / max(elapsed, 1e-9):.0f} rows/s, "
+          f"{total_rows * n_cols * 4 / max(elapsed, 1e-9) / 1024 ** 2:.1f} MB/s")
+    sys.stdout.flush()
+    return total_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream many HDF5 embedding files into one master file "
+                                                 "with bounded memory.",
+                                     allow_abbrev=False)
+    parser.add_argument('--input-patterns', type=str, required=True,
+                        help="Comma-separated glob patterns for source HDF5 files (e.g., 'embed_462*,embed_46330*')")
+    parser.add_argument('--output-file', type=str, required=True,
+                        help="Path for the output master HDF5 file (e.g., 'master.h5')")
+    parser.add_argument('--readers', type=int, default=4,
+                        help="Number of reader processes (default: 4)")
+    parser.add_argument('--memory-mb', type=int, default=4096,
+                        help="Memory budget for the embeddings in flight, in MB (default: 4096)")
+    parser.add_argument('--chunk-rows', type=int, default=EMB_CHUNK_ROWS,
+                        help=f"Rows per chunk of the output embeddings dataset (default: {EMB_CHUNK_ROWS})")
+    parser.add_argument('--storage-profile', type=str, default=DEFAULT_PROFILE,
+                        help="Precision and compression of the output embeddings, e.g. float16-shuffle-gzip "
+                             "(default: float32, uncompressed; see embedding_store.parse_storage_profile)")
+    parser.add_argument('--report-every', type=int, default=1_000_000,
+                        help="Print progress every this many rows (default: 1000000)")
+    args = parser.parse_args()
+
+    patterns = [p.strip() for p in args.input_patterns.split(',')]
+    input_files = []
+    for pattern in patterns:
+        input_files.extend(sorted(glob.glob(pattern)))
+
+    if not input_files:
+        print("No source files found. Exiting.")
+        return
+    print(f"Found {len(input_files)} files")
+
+    merge_streaming(input_files, args.output_file, args.readers, args.memory_mb,
+                    args.chunk_rows, args.report_every, args.storage_profile)
+
+
+if __name__ == '__main__':
+    main()
+
+# python /lisc/project/dome/protein_embeddings/py_bash_scripts/merge_h5_streaming.py --input-patterns "/lisc/scratch/dome/pullen/GlobDB/embeddings/embed_462*,/lisc/scratch/dome/pullen/GlobDB/embeddings/embed_46330*" --output-file $TMPDIR/master_embeddings.h5 --readers 4 --memory-mb 4096
@@ -10,6 +10,8 @@
 # for fasta in *.fasta; do time /lisc/project/dome/protein_embeddings/py_bash_scripts/part1chunking.sh -i "$fasta" ; done
 # 
 # Once you've decided by how many to split these FASTAs, you are ready for part2splitting.sh
+#
+# bin_fasta_by_length.py writes the same bins and stats in one pass over the .fai index.
 set -euo pipefail
 
 usage() {
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Plan embedding tasks of a fixed wall-clock budget directly from a FASTA and its .fai.
+
+Replaces calc_num_splits.py + part2splitting.sh + generate_array_tasks.sh. Those apply
+the time fit to the average length of each length bin and cut the bin into equal-count
+parts, so a part that happens to get the longer sequences of its bin runs over time,
+and the 0_99 bins needed extra parts by hand. Here every sequence gets its own cost from
+the time model,
+    seconds(L) = c_0 * L^d + ... + c_(d-1) * L + c_d     (--time-model c_0,...,c_d)
+by default the quadratic T4 fit from the README, and the sequences are packed greedily
+in file order (next fit) into tasks whose summed cost stays within
+    --budget * --safety - --task-overhead
+Each task wastes at most the cost of one sequence (about 1 second for 1000 residues), so
+tasks come out nearly full and their number is within a few of the lower bound
+total cost / capacity, which is printed alongside. calc_num_splits.py instead cut each
+length-sorted bin into floor(num_seqs / (3600 / seconds at the average length)) parts
+of equal count with no margin, so the parts holding the longer sequences of a bin ran
+over the hour while the shorter ones finished early, and 0_99 needed 2 extra parts by
+hand. Here every task is filled to the same estimated cost, so tasks differ only by the
+error of the model. The embedder sorts every task by length itself, so mixing lengths
+in one task costs nothing in padding.
+
+A task is a list of byte ranges of the FASTA rather than a file: one range per run of
+consecutive selected sequences. Every sequence left out by --min-length/--max-length
+between them starts a new range, so with --max-length 1000 on the whole GlobDB FASTA a
+task holds hundreds of ranges. To get one range per task, plan each length-filtered
+file written by bin_fasta_by_length.py instead (e.g. the 1000AAmax bins and the
+1001AAmin file), whose sequences are all selected. Since first_id and last_id do not say
+which sequences a task holds once ranges skip records, the planner also writes
+<manifest>.ids with one `task<TAB>ID` line per planned sequence, in file order.
+
+The estimates are only as good as the time model, which was fitted on a sample of
+lengths; the short 0_99 sequences, which needed extra parts by hand in the old flow, are
+where it is least tested, and this planner adds no such parts. Before retiring
+calc_num_splits.py, check the estimates against measured runtimes: the claims file of
+the persistent worker (<manifest>.claims) has the unix time a task was claimed and done,
+to compare with est_seconds, and --safety can be lowered or the model refitted if tasks
+run over.
+
+The manifest has one line per task, in the comma-separated style of valid_tasks4slurm.txt:
+    task,fasta,ranges,n_seqs,est_seconds,first_id,last_id
+ranges being half-open byte ranges start-end joined by ';', e.g.
+    000001,/lisc/.../clusters_more_than1.fasta,0-5314020,3954,3239.8,BCRBG_15609___2917,GCA_013288945___541
+Sequences outside --min-length/--max-length (e.g. those >1000 AAs, which go to the L40s
+with their own time model) are left out.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+from bin_fasta_by_length import byte_runs
+from fasta_index import VIRTUAL_MANIFEST_HEADER, FastaIndex, format_manifest_line
+
+# Seconds per protein vs length on a T4, see the README and calc_num_splits.py.
+DEFAULT_TIME_MODEL = "4.4562e-07,7.0125e-04,1.3098e-03"
+
+
+def ids_path(manifest_path):
+    """Sidecar listing the sequences of each task."""
+    return f"{manifest_path}.ids"
+
+
+def parse_time_model(spec):
+    """Polynomial coefficients, highest degree first, as for np.polyval."""
+    return np.array([float(c) for c in spec.split(',')], dtype=np.float64)
+
+
+def sequence_costs(lengths, time_model):
+    """Estimated seconds to embed each sequence."""
+    return np.polyval(time_model, lengths.astype(np.float64))
+
+
+def pack_next_fit(costs, capacity):
+    """
+    Task number of each item, filling tasks in order until the next item would exceed
+    capacity. An item costing more than capacity gets a task of its own.
+    """
+    task_of = np.empty(len(costs), dtype=np.int64)
+    cumulative = np.concatenate(([0.0], np.cumsum(costs)))
+    i = task = 0
+    while i < len(costs):
+        # last j with cumulative[j] - cumulative[i] <= capacity, taking at least one item
+        j = max(int(np.searchsorted(cumulative, cumulative[i] + capacity, side='right')) - 1, i + 1)
+        task_of[i:j] = task
+        i = j
+        task += 1
+    return task_of
+
+
+def plan_tasks(fasta_path, manifest_path, fai_path=None, time_model=DEFAULT_TIME_MODEL, budget=3600.0,
+               safety=0.9, task_overhead=60.0, min_length=0, max_length=None):
+    """Write the task manifest for fasta_path. Returns the estimated seconds of each task."""
+    start_time = time.time()
+    time_model = parse_time_model(time_model) if isinstance(time_model, str) else time_model
+    capacity = budget * safety - task_overhead
+    if capacity <= 0:
+        raise ValueError(f"No time left per task: budget {budget} * safety {safety} - overhead {task_overhead}")
+
+    with FastaIndex(fasta_path, fai_path) as fasta:
+        lengths = fasta.lengths
+        selected = lengths >= min_length
+        if max_length is not None:
+            selected &= lengths <= max_length
+        selected = np.flatnonzero(selected)
+        costs = sequence_costs(lengths[selected], time_model)
+        print(f"{len(selected)} of {len(fasta)} sequences in {fasta_path} selected (lengths from {fasta.source}), "
+              f"estimated {costs.sum() / 3600:.1f} hours in total")
+        n_oversized = int(np.count_nonzero(costs > capacity))
+        if n_oversized:
+            print(f"Warning: {n_oversized} sequences are estimated to take longer than a task "
+                  f"({capacity:.0f}[s]); each gets a task of its own")
+
+        task_of_selected = pack_next_fit(costs, capacity)
+        n_tasks = int(task_of_selected[-1]) + 1 if len(selected) else 0
+        task_of = np.full(len(fasta), -1, dtype=np.int64)
+        task_of[selected] = task_of_selected
+        task_seconds = np.bincount(task_of_selected, weights=costs, minlength=n_tasks)
+        task_seqs = np.bincount(task_of_selected, minlength=n_tasks)
+        # first and last selected record of each task
+        firsts = selected[np.searchsorted(task_of_selected, np.arange(n_tasks), side='left')]
+        lasts = selected[np.searchsorted(task_of_selected, np.arange(n_tasks), side='right') - 1]
+
+        ranges = [[] for _ in range(n_tasks)]
+        for task, start, end in byte_runs(fasta.records, task_of):
+            ranges[task].append((start, end))
+
+        # the IDs first, so a manifest always has its ID list next to it
+        ids_tmp_path = f"{ids_path(manifest_path)}.tmp{os.getpid()}"
+        with open(ids_tmp_path, 'w') as out:
+            for i, task in zip(selected.tolist(), task_of_selected.tolist()):
+                out.write(f"{task + 1:06d}\t{fasta.read_id(i)}\n")
+        os.replace(ids_tmp_path, ids_path(manifest_path))
+
+        tmp_path = f"{manifest_path}.tmp{os.getpid()}"
+        with open(tmp_path, 'w') as out:
+            out.write(VIRTUAL_MANIFEST_HEADER + '\n')
+            for task in range(n_tasks):
+                out.write(format_manifest_line(task + 1, fasta_path, ranges[task], task_seqs[task],
+                                               task_seconds[task] + task_overhead, fasta.read_id(firsts[task]),
+                                               fasta.read_id(lasts[task])))
+        os.replace(tmp_path, manifest_path)
+
+    total = task_seconds + task_overhead
+    if n_tasks:
+        print(f"Planned {n_tasks} tasks of at most {budget:.0f}[s] (packing to {capacity + task_overhead:.0f}[s] "
+              f"including {task_overhead:.0f}[s] overhead): estimated {total.mean():.0f}[s] on average, "
+              f"{total.min():.0f}-{total.max():.0f}[s], {total.sum() / (n_tasks * budget):.1%} of the booked time used")
+        n_ranges = np.array([len(r) for r in ranges])
+        print(f"Lower bound {int(np.ceil(task_seconds.sum() / capacity))} tasks; "
+              f"{n_ranges.mean():.1f} byte ranges per task on average, at most {n_ranges.max()}")
+    print(f"Wrote {manifest_path} and {ids_path(manifest_path)} in {time.time() - start_time:.1f}[s]")
+    sys.stdout.flush()
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack the sequences of a FASTA into embedding tasks of a fixed "
+                                                 "wall-clock budget, written as a manifest of byte ranges.",
+                                     allow_abbrev=False)
+    parser.add_argument('-i', '--input', type=str, required=True,
+                        help="FASTA file to plan")
+    parser.add_argument('-o', '--output', type=str, required=True,
+                        help="Task manifest to write")
+    parser.add_argument('--fai', type=str, default=None,
+                        help="Index of the input (default: <input>.fai; the FASTA is scanned if there is none)")
+    parser.add_argument('--time-model', type=str, default=DEFAULT_TIME_MODEL,
+                        help="Comma-separated polynomial coefficients of seconds per sequence vs length, "
+                             f"highest degree first (default: {DEFAULT_TIME_MODEL}, the T4 fit)")
+    parser.add_argument('--budget', type=float, default=3600,
+                        help="Wall-clock seconds per task (default: 3600)")
+    parser.add_argument('--safety', type=float, default=0.9,
+                        help="Fraction of the budget to fill, leaving room for the model being off (default: 0.9)")
+    parser.add_argument('--task-overhead', type=float, default=60,
+                        help="Seconds per task not spent embedding, e.g. loading the model (default: 60)")
+    parser.add_argument('--min-length', type=int, default=0,
+                        help="Only plan sequences at least this long (default: 0)")
+    parser.add_argument('--max-length', type=int, default=None,
+                        help="Only plan sequences at most this long, e.g. 1000 for the T4s (default: no limit)")
+    args = parser.parse_args()
+    plan_tasks(args.input, args.output, args.fai, args.time_model, args.budget, args.safety, args.task_overhead,
+               args.min_length, args.max_length)
+
+
+if __name__ == '__main__':
+    main()
+
+# python /lisc/project/dome/protein_embeddings/py_bash_scripts/plan_tasks.py -i /lisc/scratch/dome/pullen/GlobDB/linclust/clusters_more_than1.fasta -o /lisc/scratch/dome/pullen/GlobDB/linclust/tasks_T4.csv --max-length 1000
+# python /lisc/project/dome/protein_embeddings/py_bash_scripts/plan_tasks.py -i /lisc/scratch/dome/pullen/GlobDB/linclust/clusters_more_than1.fasta -o /lisc/scratch/dome/pullen/GlobDB/linclust/tasks_L40s.csv --min-length 1001 --budget 43200 --time-model <L40s fit>
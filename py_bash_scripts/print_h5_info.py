@@ -17,6 +17,8 @@ def print_h5_info(file_path):
             print("  Dataset 'embeddings':")
             print(f"    Shape: {ds.shape}")
             print(f"    Data type: {ds.dtype}")
+            print(f"    Storage profile: {ds.attrs.get('storage_profile', 'float32')}")
+            print(f"    Chunks: {ds.chunks}; compression: {ds.compression}; shuffle: {ds.shuffle}")
             # Estimate the in-memory size (uncompressed)
             est_size = ds.size * ds.dtype.itemsize
             print(f"    Estimated in-memory size: {est_size} bytes")
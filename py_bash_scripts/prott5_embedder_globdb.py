@@ -15,15 +15,45 @@ import logging
 from pathlib import Path
 import sys
 import fcntl
+import queue
+import threading
+import hashlib
+import multiprocessing
+import traceback
 
+import numpy as np
 import torch
 import h5py
 from transformers import T5EncoderModel, T5Tokenizer
 
+from fasta_index import FastaIndex, is_virtual_manifest, parse_byte_ranges, parse_manifest_task
+from embedding_store import EmbeddingStoreWriter
+from key_index import KeyIndex
+
 device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 print("Using device: {}".format(device))
 
-def get_T5_model(model_dir, transformer_link = "Rostlab/prot_t5_xl_half_uniref50-enc"):
+class AutocastEncoder(torch.nn.Module):
+    """Runs the encoder under CPU bfloat16 autocast and hands back float32 hidden states."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask=None):
+        with torch.autocast(device_type='cpu', dtype=torch.bfloat16):
+            embedding_repr = self.model(input_ids, attention_mask=attention_mask)
+        embedding_repr.last_hidden_state = embedding_repr.last_hidden_state.float()
+        return embedding_repr
+
+# --cpu_backend choices
+CPU_BACKENDS = ['fp32', 'bf16', 'int8']
+
+def get_T5_model(model_dir, transformer_link = "Rostlab/prot_t5_xl_half_uniref50-enc", cpu_backend='fp32'):
+    if cpu_backend not in CPU_BACKENDS:
+        raise ValueError(f"Unknown CPU backend: {cpu_backend}")
+    if device != torch.device("cpu") and cpu_backend != 'fp32':
+        raise ValueError(f"CPU backend '{cpu_backend}' only applies when running on CPU, but the device is {device}")
     print("Loading: {}".format(transformer_link))
     if model_dir is not None:
         print("##########################")
@@ -37,32 +67,16 @@ def get_T5_model(model_dir, transformer_link = "Rostlab/prot_t5_xl_half_uniref50
 
     model = model.to(device)
     model = model.eval()
+    if device==torch.device("cpu") and cpu_backend == 'bf16':
+        print("Running on CPU with bfloat16 autocast ...")
+        model = AutocastEncoder(model).eval()
+    elif device==torch.device("cpu") and cpu_backend == 'int8':
+        print("Quantizing linear layers to dynamic int8 for running on CPU ...")
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
     vocab = T5Tokenizer.from_pretrained(transformer_link, do_lower_case=False )
     return model, vocab
 
 
-def read_fasta( fasta_path ):
-    '''
-        Reads in fasta file containing multiple sequences.
-        Returns dictionary of holding multiple sequences or only single 
-        sequence, depending on input file.
-    '''
-    
-    sequences = dict()
-    with open( fasta_path, 'r' ) as fasta_f:
-        for line in fasta_f:
-            # get uniprot ID from header and create new entry
-            if line.startswith('>'):
-                uniprot_id = line.replace('>', '').strip()
-                # replace tokens that are mis-interpreted when loading h5
-                uniprot_id = uniprot_id.replace("/","_").replace(".","_")
-                sequences[ uniprot_id ] = ''
-            else:
-                # repl. all white-space chars and join seqs spanning multiple lines
-                sequences[ uniprot_id ] += ''.join( line.split() ).upper().replace("-","") # drop gaps and cast to upper-case
-                
-    return sequences
-
 def setup_logging(log_path, env_var_name='MY_SLURM_PROCESS_ID'):
     """Modify the global logging config"""
     # Get an env variable from SLURM
@@ -110,6 +124,525 @@ def read_processed_ids(master_emb_path):
         print(f"Prior embeddings problem - {e}. No prior proteins checked for this run.")
         return set()
 
+def load_processed_index(index_prefix):
+    """
+    Memory-map a sidecar published by key_index.py instead of reading the master's keys,
+    so no lock on the master is needed and only the pages we search are read.
+    """
+    processed_ids = KeyIndex(index_prefix)
+    print(f"Found {len(processed_ids)} previously processed proteins in index {index_prefix} (built from {processed_ids.meta['source']}).")
+    return processed_ids
+
+def is_processed(processed_ids, pdb_ids):
+    """One bool per ID, against either a set of IDs or a KeyIndex."""
+    if isinstance(processed_ids, KeyIndex):
+        return processed_ids.contains_many(pdb_ids).tolist()
+    return [pid in processed_ids for pid in pdb_ids]
+
+class PerKeyWriter:
+    """
+    Original output layout: one dataset per protein, named by its ID.
+    The file is reopened in append mode for every batch.
+    """
+
+    def __init__(self, emb_path):
+        self.emb_path = str(emb_path)
+
+    def write(self, keys, embeddings):
+        with h5py.File(self.emb_path, "a") as hf:
+            for identifier, emb in zip(keys, embeddings):
+                hf.create_dataset(identifier, data=emb)
+
+    def write_duplicates(self, keys, rep_keys, embeddings):
+        """Duplicates are hard links to the representative's dataset, so no data is stored twice."""
+        with h5py.File(self.emb_path, "a") as hf:
+            for identifier, rep_identifier in zip(keys, rep_keys):
+                hf[identifier] = hf[rep_identifier]
+
+    def close(self):
+        pass
+
+def open_output(emb_path, output_format, flush_rows):
+    """Writer for the requested output layout: 'per_key' datasets or the embeddings/keys 'store'."""
+    if output_format == 'per_key':
+        return PerKeyWriter(emb_path)
+    if output_format == 'store':
+        return EmbeddingStoreWriter(emb_path, flush_rows=flush_rows)
+    raise ValueError(f"Unknown output format: {output_format}")
+
+def plan_by_residues(lengths, max_residues, max_seq_len, max_batch, **kwargs):
+    """
+    Original batching rule. A batch is closed when it reaches max_batch sequences or
+    max_residues cumulative residues, or when a sequence longer than max_seq_len is added.
+    Yields (start, end) ranges into `lengths`.
+    """
+    n_seqs = len(lengths)
+    start = 0
+    n_res = 0
+    for seq_idx in range(n_seqs):
+        seq_len = int(lengths[seq_idx])
+        n_res += seq_len
+        # count residues in current batch and add the last sequence length to
+        # avoid that batches with (n_res_batch > max_residues) get processed 
+        n_res_batch = n_res + seq_len
+        if seq_idx + 1 - start >= max_batch or n_res_batch>=max_residues or seq_idx==n_seqs-1 or seq_len>max_seq_len:
+            yield start, seq_idx + 1
+            start = seq_idx + 1
+            n_res = 0
+
+def padded_cost(n_seqs, padded_len, attention_weight):
+    """
+    Cost of a batch in padded tokens: the tokenizer pads every sequence to the longest
+    one, and self-attention adds a term growing with the square of the padded length.
+    """
+    return n_seqs * padded_len * (1 + attention_weight * padded_len)
+
+def plan_by_padded_cost(lengths, max_padded_tokens, attention_weight, max_batch, **kwargs):
+    """
+    Greedily grow each batch while padded_cost stays within max_padded_tokens, so a batch
+    never holds more than max_padded_tokens tokens including padding. A single sequence over
+    the budget is still run on its own. Yields (start, end) ranges into `lengths`.
+    """
+    n_seqs = len(lengths)
+    start = 0
+    while start < n_seqs:
+        # +1 for the special token added at the end of each sequence
+        padded_len = int(lengths[start]) + 1
+        end = start + 1
+        while end < n_seqs and end - start < max_batch:
+            new_padded_len = max(padded_len, int(lengths[end]) + 1)
+            if padded_cost(end - start + 1, new_padded_len, attention_weight) > max_padded_tokens:
+                break
+            padded_len = new_padded_len
+            end += 1
+        yield start, end
+        start = end
+
+# --batch_planner choices
+BATCH_PLANNERS = {
+    'residues': plan_by_residues,
+    'padded': plan_by_padded_cost,
+}
+
+def normalise_sequence(seq):
+    """Map the rare amino acids U, Z and O to X, as the model sees them."""
+    return seq.replace('U','X').replace('Z','X').replace('O','X')
+
+class SequenceDeduplicator:
+    """
+    Find exact duplicates among the sequences that still need embedding, so that each
+    unique (normalised) sequence goes through the model once.
+
+    One sequential pass over the fasta hashes every sequence (128-bit BLAKE2b, 16 bytes
+    per record) and checks its ID against the processed IDs. Within each group of new
+    sequences with the same hash, the first in seq_order is the representative; the others
+    are dropped from the order and written from the representative's embedding.
+    """
+
+    HASH_DTYPE = np.dtype([('hi', '<u8'), ('lo', '<u8')])
+
+    def __init__(self, fasta, seq_order, processed_ids, chunk_size=100_000):
+        self.fasta = fasta
+        n_seqs = len(fasta)
+        digests = np.empty(n_seqs, dtype=self.HASH_DTYPE)
+        processed = np.zeros(n_seqs, dtype=bool)
+        ids = []
+        for record, (pdb_id, seq) in enumerate(fasta.iter_records()):
+            digests[record] = np.frombuffer(
+                hashlib.blake2b(normalise_sequence(seq).encode('ascii'), digest_size=16).digest(),
+                dtype=self.HASH_DTYPE)[0]
+            ids.append(pdb_id)
+            if len(ids) == chunk_size or record == n_seqs - 1:
+                processed[record + 1 - len(ids):record + 1] = is_processed(processed_ids, ids)
+                ids = []
+
+        # positions in seq_order of the new sequences, and of their representative
+        new_pos = np.flatnonzero(~processed[seq_order])
+        _, first, inverse = np.unique(digests[seq_order[new_pos]], return_index=True, return_inverse=True)
+        rep_pos = new_pos[first[inverse.ravel()]]
+        is_dup = rep_pos != new_pos
+
+        keep = np.ones(len(seq_order), dtype=bool)
+        keep[new_pos[is_dup]] = False
+        self.order = seq_order[keep]
+        self.n_new = len(new_pos)
+        self.n_unique = len(first)
+
+        # rep record -> its duplicate records, only for sequences that have duplicates
+        dup_records = seq_order[new_pos[is_dup]]
+        dup_reps = seq_order[rep_pos[is_dup]]
+        by_rep = np.argsort(dup_reps, kind='stable')
+        reps, starts = np.unique(dup_reps[by_rep], return_index=True)
+        self.duplicates = dict(zip(reps.tolist(), np.split(dup_records[by_rep], starts[1:])))
+
+    @property
+    def n_duplicates(self):
+        return self.n_new - self.n_unique
+
+    def duplicates_of(self, record):
+        """[(pdb_id, seq_len)] of the duplicates of representative record number `record`."""
+        dups = self.duplicates.get(record)
+        if dups is None:
+            return []
+        return [(pdb_id, len(seq)) for pdb_id, seq in self.fasta.iter_records(dups)]
+
+def batch_generator(fasta, seq_order, planner, **planner_args):
+    """
+    Plan batches on the lengths in the index, then stream each batch's sequences from disk
+    and yield it as a list of (pdb_id, seq, seq_len, record), where seq has rare amino acids
+    mapped to X and is space-separated for the tokenizer.
+    """
+    lengths = fasta.lengths[seq_order]
+    for start, end in planner(lengths, **planner_args):
+        batch = list()
+        records = seq_order[start:end]
+        for record, (pdb_id, seq) in zip(records.tolist(), fasta.iter_records(records)):
+            seq = normalise_sequence(seq)
+            seq_len = len(seq)
+            seq = ' '.join(list(seq))
+            batch.append((pdb_id,seq,seq_len,record))
+        yield batch
+
+def prepare_batches(batches, processed_ids, vocab, dedup=None, worker=None):
+    """
+    Producer stage: number the batches, drop already processed IDs and tokenize the
+    new sequences. Yields one dict per batch which is then filled in by embed_batch
+    and consumed (and logged) by write_batch. With a SequenceDeduplicator, the IDs of
+    each new sequence's duplicates are attached as well. With --workers, batches are
+    numbered per worker, e.g. 12/w3.
+    """
+    for batch_count, batch in enumerate(batches, 1):
+        if worker is not None:
+            batch_count = f"{batch_count}/w{worker}"
+        t0 = time.time()
+        # Unpack the current batch
+        pdb_ids, seqs, seq_lens, records = zip(*batch)
+
+        # Filter out sequences that have already been processed
+        done = is_processed(processed_ids, pdb_ids)
+        to_process = [(pid, seq, s_len, rec) for pid, seq, s_len, rec, d in zip(pdb_ids, seqs, seq_lens, records, done) if not d]
+
+        item = {
+            'batch_count': batch_count,
+            # Calculate total batch length using all sequences in the batch (for logging)
+            # should be lower than max_residues
+            'total_batch_length': sum(seq_lens),
+            # (pid, s_len, status) for the log, status becomes FAIL if a protein cannot be embedded
+            'ids_status': [(pid, s_len, 'EXISTING' if d else 'NEW')
+                           for pid, s_len, d in zip(pdb_ids, seq_lens, done)],
+            'proc_ids': (),
+            'proc_seq_lens': (),
+            'duplicates': {}, # pid -> [(dup_pid, dup_len)] of identical sequences to write from its embedding
+            'padded_tokens': 0,
+            'token_encoding': None,
+            'embeddings': None,
+            'retries': 0,
+            'timings': {'prepare': 0.0, 'model': 0.0, 'write': 0.0},
+        }
+
+        if to_process:
+            # These are the new sequences that need processing
+            proc_ids, proc_seqs, proc_seq_lens, proc_records = zip(*to_process)
+            if dedup is not None:
+                for pid, rec in zip(proc_ids, proc_records):
+                    dups = dedup.duplicates_of(rec)
+                    if dups:
+                        item['duplicates'][pid] = dups
+            token_encoding = vocab( proc_seqs, add_special_tokens=True, padding="longest", return_tensors="pt")
+            if device.type == 'cuda':
+                # page-locked host memory lets the copy to the GPU run asynchronously
+                token_encoding = {k: v.pin_memory() for k, v in token_encoding.items()}
+            item['proc_ids'] = proc_ids
+            item['proc_seq_lens'] = proc_seq_lens
+            item['padded_tokens'] = token_encoding['input_ids'].numel()
+            item['token_encoding'] = token_encoding
+
+        item['timings']['prepare'] = time.time() - t0
+        yield item
+
+def forward_pass(model, input_ids, attention_mask, seq_lens, per_protein):
+    """
+    Embed one (sub-)batch and return one host numpy array per sequence.
+    Raises RuntimeError (usually OOM) from the model.
+    """
+    with torch.no_grad():
+        embedding_repr = model(input_ids, attention_mask=attention_mask)
+
+    # batch-size x seq_len x embedding_dim
+    # extra token is added at the end of the seq
+    embeddings = []
+    for batch_idx, s_len in enumerate(seq_lens):
+        # slice-off padded/special tokens
+        emb = embedding_repr.last_hidden_state[batch_idx,:s_len]
+        if per_protein:
+            emb = emb.mean(dim=0)
+        embeddings.append(emb)
+    if per_protein:
+        # a single device-to-host copy for the whole batch
+        return list(torch.stack(embeddings).detach().cpu().numpy())
+    return [emb.detach().cpu().numpy().squeeze() for emb in embeddings]
+
+def forward_with_bisection(model, input_ids, attention_mask, seq_lens, per_protein):
+    """
+    Run forward_pass and, if it raises a RuntimeError, split the rows into halves and retry
+    each of them, recursively down to single sequences. Sub-batches are trimmed to their own
+    longest sequence and the CUDA cache is cleared between attempts.
+    Returns (embeddings with None for every sequence that failed on its own, number of retries).
+    """
+    embeddings = [None] * len(seq_lens)
+    retries = 0
+    pending = [(0, len(seq_lens))] # row ranges still to embed, processed depth-first
+    while pending:
+        lo, hi = pending.pop()
+        sub_mask = attention_mask[lo:hi]
+        width = int(sub_mask.sum(dim=1).max())
+        failed = False
+        try:
+            embeddings[lo:hi] = forward_pass(model, input_ids[lo:hi, :width], sub_mask[:, :width],
+                                             seq_lens[lo:hi], per_protein)
+        except RuntimeError:
+            # handled outside the except block so the traceback no longer holds on to GPU memory
+            failed = True
+        if not failed:
+            continue
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+        if hi - lo > 1:
+            mid = (lo + hi) // 2
+            pending.append((mid, hi))
+            pending.append((lo, mid))
+            retries += 2
+    return embeddings, retries
+
+def embed_batch(item, model, per_protein):
+    """
+    Model stage: run the forward pass and copy the (pooled) embeddings to host memory.
+    On a RuntimeError (usually OOM) the batch is bisected and retried, so only proteins
+    which fail on their own are left without an embedding (None).
+    """
+    if item['token_encoding'] is None:
+        return item
+    t0 = time.time()
+    proc_ids, proc_seq_lens = item['proc_ids'], item['proc_seq_lens']
+    input_ids      = item['token_encoding']['input_ids'].to(device, non_blocking=True)
+    attention_mask = item['token_encoding']['attention_mask'].to(device, non_blocking=True)
+    item['token_encoding'] = None
+
+    embeddings, retries = forward_with_bisection(model, input_ids, attention_mask, proc_seq_lens, per_protein)
+    item['embeddings'] = embeddings
+    item['retries'] = retries
+    for pid, s_len, emb in zip(proc_ids, proc_seq_lens, embeddings):
+        if emb is None:
+            # This will go to the .out file and indicates each protein that failed on its own
+            print("Batch {} with total batch length {} RuntimeError during embedding for {} (Length={} AAs) even as a single sequence. ".format(item['batch_count'], item['total_batch_length'], pid, s_len) +
+                  "You need more vRAM to process your protein.")
+    if retries:
+        sys.stdout.flush()
+    item['timings']['model'] = time.time() - t0
+    return item
+
+def write_batch(item, writer):
+    """
+    Writer stage: save the new embeddings and log the batch so that every protein has
+    either NEW, EXISTING or FAIL in the log file.
+    Returns the number of embeddings written.
+    """
+    batch_count = item['batch_count']
+    proc_ids = item['proc_ids']
+    duplicates = item['duplicates']
+    failed = set()
+    log_tail = ""
+    item['n_duplicates'] = 0
+
+    if proc_ids:
+        done = [(pid, emb) for pid, emb in zip(proc_ids, item['embeddings']) if emb is not None]
+        failed = set(proc_ids) - set(pid for pid, _ in done)
+        if done:
+            t0 = time.time()
+            done_ids, done_embs = zip(*done)
+            writer.write(done_ids, done_embs)
+            dup_rows = [(dup_pid, pid, emb) for pid, emb in done for dup_pid, _ in duplicates.get(pid, [])]
+            if dup_rows:
+                dup_ids, rep_ids, dup_embs = zip(*dup_rows)
+                writer.write_duplicates(dup_ids, rep_ids, dup_embs)
+                item['n_duplicates'] = len(dup_rows)
+            item['timings']['write'] = time.time() - t0
+        if item['retries']:
+            log_tail += (f"Batch {batch_count}: RuntimeError, retried as {item['retries']} smaller sub-batches. "
+                         f"{len(failed)} proteins failed on their own.\n")
+        if failed:
+            log_tail += f"FAIL: {len(failed)} proteins of batch {batch_count} encountered RuntimeError and will be skipped.\n"
+        # Append the completion details to the log message after processing each batch
+        log_tail += f"Completed batch {batch_count}: Processed {len(proc_ids) - len(failed)} new sequences.\n"
+
+    all_ids_status = "\n".join(
+        f"Batch {batch_count}: {'FAIL' if pid in failed else status} - {pid} (L={s_len})"
+        for pid, s_len, status in item['ids_status']
+    )
+    if duplicates:
+        # duplicates share the fate of the sequence they were deduplicated against
+        all_ids_status += "".join(
+            f"\nBatch {batch_count}: {'FAIL' if pid in failed else 'NEW'} - {dup_pid} (L={dup_len}) duplicate of {pid}"
+            for pid, dups in duplicates.items() for dup_pid, dup_len in dups
+        )
+    n_previous = len(item['ids_status']) - len(proc_ids)
+    log_message = (
+        f"Batch {batch_count}: Total batch length: {item['total_batch_length']}, "
+        f"{len(proc_ids)} new sequences, {n_previous} previous sequences.\n"
+    )
+    if item['padded_tokens']:
+        # share of the tokenized batch that is padding (+1 for the special token per sequence)
+        real_tokens = sum(item['proc_seq_lens']) + len(proc_ids)
+        padding_ratio = 1 - real_tokens / item['padded_tokens']
+        log_message += f"Batch {batch_count}: Padded tokens: {item['padded_tokens']}, padding ratio: {padding_ratio:.3f}\n"
+    log_message += f"IDs:\n{all_ids_status}\n"
+
+    # If no new sequences needed processing, this is just the batch summary
+    logging.info(log_message + log_tail)
+    return len(proc_ids) - len(failed) + item['n_duplicates']
+
+def account_batch(item, n_written, run_stats):
+    """Add a written batch to the run totals."""
+    run_stats['batches'] += 1
+    run_stats['embeddings'] += n_written
+    run_stats['duplicates'] += item['n_duplicates']
+    for stage, t in item['timings'].items():
+        run_stats[stage] += t
+
+def _put(q, item, stop):
+    """Put into a bounded queue, giving up if another stage has stopped the pipeline."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def run_pipelined(items, model, per_protein, writer, depth, run_stats):
+    """
+    Run the three stages concurrently: a producer thread prepares and tokenizes the next
+    batches, the main thread runs the model and a writer thread does the HDF5 writes.
+    The stages are connected by queues holding at most `depth` batches each, which bounds
+    the extra host memory. Totals are added to run_stats by the writer thread.
+    """
+    to_model = queue.Queue(maxsize=depth)
+    to_writer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    errors = []
+
+    def producer():
+        try:
+            for item in items:
+                if not _put(to_model, item, stop):
+                    return
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            _put(to_model, None, stop)
+
+    def consumer():
+        while True:
+            item = to_writer.get()
+            if item is None:
+                return
+            if errors:
+                # keep draining so the model stage never blocks on a full queue
+                continue
+            try:
+                account_batch(item, write_batch(item, writer), run_stats)
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+
+    producer_thread = threading.Thread(target=producer, name="producer", daemon=True)
+    writer_thread = threading.Thread(target=consumer, name="writer", daemon=True)
+    producer_thread.start()
+    writer_thread.start()
+    try:
+        while not stop.is_set():
+            # wake up regularly: once the writer stops the pipeline, the producer may give up
+            # before its None sentinel fits in the queue
+            try:
+                item = to_model.get(timeout=1)
+            except queue.Empty:
+                continue
+            if item is None:
+                break
+            if not _put(to_writer, embed_batch(item, model, per_protein), stop):
+                break
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        to_writer.put(None)
+        writer_thread.join()
+        stop.set()
+        producer_thread.join()
+
+    if errors:
+        raise errors[0]
+
+def _cpu_worker(worker, n_threads, shard_order, fasta, model, vocab, processed_ids, deduplicator,
+                per_protein, planner, planner_args, results):
+    """
+    Body of one --workers process, forked after the model was loaded: prepare and embed
+    the batches of one shard and send them to the parent, which does all the writing.
+    """
+    try:
+        torch.set_num_threads(n_threads)
+        batches = batch_generator(fasta, shard_order, planner, **planner_args)
+        for item in prepare_batches(batches, processed_ids, vocab, deduplicator, worker):
+            results.put(embed_batch(item, model, per_protein))
+        results.put(None)
+    except BaseException:
+        results.put(traceback.format_exc())
+
+def run_workers(n_workers, seq_order, fasta, model, vocab, processed_ids, deduplicator,
+                per_protein, planner, planner_args, writer, run_stats):
+    """
+    Multi-process CPU inference. The model weights are moved to shared memory and N
+    processes are forked, each with its own share of the CPU threads. Shards are taken
+    round-robin from the length-sorted order, so every worker gets a similar mix of lengths.
+    Embedded batches come back over a queue and are written here, into the one output.
+    """
+    n_cpus = len(os.sched_getaffinity(0))
+    n_threads = max(1, n_cpus // n_workers)
+    print("Running {} CPU workers with {} threads each ({} CPUs available)".format(n_workers, n_threads, n_cpus))
+    sys.stdout.flush()
+
+    model.share_memory()
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue(maxsize=4 * n_workers)
+    workers = [
+        ctx.Process(target=_cpu_worker, name=f"embedder-w{w}",
+                    args=(w, n_threads, seq_order[w::n_workers], fasta, model, vocab, processed_ids,
+                          deduplicator, per_protein, planner, planner_args, results))
+        for w in range(n_workers)
+    ]
+    for p in workers:
+        p.start()
+    try:
+        n_running = n_workers
+        while n_running:
+            try:
+                item = results.get(timeout=10)
+            except queue.Empty:
+                if any(p.exitcode not in (None, 0) for p in workers):
+                    raise RuntimeError("A worker process died: exit codes {}".format([p.exitcode for p in workers]))
+                continue
+            if item is None:
+                n_running -= 1
+            elif isinstance(item, str):
+                raise RuntimeError("Worker failed:\n{}".format(item))
+            else:
+                account_batch(item, write_batch(item, writer), run_stats)
+    finally:
+        for p in workers:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+
 def get_embeddings(seq_path, 
                    emb_path, 
                    model_dir,
@@ -117,34 +650,60 @@ def get_embeddings(seq_path,
                    per_protein, # whether to derive per-protein (mean-pooled) embeddings
                    max_residues=4000, # number of cumulative residues per batch
                    max_seq_len=1000, # max length after which we switch to single-sequence processing to avoid OOM
-                   max_batch=100 # max number of sequences per single batch
+                   max_batch=100, # max number of sequences per single batch
+                   batch_planner='residues', # 'residues' (cumulative residues) or 'padded' (padded token cost model)
+                   max_padded_tokens=16000, # budget of padded tokens per batch for the 'padded' planner
+                   attention_weight=1/2048, # weight of the quadratic attention term in the 'padded' cost model
+                   processed_index=None, # key_index.py sidecar to check instead of reading master_emb_path
+                   fai_path=None, # .fai index of seq_path, otherwise <seq_path>.fai or a single scan of the fasta
+                   byte_ranges=None, # [(start, end)] of seq_path to embed (a virtual shard), scanned instead of any .fai
+                   pipeline_depth=0, # >0 overlaps tokenization, forward pass and writing with queues of this many batches
+                   output_format='per_key', # 'per_key' datasets or the contiguous embeddings/keys 'store'
+                   flush_rows=10000, # rows buffered before each append when output_format='store'
+                   dedup=False, # embed identical sequences once and write the other IDs from that embedding
+                   workers=1, # >1 forks this many CPU inference processes over length-balanced shards
+                   transformer_link="Rostlab/prot_t5_xl_half_uniref50-enc",
+                   cpu_backend='fp32', # 'fp32', 'bf16' autocast or dynamic 'int8' when running on CPU
+                   model_vocab=None, # already loaded (model, vocab), e.g. from a persistent task worker
+                   processed_ids=None # already loaded processed IDs (set or KeyIndex)
                    ):
     
-    seq_dict = dict()
-
-    # Read in fasta
-    seq_dict = read_fasta( seq_path )
-    model, vocab = get_T5_model(model_dir)
+    # Index the fasta: only a compact (start, end, length) table is held in memory
+    # and sequences are read from disk batch by batch in order of decreasing length
+    if output_format == 'store' and not per_protein:
+        raise ValueError("The embeddings/keys store holds one vector per protein, so it needs per_protein embeddings")
+    if workers > 1 and device.type != 'cpu':
+        raise ValueError("--workers is for CPU-only nodes, on a GPU use --pipeline_depth instead")
+    fasta = FastaIndex(seq_path, fai_path, byte_ranges)
+    if model_vocab is None:
+        model_vocab = get_T5_model(model_dir, transformer_link, cpu_backend)
+    model, vocab = model_vocab
 
-#    print('########################################')
-#    print('Example sequence: {}\n{}'.format( next(iter(
-#            seq_dict.keys())), next(iter(seq_dict.values()))) )
-#    print('########################################')
-    print('Total number of sequences: {}'.format(len(seq_dict)))
+    n_seqs = len(fasta)
+    print('Total number of sequences: {} (table built from {})'.format(n_seqs, fasta.source))
+    if n_seqs == 0:
+        print("No sequences found in {}".format(seq_path))
+        fasta.close()
+        return False
 
-    avg_length = sum([ len(seq) for _, seq in seq_dict.items()]) / len(seq_dict)
-    n_long     = sum([ 1 for _, seq in seq_dict.items() if len(seq)>max_seq_len])
-    seq_dict   = sorted( seq_dict.items(), key=lambda kv: len( seq_dict[kv[0]] ), reverse=True )
+    avg_length = float(fasta.lengths.mean())
+    n_long     = int((fasta.lengths > max_seq_len).sum())
+    seq_order  = fasta.order_by_length(descending=True)
     
     print("Average sequence length: {}".format(avg_length))
     print("Number of sequences >{}: {}".format(max_seq_len, n_long))
 
-    # Initialize counters
-    batch_count = 0 # Batches for logging
-    new_embeddings_count = 0  # How many new embeddings were processed
+    # Initialize counters: batches for logging, new embeddings written (including duplicates),
+    # of which copied/linked from an identical sequence, and summed seconds spent in each stage
+    run_stats = {'batches': 0, 'embeddings': 0, 'duplicates': 0, 'prepare': 0.0, 'model': 0.0, 'write': 0.0}
 
-    # Checkpointing - Open the 'master' H5 file to get the already processed IDs
-    processed_ids = read_processed_ids(master_emb_path)
+    # Checkpointing - Open the 'master' H5 file (or its published key index) to get the already processed IDs
+    if processed_ids is not None:
+        print(f"Using {len(processed_ids)} previously processed proteins loaded before.")
+    elif processed_index is not None:
+        processed_ids = load_processed_index(processed_index)
+    else:
+        processed_ids = read_processed_ids(master_emb_path)
 
     # Here we flush all the prior print statements to stdout so we can check that sth is happening
     # Otherwise this gets held in a buffer until job completion which is not very helpful
@@ -152,102 +711,263 @@ def get_embeddings(seq_path,
 
     logging.info("=========FOR LOOP STARTING============")
     start = time.time()
-    batch = list()
-    for seq_idx, (pdb_id, seq) in enumerate(seq_dict,1):
-        seq = seq.replace('U','X').replace('Z','X').replace('O','X')
-        seq_len = len(seq)
-        seq = ' '.join(list(seq))
-        batch.append((pdb_id,seq,seq_len))
-
-        # count residues in current batch and add the last sequence length to
-        # avoid that batches with (n_res_batch > max_residues) get processed 
-        n_res_batch = sum([ s_len for  _, _, s_len in batch ]) + seq_len 
-        if len(batch) >= max_batch or n_res_batch>=max_residues or seq_idx==len(seq_dict) or seq_len>max_seq_len:
-            # Unpack the current batch
-            pdb_ids, seqs, seq_lens = zip(*batch)
-            batch = list()
-            batch_count += 1
-
-            # Filter out sequences that have already been processed
-            to_process = [(pid, seq, s_len) for pid, seq, s_len in zip(pdb_ids, seqs, seq_lens) if pid not in processed_ids]
-    
-            # Calculate total batch length using all sequences in the batch (for logging)
-            # should be lower than max_residues
-            total_batch_length = sum(seq_lens)
-            all_ids_status = "\n".join(
-                f"Batch {batch_count}: {'NEW' if pid not in processed_ids else 'EXISTING'} - {pid} (L={s_len})"
-                for pid, s_len in zip(pdb_ids, seq_lens)
-            )
-
-            log_message = (
-                f"Batch {batch_count}: Total batch length: {total_batch_length}, "
-                f"{len(to_process)} new sequences, {len(pdb_ids) - len(to_process)} previous sequences.\n"
-                f"IDs:\n{all_ids_status}\n"
-            )
-
-            # If no new sequences need processing, log the batch summary anyway and skip any computation
-            if not to_process:
-                logging.info(log_message)
-                continue
-    
-            # These are the new sequences that need processing
-            proc_ids, proc_seqs, proc_seq_lens = zip(*to_process)
-
-            token_encoding = vocab( proc_seqs, add_special_tokens=True, padding="longest", return_tensors="pt")
-            input_ids      = token_encoding['input_ids'].to(device)
-            attention_mask = token_encoding['attention_mask'].to(device)
-            
-            try:
-                with torch.no_grad():
-                    embedding_repr = model(input_ids, attention_mask=attention_mask)
-            except RuntimeError:
-                # We record which batch failed and (all) its constituent proteins
-                all_ids_status_fail = "\n".join(
-                    f"Batch {batch_count}: FAIL - {pid} (L={s_len})"
-                    for pid, s_len in zip(proc_ids, proc_seq_lens)
-                )
-                log_message = (
-                    f"Batch {batch_count}: Total batch length: {total_batch_length}, "
-                    f"{len(to_process)} new sequences, {len(pdb_ids) - len(to_process)} previous sequences.\n"
-                    f"IDs:\n{all_ids_status_fail}\n"
-                    f"FAIL: Batch {batch_count} encountered RuntimeError and will be skipped.\n"
-                )
-                # Save FAILs to log as well so that all proteins will have either NEW, EXISTING or FAIL in the log file
-                logging.info(log_message)
-                # This will go to the .out file and should indicate the last protein in the batch that failed 
-                print("Batch {} with total batch length {} RuntimeError during embedding for {} (Length={} AAs). Try lowering batch size. ".format(batch_count, total_batch_length, proc_ids[-1], proc_seq_lens[-1]) +
-                      "If single sequence processing does not work, you need more vRAM to process your protein.")
-                sys.stdout.flush()
-                continue
-
-            # batch-size x seq_len x embedding_dim
-            # extra token is added at the end of the seq
-            with h5py.File(str(emb_path), "a") as hf:
-                for batch_idx, identifier in enumerate(proc_ids):
-                    s_len = proc_seq_lens[batch_idx]
-                    # slice-off padded/special tokens
-                    emb = embedding_repr.last_hidden_state[batch_idx,:s_len]
-                    
-                    if per_protein:
-                        emb = emb.mean(dim=0)
-                
-                    hf.create_dataset(identifier, data=emb.detach().cpu().numpy().squeeze())
-                    new_embeddings_count += 1
-                    #print("new_embeddings_count=", new_embeddings_count)
-
-            # Append the completion details to the log message after processing each batch
-            log_message += f"Completed batch {batch_count}: Processed {len(proc_ids)} new sequences.\n"
-            logging.info(log_message)
+    deduplicator = None
+    if dedup:
+        deduplicator = SequenceDeduplicator(fasta, seq_order, processed_ids)
+        seq_order = deduplicator.order
+        print("Deduplication: {} new sequences, {} unique, {} duplicates will not be embedded again ({:.2f}[s])".format(
+                deduplicator.n_new, deduplicator.n_unique, deduplicator.n_duplicates, time.time()-start))
+        sys.stdout.flush()
+    print("Batch planner: {}".format(batch_planner))
+    planner = BATCH_PLANNERS[batch_planner]
+    planner_args = dict(max_residues=max_residues, max_seq_len=max_seq_len, max_batch=max_batch,
+                        max_padded_tokens=max_padded_tokens, attention_weight=attention_weight)
+    batches = batch_generator(fasta, seq_order, planner, **planner_args)
+    items = prepare_batches(batches, processed_ids, vocab, deduplicator)
+    writer = open_output(emb_path, output_format, flush_rows)
+    try:
+        if workers > 1:
+            run_workers(workers, seq_order, fasta, model, vocab, processed_ids, deduplicator,
+                        per_protein, planner, planner_args, writer, run_stats)
+        elif pipeline_depth > 0:
+            print("Running pipelined with queue depth {}".format(pipeline_depth))
+            sys.stdout.flush()
+            run_pipelined(items, model, per_protein, writer, pipeline_depth, run_stats)
+        else:
+            for item in items:
+                account_batch(item, write_batch(embed_batch(item, model, per_protein), writer), run_stats)
+    finally:
+        # write out whatever is still buffered, also when stopping on an error
+        writer.close()
 
     end = time.time()
+    fasta.close()
 
+    batch_count = run_stats['batches']
+    new_embeddings_count = run_stats['embeddings']
     print('\n############# OVERALL STATS #############')
     print('Total new embeddings processed in this run: {}'.format(new_embeddings_count))
+    if deduplicator is not None:
+        # dedup ratio: share of the new sequences that did not need a forward pass
+        print('Deduplicated embeddings written from identical sequences: {}; dedup ratio: {:.4f}'.format(
+                run_stats['duplicates'], deduplicator.n_duplicates / deduplicator.n_new if deduplicator.n_new else 0))
     print('Total time: {:.2f}[s]; time/prot: {:.4f}[s]; avg. len of all proteins= {:.2f}'.format( 
             end-start, (end-start)/new_embeddings_count if new_embeddings_count > 0 else 0, avg_length))
+    if batch_count > 0:
+        # With pipelining the wall time per batch should approach the slowest stage rather than their sum
+        print('Batches: {}; wall time/batch: {:.4f}[s]; prepare/batch: {:.4f}[s]; model/batch: {:.4f}[s]; write/batch: {:.4f}[s]'.format(
+                batch_count, (end-start)/batch_count, *(run_stats[s]/batch_count for s in ('prepare', 'model', 'write'))))
     return True
 
 
+def embed_sample(fasta, seq_order, model, vocab, **planner_args):
+    """Embed the given records per protein in memory, returning ({pdb_id: embedding}, seconds)."""
+    start = time.time()
+    embeddings = {}
+    batches = batch_generator(fasta, seq_order, plan_by_residues, **planner_args)
+    for item in prepare_batches(batches, set(), vocab):
+        item = embed_batch(item, model, per_protein=True)
+        for pid, emb in zip(item['proc_ids'], item['embeddings']):
+            if emb is not None:
+                embeddings[pid] = emb
+    return embeddings, time.time() - start
+
+def embedding_metrics(ref, test):
+    """Row-wise cosine similarity, Pearson correlation and MSE between two (n, d) arrays."""
+    ref = np.asarray(ref, dtype=np.float64)
+    test = np.asarray(test, dtype=np.float64)
+    cos_sim = (ref * test).sum(axis=1) / (np.linalg.norm(ref, axis=1) * np.linalg.norm(test, axis=1))
+    ref_c = ref - ref.mean(axis=1, keepdims=True)
+    test_c = test - test.mean(axis=1, keepdims=True)
+    pearson_corr = (ref_c * test_c).sum(axis=1) / (np.linalg.norm(ref_c, axis=1) * np.linalg.norm(test_c, axis=1))
+    mse = ((ref - test) ** 2).mean(axis=1)
+    return {'cosine': cos_sim, 'pearson': pearson_corr, 'mse': mse}
+
+def backend_accuracy_report(seq_path, model_dir, cpu_backend, n_sample=200, fai_path=None, n_worst=5,
+                            transformer_link="Rostlab/prot_t5_xl_half_uniref50-enc",
+                            max_residues=4000, max_seq_len=1000, max_batch=100):
+    """
+    Accuracy harness for the reduced-precision CPU backends: embed a sample of n_sample
+    sequences, spread evenly over the length range of seq_path, with the fp32 reference
+    and with cpu_backend, and print the speedup and the per-protein cosine similarity,
+    Pearson correlation and MSE against the reference (as in compare_h5.py). Each backend
+    first embeds a few sequences untimed, so one-off costs such as starting the thread
+    pool and the first allocations are not counted in its time.
+    """
+    if cpu_backend == 'fp32':
+        raise ValueError("The accuracy report compares a reduced-precision backend with fp32: "
+                         "choose --cpu_backend bf16 or int8")
+    if device != torch.device("cpu"):
+        raise ValueError(f"The accuracy report is for the CPU backends, but the device is {device}")
+    fasta = FastaIndex(seq_path, fai_path)
+    seq_order = fasta.order_by_length(descending=True)
+    sample = seq_order[np.unique(np.linspace(0, len(seq_order) - 1, min(n_sample, len(seq_order))).astype(np.int64))]
+    planner_args = dict(max_residues=max_residues, max_seq_len=max_seq_len, max_batch=max_batch)
+    print("Accuracy report for CPU backend '{}' on {} sequences of {}".format(cpu_backend, len(sample), seq_path))
+
+    results = {}
+    for backend in ('fp32', cpu_backend):
+        model, vocab = get_T5_model(model_dir, transformer_link, cpu_backend=backend)
+        # untimed warm-up on a few sequences across the length range
+        embed_sample(fasta, sample[::max(1, len(sample) // 8)], model, vocab, **planner_args)
+        results[backend] = embed_sample(fasta, sample, model, vocab, **planner_args)
+        del model
+    fasta.close()
+
+    ref, ref_time = results['fp32']
+    test, test_time = results[cpu_backend]
+    ids = [pid for pid in ref if pid in test]
+    metrics = embedding_metrics(np.stack([ref[pid] for pid in ids]), np.stack([test[pid] for pid in ids]))
+
+    print('\n############# CPU BACKEND REPORT #############')
+    print('Proteins compared: {}'.format(len(ids)))
+    print('fp32: {:.2f}[s]; {}: {:.2f}[s]; speedup: {:.2f}x'.format(ref_time, cpu_backend, test_time, ref_time / test_time))
+    for name, worst in (('cosine', 'min'), ('pearson', 'min'), ('mse', 'max')):
+        values = metrics[name]
+        print('{:8s} mean: {:.6g}; median: {:.6g}; {}: {:.6g}'.format(
+                name, values.mean(), np.median(values), worst, values.min() if worst == 'min' else values.max()))
+    print('Lowest cosine similarity:')
+    for i in np.argsort(metrics['cosine'])[:n_worst]:
+        print('  {} cosine={:.6f} pearson={:.6f} mse={:.3g}'.format(
+                ids[i], metrics['cosine'][i], metrics['pearson'][i], metrics['mse'][i]))
+    return metrics
+
+def read_task_manifest(manifest_path):
+    """
+    Tasks from a manifest such as valid_tasks4slurm.txt, one per line, e.g. 001,0_99,002.
+    Returns [(task name, fields)], the name being the fields joined by '_'. In a manifest
+    from plan_tasks.py (task,fasta,ranges,...) the name is the task number.
+    """
+    virtual = is_virtual_manifest(manifest_path)
+    tasks = []
+    with open(manifest_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = [field.strip() for field in line.split(',')]
+            tasks.append((fields[0] if virtual else "_".join(fields), fields))
+    return tasks
+
+class TaskClaims:
+    """
+    Coordinates which worker runs which task via an append-only claims file, only ever
+    read and appended to under an exclusive flock. Each line is
+    `task <TAB> state <TAB> owner <TAB> unix time`, state being claimed, done or failed;
+    the last line for a task is its current state. A claim that is still open after
+    reclaim_after seconds (e.g. its worker was killed) may be claimed again, 0 disables this.
+    """
+
+    def __init__(self, claims_path, owner, reclaim_after=0):
+        self.claims_path = str(claims_path)
+        self.owner = owner
+        self.reclaim_after = reclaim_after
+
+    def _append(self, f, task, state):
+        f.write(f"{task}\t{state}\t{self.owner}\t{time.time():.0f}\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+    def claim(self, tasks):
+        """Claim the first task that is free, returning (task name, fields), or None if all are taken."""
+        with open(self.claims_path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                states = {}
+                for line in f:
+                    cols = line.rstrip('\n').split('\t')
+                    if len(cols) == 4:
+                        states[cols[0]] = (cols[1], float(cols[3]))
+                now = time.time()
+                for task, fields in tasks:
+                    state = states.get(task)
+                    if state is None or (state[0] == 'claimed' and self.reclaim_after > 0
+                                         and now - state[1] > self.reclaim_after):
+                        self._append(f, task, 'claimed')
+                        return task, fields
+                return None
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def finish(self, task, state):
+        with open(self.claims_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                self._append(f, task, state)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+def run_task_worker(manifest_path, input_template, output_template, model_dir, master_emb_path,
+                    claims_path=None, time_budget=0, reclaim_after=0,
+                    processed_index=None, transformer_link="Rostlab/prot_t5_xl_half_uniref50-enc",
+                    cpu_backend='fp32', **embed_args):
+    """
+    Persistent worker: load the model (and the processed IDs) once, then keep claiming
+    tasks from the manifest and embedding them, one output file per task, until no tasks
+    are left or the next task would likely not finish within time_budget seconds (judged
+    by the longest task so far). Task fields fill in {0}, {1}, ... of the input and output
+    templates and {task} is the task name, e.g.
+      --input 'splits/clusters_more_than1.part_{0}_filtered1000AAmax_sorted_{1}.part_{2}.fasta'
+      --output 'embeddings/embed_{task}.h5'
+    A manifest from plan_tasks.py names the FASTA and byte ranges of each task, which are
+    read straight from that FASTA (virtual shards), so no input template is needed.
+    """
+    worker_start = time.time()
+    tasks = read_task_manifest(manifest_path)
+    virtual = is_virtual_manifest(manifest_path)
+    owner = "{}:{}:{}".format(os.getenv('MY_SLURM_PROCESS_ID', ''), os.uname().nodename, os.getpid())
+    claims = TaskClaims(claims_path or f"{manifest_path}.claims", owner, reclaim_after)
+    print("Worker {} found {} tasks in {}, claims in {}".format(owner, len(tasks), manifest_path, claims.claims_path))
+
+    model_vocab = get_T5_model(model_dir, transformer_link, cpu_backend)
+    if processed_index is not None:
+        processed_ids = load_processed_index(processed_index)
+    else:
+        processed_ids = read_processed_ids(master_emb_path)
+
+    n_done = 0
+    longest_task = 0.0
+    while True:
+        elapsed = time.time() - worker_start
+        if time_budget > 0 and elapsed + longest_task > time_budget:
+            print("Stopping: {:.0f}[s] used and the longest task took {:.0f}[s] of a {:.0f}[s] budget".format(
+                    elapsed, longest_task, time_budget))
+            break
+        claimed = claims.claim(tasks)
+        if claimed is None:
+            print("Stopping: no unclaimed tasks left")
+            break
+        task, fields = claimed
+        byte_ranges = None
+        if virtual:
+            seq_path, byte_ranges = parse_manifest_task(fields)
+            seq_path = Path(seq_path)
+        else:
+            seq_path = Path(input_template.format(*fields, task=task))
+        emb_path = Path(output_template.format(*fields, task=task))
+        print("\n=== Task {}: {} -> {} ===".format(task, seq_path, emb_path))
+        logging.info(f"=========TASK {task} STARTING: {seq_path}============")
+        sys.stdout.flush()
+        task_start = time.time()
+        try:
+            get_embeddings(seq_path, emb_path, model_dir, master_emb_path, byte_ranges=byte_ranges,
+                           model_vocab=model_vocab, processed_ids=processed_ids, **embed_args)
+        except Exception as e:
+            # a broken task should not take the rest of the worker's time budget with it
+            print("Task {} failed: {!r}".format(task, e))
+            logging.exception(f"Task {task} failed")
+            claims.finish(task, 'failed')
+        else:
+            claims.finish(task, 'done')
+            n_done += 1
+        longest_task = max(longest_task, time.time() - task_start)
+        sys.stdout.flush()
+
+    print("Worker finished {} tasks in {:.2f}[s]".format(n_done, time.time() - worker_start))
+    return n_done
+
+
 def create_arg_parser():
     """Creates and returns the ArgumentParser object."""
 
@@ -257,12 +977,15 @@ def create_arg_parser():
             ' file containing sequence(s) in FASTA-format.') )
     
     # Required positional argument
-    parser.add_argument( '-i', '--input', required=True, type=str,
-                    help='A path to a fasta-formatted text file containing protein sequence(s).')
+    parser.add_argument( '-i', '--input', required=False, type=str,
+                    help='A path to a fasta-formatted text file containing protein sequence(s). '
+                         'With --task_manifest, a template filled in from each task, e.g. part_{0}_sorted_{1}.part_{2}.fasta '
+                         '(not needed for a plan_tasks.py manifest, which names the fasta)')
 
     # Required positional argument
     parser.add_argument( '-o', '--output', required=True, type=str, 
-                    help='A path for saving the created embeddings as NumPy npz file.')
+                    help='A path for saving the created embeddings as an HDF5 file (layout set by --output_format). '
+                         'With --task_manifest, a template such as embed_{task}.h5')
 
     # Optional positional argument
     parser.add_argument('--model', required=False, type=str,
@@ -273,6 +996,10 @@ def create_arg_parser():
     parser.add_argument( '--master_embedding_file', required=False, type=str, 
                     help='A path for all the current embeddings which will be checked to avoid duplicate work')
 
+    parser.add_argument('--processed_index', required=False, type=str, default=None,
+                    help='Prefix of a key index published by key_index.py (e.g. <master>.keyidx). '
+                         'It is memory-mapped and used instead of reading the keys of --master_embedding_file')
+
     # Optional argument
     parser.add_argument('--per_protein', type=int, 
                     default=1,
@@ -289,13 +1016,66 @@ def create_arg_parser():
                         help='Max sequence length after which we switch to single-sequence processing (default: 1000)')
     parser.add_argument('--max_batch', type=int, default=100,
                         help='Maximum number of sequences per batch (default: 100)')    
+    parser.add_argument('--batch_planner', type=str, choices=sorted(BATCH_PLANNERS), default='residues',
+                        help="'residues': cap cumulative residues per batch at --max_residues (default). "
+                             "'padded': cap the padded batch size (n_seqs x longest) plus a quadratic attention "
+                             "term at --max_padded_tokens")
+    parser.add_argument('--max_padded_tokens', type=int, default=16000,
+                        help='Padded token budget per batch for --batch_planner padded (default: 16000)')
+    parser.add_argument('--attention_weight', type=float, default=1/2048,
+                        help='Cost per padded token of each extra position attended to, for --batch_planner padded. '
+                             'A batch costs n_seqs x L x (1 + attention_weight x L) for padded length L (default: 1/2048)')
+    parser.add_argument('--fai', required=False, type=str, default=None,
+                        help='A path to the .fai index of the input fasta (default: <input>.fai if it exists, '
+                             'otherwise the fasta is scanned once to build the index)')
+    parser.add_argument('--byte_ranges', required=False, type=str, default=None,
+                        help='Only embed the records in these byte ranges of the input, e.g. 0-5314020;7931-9641 '
+                             'as in a plan_tasks.py manifest, read straight from the fasta without its .fai')
+    parser.add_argument('--pipeline_depth', type=int, default=0,
+                        help='Overlap tokenization, the forward pass and writing using bounded queues holding this many '
+                             'batches per stage (default: 0, run the stages one after another)')
+    parser.add_argument('--output_format', type=str, choices=['per_key', 'store'], default='per_key',
+                        help="'per_key': one dataset per protein (default). 'store': chunked, resizable 'embeddings' (N x 1024) "
+                             "and 'keys' datasets as written by merge_h5_inter_to_big.py, appended in blocks")
+    parser.add_argument('--flush_rows', type=int, default=10000,
+                        help='Embeddings buffered in memory before each append with --output_format store (default: 10000)')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Embed identical sequences (after U/Z/O->X) only once. The other IDs are written as links '
+                             '(per_key) or copied rows (store) of that embedding')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of CPU inference processes (CPU-only nodes). The model is loaded once and shared, '
+                             'each worker gets an equal share of the available CPUs and a length-balanced shard of the '
+                             'input, and all results are written to the one output (default: 1)')
+    parser.add_argument('--task_manifest', type=str, default=None,
+                        help='Run as a persistent worker: load the model once and embed task after task from this '
+                             'manifest (e.g. valid_tasks4slurm.txt, comma-separated fields per line)')
+    parser.add_argument('--task_claims', type=str, default=None,
+                        help='Claims file shared by all workers of a manifest (default: <task_manifest>.claims)')
+    parser.add_argument('--time_budget', type=float, default=0,
+                        help='Wall-clock seconds for a --task_manifest worker. No new task is started if the longest '
+                             'task so far would not fit in what is left (default: 0, no limit)')
+    parser.add_argument('--reclaim_after', type=float, default=0,
+                        help='Seconds after which a task claimed but never finished may be claimed again '
+                             '(default: 0, never)')
+    parser.add_argument('--cpu_backend', type=str, choices=CPU_BACKENDS, default='fp32',
+                        help="Precision when running on CPU: 'fp32' (default), 'bf16' autocast or dynamic 'int8' "
+                             "quantization of the linear layers. Check with --accuracy_report first")
+    parser.add_argument('--accuracy_report', type=int, default=0,
+                        help='Instead of embedding, compare --cpu_backend against fp32 on this many sequences of '
+                             'the input spread over its length range, and report speedup, cosine similarity, '
+                             'Pearson correlation and MSE (default: 0, off)')
+    parser.add_argument('--transformer_link', type=str, default="Rostlab/prot_t5_xl_half_uniref50-enc",
+                        help='Hugging Face name or local directory of the encoder and tokenizer, e.g. a tiny '
+                             'checkpoint for testing on CPU (default: Rostlab/prot_t5_xl_half_uniref50-enc)')
     return parser
 
 def main():
     parser     = create_arg_parser()
     args       = parser.parse_args()
     
-    seq_path   = Path( args.input )
+    if args.input is None and (args.task_manifest is None or not is_virtual_manifest(args.task_manifest)):
+        parser.error("--input is required, except with a --task_manifest written by plan_tasks.py")
+    seq_path   = Path( args.input ) if args.input is not None else None
     emb_path   = Path( args.output)
     master_emb_path = Path( args.master_embedding_file) if args.master_embedding_file is not None else None
     model_dir  = Path( args.model ) if args.model is not None else None
@@ -306,6 +1086,8 @@ def main():
     max_residues = args.max_residues
     max_seq_len  = args.max_seq_len
     max_batch    = args.max_batch
+    fai_path     = Path( args.fai ) if args.fai is not None else None
+    pipeline_depth = args.pipeline_depth
 
     # Very minor, but if the log file exists, we open it and write a newline to separate the appearance of jobs
     if log_path is not None and os.path.exists(log_path):
@@ -315,8 +1097,28 @@ def main():
     setup_logging(log_path)
 #    logging.basicConfig(filename=log_path, level=logging.INFO, format='%(asctime)s - %(levelname)s - Process: %(process)d - %(message)s')
     
-    get_embeddings( seq_path, emb_path, model_dir, master_emb_path=master_emb_path, per_protein=per_protein, 
-                    max_residues=max_residues, max_seq_len=max_seq_len, max_batch=max_batch)
+    embed_args = dict(per_protein=per_protein, 
+                    max_residues=max_residues, max_seq_len=max_seq_len, max_batch=max_batch,
+                    batch_planner=args.batch_planner, max_padded_tokens=args.max_padded_tokens,
+                    attention_weight=args.attention_weight, processed_index=args.processed_index, dedup=args.dedup,
+                    workers=args.workers, pipeline_depth=pipeline_depth, output_format=args.output_format,
+                    flush_rows=args.flush_rows, transformer_link=args.transformer_link, cpu_backend=args.cpu_backend)
+
+    if args.accuracy_report > 0:
+        backend_accuracy_report(seq_path, model_dir, args.cpu_backend, args.accuracy_report, fai_path=fai_path,
+                                transformer_link=args.transformer_link, max_residues=max_residues,
+                                max_seq_len=max_seq_len, max_batch=max_batch)
+        return
+
+    if args.task_manifest is not None:
+        run_task_worker(args.task_manifest, args.input, args.output, model_dir, master_emb_path,
+                        claims_path=args.task_claims, time_budget=args.time_budget,
+                        reclaim_after=args.reclaim_after, **embed_args)
+        return
+
+    byte_ranges = parse_byte_ranges(args.byte_ranges) if args.byte_ranges is not None else None
+    get_embeddings( seq_path, emb_path, model_dir, master_emb_path=master_emb_path, fai_path=fai_path,
+                    byte_ranges=byte_ranges, **embed_args)
 
 if __name__ == '__main__':
     print("Starting...")
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Hash-sharded embedding store: N ordinary embeddings/keys stores (see embedding_store.py)
+plus a small JSON manifest, written by merge_h5_big_to_final.py --shards N.
+
+Each key goes to shard hash(key) % N, with the same 64-bit BLAKE2b hash as key_index.py,
+so a lookup only opens the one shard that can hold the key. The shards can be copied,
+locked, indexed (key_index.py --h5 <shard>) and scanned independently, e.g. one process
+per shard with ShardedStore.map_shards.
+
+Files for --output-file GlobDB40.h5 and 16 shards:
+  GlobDB40.manifest.json               hash scheme, number of shards, rows per shard, profile
+  GlobDB40.shard000.h5 ... shard015.h5 the shards, named relative to the manifest
+
+The manifest is written last, so its presence means all shards are complete.
+
+Example:
+    store = ShardedStore("GlobDB40.manifest.json")
+    embeddings = store.get(["BCRBG_15609___2917", "GCA_013288945___541"])
+    row_counts = store.map_shards(count_rows, processes=8)
+"""
+import json
+import os
+import time
+from multiprocessing import get_context
+
+import h5py
+import numpy as np
+
+from embedding_store import (DEFAULT_PROFILE, EMB_CHUNK_ROWS, ChunkGather, EmbeddingStoreWriter,
+                             create_store_datasets, iter_embedding_blocks)
+from key_index import HASH_SCHEME, KeyIndex, hash_keys, index_paths
+
+MANIFEST_FORMAT = "sharded-embedding-store"
+
+
+def sharded_paths(output_file, n_shards):
+    """(manifest path, shard paths) for an output file name like GlobDB40.h5."""
+    prefix = output_file[:-3] if output_file.endswith('.h5') else output_file
+    shards = [f"{prefix}.shard{i:03d}.h5" for i in range(n_shards)]
+    return f"{prefix}.manifest.json", shards
+
+
+def shard_of(keys, n_shards) -> np.ndarray:
+    """Shard number of each key."""
+    return (hash_keys(keys) % np.uint64(n_shards)).astype(np.int64)
+
+
+class ShardedStoreWriter:
+    """
+    Routes appended rows to the shards by key hash. Each shard is written through an
+    EmbeddingStoreWriter, so rows are buffered and appended a chunk at a time.
+    Existing shards and manifest at these paths are replaced.
+    """
+
+    def __init__(self, output_file, n_shards, n_cols, profile=DEFAULT_PROFILE, chunk_rows=EMB_CHUNK_ROWS):
+        self.manifest_path, self.shard_paths = sharded_paths(output_file, n_shards)
+        self.n_shards = n_shards
+        self.n_cols = n_cols
+        self.profile = profile
+        self.rows_written = 0
+        self.writers = []
+        for path in self.shard_paths:
+            with h5py.File(path, 'w') as hf:
+                create_store_datasets(hf, n_cols, emb_chunk_rows=chunk_rows, profile=profile)
+            self.writers.append(EmbeddingStoreWriter(path, flush_rows=chunk_rows, emb_chunk_rows=chunk_rows,
+                                                     profile=profile))
+
+    def append(self, keys, embeddings):
+        """Append a block of rows, each to its shard. Returns the total number of rows so far."""
+        keys = list(keys)
+        shards = shard_of(keys, self.n_shards)
+        order = np.argsort(shards, kind='stable')
+        bounds = np.searchsorted(shards[order], np.arange(self.n_shards + 1))
+        for shard in range(self.n_shards):
+            rows = order[bounds[shard]:bounds[shard + 1]]
+            if len(rows):
+                self.writers[shard].write([keys[i] for i in rows], embeddings[rows])
+        self.rows_written += len(keys)
+        return self.rows_written
+
+    def close(self):
+        """Flush every shard, then publish the manifest."""
+        for writer in self.writers:
+            writer.close()
+        shards = []
+        for path in self.shard_paths:
+            with h5py.File(path, 'r') as hf:
+                shards.append({'path': os.path.basename(path), 'rows': int(hf['keys'].shape[0])})
+        manifest = {
+            'format': MANIFEST_FORMAT,
+            'hash_scheme': HASH_SCHEME,
+            'n_shards': self.n_shards,
+            'total_rows': sum(s['rows'] for s in shards),
+            'width': self.n_cols,
+            'storage_profile': self.profile,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'shards': shards,
+        }
+        tmp_path = f"{self.manifest_path}.tmp{os.getpid()}"
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+        return manifest
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+
+
+def _lookup_in_shard(path, keys, verify=True):
+    """{key: embedding} for the keys found in one shard, through its key index if it has one."""
+    keys = list(keys)
+    prefix = f"{path}.keyidx"
+    with h5py.File(path, 'r') as hf:
+        if os.path.exists(index_paths(prefix)['meta']):
+            rows = KeyIndex(prefix).lookup(keys)
+        else:
+            # no index: one pass over this shard's keys only
+            wanted = {k: i for i, k in enumerate(keys)}
+            rows = np.full(len(keys), -1, dtype=np.int64)
+            keys_ds = hf['keys']
+            for start in range(0, keys_ds.shape[0], 1_000_000):
+                block = keys_ds.asstr()[start:start + 1_000_000]
+                for j in np.flatnonzero(np.isin(block, keys)):
+                    rows[wanted[block[j]]] = start + j
+        hits = np.flatnonzero(rows >= 0)
+        if not len(hits):
+            return {}
+        unique_rows, inverse = np.unique(rows[hits], return_inverse=True)
+        embs = ChunkGather(hf).gather(unique_rows)
+        stored_keys = hf['keys'].asstr()[unique_rows] if verify else None
+    return {keys[i]: embs[j] for i, j in zip(hits, inverse) if not verify or stored_keys[j] == keys[i]}
+
+
+def _map_shard(args):
+    func, path, func_args = args
+    return func(path, *func_args)
+
+
+class ShardedStore:
+    """Read access to a sharded store through its manifest."""
+
+    def __init__(self, manifest_path):
+        self.manifest_path = str(manifest_path)
+        with open(self.manifest_path, 'r') as f:
+            self.manifest = json.load(f)
+        if self.manifest.get('format') != MANIFEST_FORMAT:
+            raise ValueError(f"{self.manifest_path} is not a sharded store manifest")
+        if self.manifest['hash_scheme'] != HASH_SCHEME:
+            raise ValueError(f"Unsupported hash scheme {self.manifest['hash_scheme']} in {self.manifest_path}")
+        self.n_shards = self.manifest['n_shards']
+        base_dir = os.path.dirname(os.path.abspath(self.manifest_path))
+        self.shard_paths = [os.path.join(base_dir, s['path']) for s in self.manifest['shards']]
+
+    def __len__(self) -> int:
+        return self.manifest['total_rows']
+
+    def shard_of(self, keys) -> np.ndarray:
+        return shard_of(keys, self.n_shards)
+
+    def get(self, keys, verify=True):
+        """{key: float32 embedding} for the keys found, opening only the shards they hash to."""
+        keys = list(keys)
+        shards = self.shard_of(keys)
+        result = {}
+        for shard in np.unique(shards):
+            shard_keys = [keys[i] for i in np.flatnonzero(shards == shard)]
+            result.update(_lookup_in_shard(self.shard_paths[shard], shard_keys, verify))
+        return result
+
+    def iter_blocks(self, block_rows=EMB_CHUNK_ROWS):
+        """Stream (keys, embeddings) blocks over all shards in turn."""
+        for path in self.shard_paths:
+            yield from iter_embedding_blocks(path, block_rows)
+
+    def map_shards(self, func, processes=1, args=()):
+        """
+        [func(shard_path, *args) for each shard], run in `processes` worker processes.
+        func must be a module-level function, e.g. one that loops over
+        iter_embedding_blocks(shard_path) and returns a partial result to combine.
+        """
+        tasks = [(func, path, tuple(args)) for path in self.shard_paths]
+        if processes <= 1:
+            return [_map_shard(t) for t in tasks]
+        with get_context('fork').Pool(processes=min(processes, len(tasks))) as pool:
+            return pool.map(_map_shard, tasks, chunksize=1)
+
+
+def count_rows(shard_path, block_rows=EMB_CHUNK_ROWS):
+    """Example map_shards function: number of non-empty rows in a shard."""
+    return sum(len(keys) for keys, _ in iter_embedding_blocks(shard_path, block_rows))
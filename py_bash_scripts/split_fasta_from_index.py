@@ -1,8 +1,13 @@
 from itertools import islice
+from multiprocessing import get_context
+import os
 import sys
-from typing import List
+import time
+from typing import List, Tuple
 
-def split_fasta(fasta_file: str, fai_file: str, part_size: int, output_string: str) -> None:
+from fasta_index import copy_range
+
+def split_fasta(fasta_file: str, fai_file: str, part_size: int, output_string: str, workers: int = 1) -> None:
     """
     Splits a large FASTA file into smaller parts using its .fai index file.
 
@@ -39,13 +44,17 @@ def split_fasta(fasta_file: str, fai_file: str, part_size: int, output_string: s
        - Extract the sequence ID and calculate its length in bytes.
        - Add 2 bytes (for '>' and newline) to account for the FASTA header format.
        - Adjust the byte offset to include the ID line.
-    3. Write each part to a separate output file, ensuring valid FASTA format.
+    3. Copy each part's byte range to its own output file with `copy_range` (os.copy_file_range,
+       so the data is copied by the kernel without passing through Python, falling back to
+       sendfile and then to chunked reads), on `workers` processes at once, and check that
+       each output has exactly the size of its byte range.
 
     Args:
         fasta_file (str): Path to the input FASTA file.
         fai_file (str): Path to the corresponding .fai index file.
         part_size (int): Number of sequences per output part.
         output_string (str): Template for output filenames (e.g., "path/to/file/prefix_"). `{part_num:03d}.fasta` will be appended.
+        workers (int): Number of processes copying parts at the same time (default 1).
 
     Output:
         Generates multiple FASTA files, each containing `part_size` sequences, with filenames
@@ -95,48 +104,67 @@ def split_fasta(fasta_file: str, fai_file: str, part_size: int, output_string: s
 #            offsets_file.write(f"{offset}\n")
 #    print(f"len offset: {len(offsets)}")
 
-    # Open the FASTA file and extract parts
-    try:
-        # Open the FASTA file for reading
-        with open(fasta_file, 'rb') as fasta:
-            part_num = 1
-            total_parts = len(offsets)
-    
-            for i in range(total_parts):
-                # Calculate the start and end of the part
-                start_offset = offsets[i]
-                if i + 1 < total_parts:
-                    end_offset = offsets[i + 1]
-                else:
-                    # For the last part, read until the end of the file
-                    end_offset = None
-    
-                    # Generate the output filename
-                    output_file = output_string.format(part_num=part_num)
-    
-                    # Write the part to the output file
-                    try:
-                        with open(output_file, 'wb') as out_f:
-                            # Seek the start of the part
-                            fasta.seek(start_offset)
-                            # With file.read(size) at most size characters (in text mode) or size bytes (in binary mode) are read and returned.
-                            # So we read all that we need in 1 go
-                            if end_offset is not None:
-                                part_bytes = fasta.read(end_offset - start_offset)
-                            else:
-                                # Now it will read until the end of the file
-                                part_bytes = fasta.read()
-                            # Write the whole part to the output file
-                            out_f.write(part_bytes)
-                        print(f"Written {output_file}")
-                        sys.stdout.flush()
-                    except IOError as e:
-                        raise IOError(f"Error writing to output file '{output_file}': {e}")
-                    part_num += 1
-    except FileNotFoundError:
+    if not os.path.exists(fasta_file):
         raise FileNotFoundError(f"The FASTA file '{fasta_file}' does not exist.")
-    except Exception as e:
-        raise RuntimeError(f"Error processing FASTA file: {e}")
+    fasta_size = os.path.getsize(fasta_file)
+
+    # Each part runs from its offset to the next part's offset, the last one to the end of the file
+    parts: List[Tuple[str, int, int]] = []
+    for i, start_offset in enumerate(offsets):
+        end_offset = offsets[i + 1] if i + 1 < len(offsets) else fasta_size
+        parts.append((output_string.format(part_num=i + 1), start_offset, end_offset))
+
+    # Check the calculated offsets really are the start of a sequence ID (e.g. not if the
+    # headers hold more than the .fai NAME), before anything is written
+    fd = os.open(fasta_file, os.O_RDONLY)
+    try:
+        for output_file, start_offset, _ in parts:
+            if os.pread(fd, 1, start_offset) != b'>':
+                raise ValueError(f"Byte {start_offset} of '{fasta_file}' (start of {output_file}) is not the "
+                                 f"start of a sequence ID; are there descriptions after the IDs?")
+    finally:
+        os.close(fd)
+
+    start_time = time.time()
+    if workers > 1:
+        with get_context('fork').Pool(workers) as pool:
+            results = pool.imap_unordered(_copy_part, [(fasta_file, *part) for part in parts])
+            _report_parts(results, start_time)
+    else:
+        _report_parts(map(_copy_part, [(fasta_file, *part) for part in parts]), start_time)
+    elapsed = max(time.time() - start_time, 1e-9)
+    print(f"Written {len(parts)} parts, {fasta_size / 1024 ** 3:.2f} GB in {elapsed:.1f}[s] "
+          f"({fasta_size / elapsed / 1024 ** 2:.1f} MB/s) with {workers} workers")
+
+
+def _copy_part(args: Tuple[str, str, int, int]) -> Tuple[str, int]:
+    """Copy bytes start_offset:end_offset of the FASTA to output_file and check its size."""
+    fasta_file, output_file, start_offset, end_offset = args
+    src = os.open(fasta_file, os.O_RDONLY)
+    try:
+        try:
+            dst = os.open(output_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                copy_range(src, dst, start_offset, end_offset - start_offset)
+            finally:
+                os.close(dst)
+        except (IOError, EOFError) as e:
+            raise IOError(f"Error writing to output file '{output_file}': {e}")
+    finally:
+        os.close(src)
+    size = os.path.getsize(output_file)
+    if size != end_offset - start_offset:
+        raise IOError(f"'{output_file}' has {size} bytes, expected {end_offset - start_offset} "
+                      f"(bytes {start_offset} to {end_offset})")
+    return output_file, size
+
+
+def _report_parts(results, start_time: float) -> None:
+    written = 0
+    for output_file, size in results:
+        written += size
+        print(f"Written {output_file} ({written / max(time.time() - start_time, 1e-9) / 1024 ** 2:.1f} MB/s so far)")
+        sys.stdout.flush()
 
 def main():
     # Parameters
@@ -144,9 +172,10 @@ def main():
     fai_file = "/lisc/scratch/dome/pullen/GlobDB/fastas/globdb_r226_all_prot.faa.seqkit.fai"
     output_string = "/lisc/scratch/dome/pullen/GlobDB/fastas/globdb_r226_all_prot_part_{part_num:03d}.fasta"  # Zero-padded filenames
     part_size = 3354462  #sequences per split file, based on total sequences/some round number: 838615274/250=3354461.096
-    
+    workers = int(os.environ.get('SLURM_CPUS_PER_TASK', 1))  # parts copied at the same time
+
     # Run the splitting
-    split_fasta(fasta_file, fai_file, part_size, output_string)
+    split_fasta(fasta_file, fai_file, part_size, output_string, workers)
 
 if __name__ == '__main__':
     main()